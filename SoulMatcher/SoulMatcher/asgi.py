@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'SoulMatcher.settings')
 
 application = get_asgi_application()
+
+# Построение резидентной матрицы приоритетов до приема первых запросов,
+# если способ поиска по умолчанию (SEARCH_MODE) ищет по ней
+from soulmate.matching import warm_up  # noqa: E402
+
+warm_up()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 
@@ -87,6 +88,48 @@ DATABASES = {
     }
 }
 
+# Профиль SQLite для продакшена (SOULMATE_DB_PROFILE=production):
+# журнал WAL, прагмы для каждого соединения (soulmate.database)
+# и реплика - соединение только для чтения к той же БД, чтения
+# которого в режиме WAL не ждут записей приоритетов
+DB_PROFILE = os.environ.get('SOULMATE_DB_PROFILE', 'development')
+
+SQLITE_PRODUCTION_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    # Отрицательное значение - размер в КиБ
+    'cache_size': -64 * 1024,
+    'busy_timeout': 5000,
+}
+
+SQLITE_PRAGMAS = {}
+
+if DB_PROFILE == 'production':
+    SQLITE_PRAGMAS = SQLITE_PRODUCTION_PRAGMAS
+    DATABASES['default']['OPTIONS'] = {'timeout': 5}
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f"file:{DATABASES['default']['NAME']}?mode=ro",
+        'OPTIONS': {'timeout': 5},
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Реплика для чтений в отдельном файле SQLite (SOULMATE_REPLICA_DB),
+# который обновляется командой sync_replica; реплика PostgreSQL
+# подключается так же, записью 'replica' в DATABASES
+REPLICA_DB = os.environ.get('SOULMATE_REPLICA_DB')
+
+if REPLICA_DB:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': REPLICA_DB,
+        'OPTIONS': {'timeout': 5},
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['soulmate.database.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -153,3 +196,6 @@ CACHES = {
     }
 }
 
+# Переопределения настроек подбора совместимых пользователей:
+# значения по умолчанию и их описания - soulmate/matching/conf.py
+SOULMATE_MATCHING = {}
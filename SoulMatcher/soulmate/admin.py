@@ -1,16 +1,98 @@
+from django import forms
 from django.contrib import admin
 
-from .models import CustomUser, Aspect, Attitude, Weight, Priority
+from .database import replica_reads
+from .models import CustomUser, Aspect, UserPriority
+
+
+class UserPriorityForm(forms.ModelForm):
+    """
+    Форма приоритета с выбором отношения и веса,
+    из которых вычисляется знаковый вес.
+    """
+    attitude = forms.ChoiceField(choices=UserPriority.ATTITUDES)
+    weight = forms.TypedChoiceField(choices=UserPriority.WEIGHTS, coerce=int)
+
+    class Meta:
+        model = UserPriority
+        fields = ('user', 'aspect', 'attitude', 'weight')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.initial['attitude'] = self.instance.attitude
+            self.initial['weight'] = self.instance.weight
+
+    def save(self, commit=True):
+        self.instance.signed_weight = UserPriority.to_signed_weight(
+            self.cleaned_data['attitude'], self.cleaned_data['weight']
+        )
+        return super().save(commit)
 
 
 class PriorityInline(admin.TabularInline):
-    model = Priority.users.through
-    raw_id_fields = ('priority',)
+    model = UserPriority
+    form = UserPriorityForm
+    raw_id_fields = ('aspect',)
     extra = 0
 
 
+class AttitudeFilter(admin.SimpleListFilter):
+    """
+    Фильтр приоритетов по знаку знакового веса.
+    """
+    title = 'attitude'
+    parameter_name = 'attitude'
+
+    def lookups(self, request, model_admin):
+        return UserPriority.ATTITUDES
+
+    def queryset(self, request, queryset):
+        if self.value() == 'positive':
+            return queryset.filter(signed_weight__gt=0)
+        if self.value() == 'negative':
+            return queryset.filter(signed_weight__lt=0)
+        return queryset
+
+
+class WeightFilter(admin.SimpleListFilter):
+    """
+    Фильтр приоритетов по модулю знакового веса.
+    """
+    title = 'weight'
+    parameter_name = 'weight'
+
+    def lookups(self, request, model_admin):
+        return [(str(value), label) for value, label in UserPriority.WEIGHTS]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        weight = int(self.value())
+        return queryset.filter(signed_weight__in=[weight, -weight])
+
+
+class ReplicaChangeListMixin:
+    """
+    Выполняет чтения страниц списков (GET) через реплику.
+    Страница отрисовывается внутри области replica_reads(),
+    так как queryset списка вычисляется при отрисовке шаблона.
+    Действия над выбранными объектами (POST) и карточки
+    объектов работают с основной БД.
+    """
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with replica_reads():
+            response = super().changelist_view(request, extra_context)
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+
 @admin.register(CustomUser)
-class CustomUserAdmin(admin.ModelAdmin):
+class CustomUserAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
     list_display = ('username', 'email', 'email_confirmed')
     list_filter = ('email_confirmed',)
     search_fields = ('username', 'email')
@@ -18,26 +100,16 @@ class CustomUserAdmin(admin.ModelAdmin):
 
 
 @admin.register(Aspect)
-class AspectAdmin(admin.ModelAdmin):
+class AspectAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
     list_display = ('aspect',)
     search_fields = ('aspect',)
 
 
-@admin.register(Attitude)
-class AttitudeAdmin(admin.ModelAdmin):
-    list_display = ('attitude',)
-    search_fields = ('attitude',)
-
-
-@admin.register(Weight)
-class WeightAdmin(admin.ModelAdmin):
-    list_display = ('weight',)
-    search_fields = ('weight',)
-
-
-@admin.register(Priority)
-class PriorityAdmin(admin.ModelAdmin):
-    list_display = ('aspect', 'attitude', 'weight')
-    list_filter = ('aspect', 'attitude', 'weight')
-    search_fields = ('aspect__aspect', 'attitude__attitude', 'weight__weight')
-    filter_horizontal = ('users',)
+@admin.register(UserPriority)
+class UserPriorityAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    form = UserPriorityForm
+    list_display = ('user', 'aspect', 'attitude', 'weight')
+    list_filter = ('aspect', AttitudeFilter, WeightFilter)
+    search_fields = ('user__username', 'aspect__aspect')
+    raw_id_fields = ('user', 'aspect')
+    list_select_related = ('user', 'aspect')
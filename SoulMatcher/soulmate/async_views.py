@@ -0,0 +1,434 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+
+from django.http import HttpResponse, JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from rest_framework import exceptions, status
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .database import primary_reads, replica_reads, track_replica_reads, wrote_recently
+from .models import UserPriority, CustomUser
+from .serializers import PrioritySerializer
+from .views import CompatibleUsersMixin, CompatibleUsersView, query_flag
+from .matching import \
+    DATABASE_MODES, \
+    SEARCH_MODES, \
+    VectorStore, \
+    budgeted_search, \
+    display_names, \
+    find_compatible_users, \
+    find_mutual_users, \
+    get_engine, \
+    get_data_version, \
+    get_setting, \
+    matches_page, \
+    result_cache, \
+    run_scoring, \
+    single_flight, \
+    uses_vector_store
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    """
+    Формирует JSON-ответ так же, как JSONRenderer DRF.
+    """
+    return JsonResponse(
+        data,
+        status=status_code,
+        encoder=JSONEncoder,
+        safe=False,
+        json_dumps_params={'ensure_ascii': False}
+    )
+
+
+class AsyncAPIView(View):
+    """
+    Базовое асинхронное представление для работы под ASGI.
+
+    DRF не поддерживает асинхронные представления, поэтому запрос
+    оборачивается в Request DRF вручную: тело разбирается теми же
+    парсерами, а пользователь определяется по JWT. Исключения DRF
+    (NotAuthenticated, NotFound и др.) превращаются в ответы
+    с полем detail, как в синхронных представлениях.
+
+    Attributes:
+        - authentication_required: Требовать аутентифицированного
+                                   пользователя
+        - replica_reads:           Направлять чтения в реплику,
+                                   как ReplicaReadsMixin
+    """
+    authentication_required = False
+    replica_reads = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Аутентификация выполняется по JWT, а не по сессии
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        request = self.request = Request(
+            request,
+            parsers=[JSONParser(), FormParser(), MultiPartParser()],
+            authenticators=[JWTAuthentication()]
+        )
+        try:
+            # Определение пользователя обращается к БД
+            user = await sync_to_async(lambda: request.user)()
+            if self.authentication_required and not user.is_authenticated:
+                raise exceptions.NotAuthenticated()
+            with await self.read_scope(user, kwargs):
+                return await super().dispatch(request, *args, **kwargs)
+        except exceptions.APIException as error:
+            return json_response({'detail': error.detail}, error.status_code)
+
+    async def read_scope(self, user, kwargs):
+        """
+        Возвращает область чтений запроса: реплику (replica_reads),
+        если она включена для представления и ни пользователь
+        из URL, ни пользователь запроса недавно не изменяли
+        приоритеты, иначе основную БД.
+        """
+        if not self.replica_reads:
+            return primary_reads()
+        user_ids = [kwargs.get('user_id'), user.id if user.is_authenticated else None]
+        # Отметки о записях хранятся в кэше
+        if await sync_to_async(wrote_recently)(user_ids):
+            return primary_reads()
+        return replica_reads()
+
+
+class AsyncCompatibleUsersView(CompatibleUsersMixin, AsyncAPIView):
+    """
+    Асинхронный вариант CompatibleUsersView.
+
+    Обращения к БД и кэшу выполняются асинхронным ORM или
+    в потоке sync_to_async, а вычисление сходств по резидентной
+    матрице - в ограниченном пуле потоков (SCORING_THREADS),
+    поэтому один процесс ASGI продолжает обслуживать медленные
+    и простаивающие соединения, пока идут поиски.
+    """
+
+    async def get(self, request, user_id):
+        """
+        Обрабатывает GET-запросы
+        для получения списка совместимых пользователей.
+
+        Параметры запроса и формат ответа совпадают
+        с CompatibleUsersView, кроме потоковой выдачи (stream=true):
+        ее строки формируются с обращениями к БД, а Django 4.1
+        читает потоковый ответ в цикле событий.
+
+        :param request: Объект запроса
+        :param user_id: ID пользователя,
+                        для которого необходимо найти совместимых пользователей
+        :return:        Список совместимых пользователей в
+                        порядке убывания степени совместимости,
+                        источник выдачи и время вычисления
+                        предвычисленного списка
+        """
+        started = time.monotonic()
+        mode = request.query_params.get('mode') or None
+        if mode is not None and mode not in SEARCH_MODES:
+            return json_response(
+                {"error": f"Unknown search mode: {mode}."},
+                status.HTTP_400_BAD_REQUEST
+            )
+        mutual = query_flag(request, 'mutual')
+        if self.is_listing(request):
+            return await self.list_page(request, user_id, mode, mutual)
+
+        deadline, errors = self.get_deadline(request, mode, mutual, started)
+        if errors is not None:
+            return json_response(errors, status.HTTP_400_BAD_REQUEST)
+
+        version = await sync_to_async(get_data_version)()
+        result = await sync_to_async(result_cache.get)(
+            user_id, mode, version, mutual
+        )
+        if result is None:
+            if not await CustomUser.objects.filter(id=user_id).aexists():
+                raise exceptions.NotFound()
+            result = await single_flight.ado(
+                self.flight_key(user_id, mode, mutual, deadline, version),
+                lambda: self.compute_matches(
+                    user_id, mode, mutual, deadline, version
+                )
+            )
+
+            if result is None:
+                return json_response(
+                    {"error": "User does not have any priorities."},
+                    status.HTTP_400_BAD_REQUEST
+                )
+
+        names = await sync_to_async(display_names.get_many)(
+            [compatible_user_id for compatible_user_id, _ in result["matches"]]
+        )
+        return json_response(self.serialize_result(result, names))
+
+    async def list_page(self, request, user_id, mode, mutual):
+        """
+        Возвращает страницу полной выдачи с курсором
+        (см. CompatibleUsersView.list_all_matches).
+        """
+        if query_flag(request, 'stream'):
+            return json_response(
+                {"error": "Streaming is supported by the synchronous view only."},
+                status.HTTP_400_BAD_REQUEST
+            )
+        params, errors = self.validate_listing(request, mode, mutual)
+        if errors is not None:
+            return json_response(errors, status.HTTP_400_BAD_REQUEST)
+
+        if not await CustomUser.objects.filter(id=user_id).aexists():
+            raise exceptions.NotFound()
+        snapshot = await sync_to_async(get_engine().snapshot)()
+        if not snapshot.has_priorities(user_id):
+            return json_response(
+                {"error": "User does not have any priorities."},
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        page = await run_scoring(
+            matches_page,
+            snapshot,
+            user_id,
+            params.get('threshold'),
+            params.get('cursor'),
+            params.get('page_size')
+        )
+        names = await sync_to_async(display_names.get_many)(
+            [compatible_user_id for compatible_user_id, _ in page[0]]
+        )
+        return json_response(self.serialize_page(page, names))
+
+    async def compute_matches(self, user_id, mode, mutual, deadline, version):
+        """
+        Находит совместимых пользователей и сохраняет выдачу в кэше
+        (см. CompatibleUsersView.compute_matches). Выдача другого
+        процесса ожидается опросом кэша с asyncio.sleep.
+        """
+        locked = False
+        if self.uses_cache_lock(deadline):
+            locked = await sync_to_async(result_cache.acquire)(
+                user_id, mode, version, mutual
+            )
+            if not locked:
+                result = await self.wait_result(user_id, mode, version, mutual)
+                if result is not None:
+                    return result
+
+        try:
+            with track_replica_reads() as reads:
+                result = await self.find_matches(user_id, mode, mutual, deadline)
+            if result is not None and await sync_to_async(self.is_cacheable)(
+                result, version, reads
+            ):
+                await sync_to_async(result_cache.set)(
+                    user_id, mode, result, version, mutual
+                )
+            return result
+        finally:
+            if locked:
+                await sync_to_async(result_cache.release)(
+                    user_id, mode, version, mutual
+                )
+
+    @staticmethod
+    async def wait_result(user_id, mode, version, mutual):
+        """
+        Асинхронный вариант ResultCache.wait.
+        """
+        interval = get_setting('SINGLE_FLIGHT_POLL_INTERVAL')
+        while True:
+            result = await sync_to_async(result_cache.peek)(
+                user_id, mode, version, mutual
+            )
+            if result is not None:
+                return result
+            if not await sync_to_async(result_cache.is_locked)(
+                user_id, mode, version, mutual
+            ):
+                return await sync_to_async(result_cache.peek)(
+                    user_id, mode, version, mutual
+                )
+            await asyncio.sleep(interval)
+
+    async def find_matches(self, user_id, mode, mutual=False, deadline=None):
+        """
+        Находит совместимых пользователей в предвычисленном списке
+        или на лету.
+
+        Перед поиском на лету снимок движка обновляется в потоке
+        sync_to_async (перечитываются строки изменившихся
+        пользователей) и закрепляется за запросом, после чего поиск
+        по нему не обращается к БД и выполняется в пуле потоков. Способы поиска,
+        обращающиеся к БД (DATABASE_MODES), выполняются целиком
+        в потоке sync_to_async.
+
+        :param user_id:  ID пользователя
+        :param mode:     Способ поиска или None
+        :param mutual:   Искать только взаимно совместимых пользователей
+        :param deadline: Момент окончания бюджета времени поиска
+                         на лету или None
+        :return:         Словарь со списком пар (ID пользователя, сходство),
+                         источником выдачи и временем вычисления списка
+                         или None, если у пользователя нет приоритетов
+        """
+        if mode is None:
+            precomputed = await sync_to_async(
+                CompatibleUsersView.get_precomputed_matches
+            )(user_id, mutual)
+            if precomputed is not None:
+                computed_at, matches = precomputed
+                return {
+                    "matches": matches,
+                    "source": "precomputed",
+                    "computed_at": computed_at,
+                }
+            mode = get_setting('SEARCH_MODE')
+
+        if mode in DATABASE_MODES:
+            search = find_mutual_users if mutual else find_compatible_users
+            store_generation = VectorStore.generation() if uses_vector_store(mode) else None
+            matches = await sync_to_async(search)(user_id, mode)
+            if matches is None:
+                return None
+            result = {"matches": matches, "source": "live", "computed_at": None}
+            if uses_vector_store(mode):
+                result["store_generation"] = store_generation
+            return result
+
+        engine = get_engine()
+        snapshot = await sync_to_async(engine.snapshot)()
+        if deadline is not None:
+            if not snapshot.has_priorities(user_id):
+                return None
+            result = self.budgeted_result(await run_scoring(
+                budgeted_search, snapshot, user_id, deadline
+            ))
+        else:
+            search = find_mutual_users if mutual else find_compatible_users
+            with engine.pinned(snapshot):
+                matches = await run_scoring(search, user_id, mode)
+            if matches is None:
+                return None
+            result = {"matches": matches, "source": "live", "computed_at": None}
+        result["data_version"] = snapshot.data_version
+        return result
+
+
+class AsyncPriorityMixin:
+    """
+    Общая логика асинхронных представлений приоритетов:
+    приоритеты аутентифицированного пользователя.
+    """
+    authentication_required = True
+
+    def get_queryset(self):
+        """
+        Возвращает queryset приоритетов для аутентифицированного пользователя.
+        """
+        return UserPriority.objects.filter(
+            user=self.request.user
+        ).select_related('aspect')
+
+    async def get_object(self, pk):
+        """
+        Возвращает приоритет пользователя или вызывает NotFound.
+        """
+        try:
+            return await self.get_queryset().aget(pk=pk)
+        except UserPriority.DoesNotExist:
+            raise exceptions.NotFound()
+
+    @staticmethod
+    def save(serializer, user=None):
+        """
+        Проверяет данные и сохраняет приоритет, создавая новый
+        приоритет пользователя. Валидация создает аспекты,
+        поэтому выполняется в потоке sync_to_async.
+
+        :return: Данные сохраненного приоритета или None,
+                 если данные некорректны
+        """
+        if not serializer.is_valid():
+            return None
+        if user is not None:
+            serializer.save(user=user)
+        else:
+            serializer.save()
+        return serializer.data
+
+
+class AsyncPriorityListView(AsyncPriorityMixin, AsyncAPIView):
+    """
+    Асинхронный вариант действий list() и create() PriorityViewSet.
+    """
+
+    async def get(self, request):
+        """
+        Возвращает приоритеты аутентифицированного пользователя.
+        """
+        priorities = [priority async for priority in self.get_queryset()]
+        return json_response(PrioritySerializer(priorities, many=True).data)
+
+    async def post(self, request):
+        """
+        Создает приоритет аутентифицированного пользователя.
+        """
+        serializer = PrioritySerializer(data=request.data)
+        data = await sync_to_async(self.save)(serializer, request.user)
+        if data is None:
+            return json_response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        return json_response(data, status.HTTP_201_CREATED)
+
+
+class AsyncPriorityDetailView(AsyncPriorityMixin, AsyncAPIView):
+    """
+    Асинхронный вариант действий retrieve(), update(),
+    partial_update() и destroy() PriorityViewSet.
+    """
+
+    async def get(self, request, pk):
+        """
+        Возвращает приоритет аутентифицированного пользователя.
+        """
+        return json_response(PrioritySerializer(await self.get_object(pk)).data)
+
+    async def put(self, request, pk):
+        """
+        Обновляет приоритет целиком.
+        """
+        return await self.update(request, pk, partial=False)
+
+    async def patch(self, request, pk):
+        """
+        Частично обновляет приоритет.
+        """
+        return await self.update(request, pk, partial=True)
+
+    async def delete(self, request, pk):
+        """
+        Удаляет приоритет.
+        """
+        priority = await self.get_object(pk)
+        await UserPriority.objects.filter(pk=priority.pk).adelete()
+        return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+
+    async def update(self, request, pk, partial):
+        serializer = PrioritySerializer(
+            await self.get_object(pk), data=request.data, partial=partial
+        )
+        data = await sync_to_async(self.save)(serializer)
+        if data is None:
+            return json_response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+        return json_response(data)
@@ -0,0 +1,150 @@
+from django.db import transaction
+from django.db.models import Count, Max, Min
+
+from .matching.data import QUERY_CHUNK_SIZE
+
+
+def chunked(values, size=QUERY_CHUNK_SIZE):
+    """
+    Делит список на части не длиннее size.
+    """
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def find_duplicate_aspects(aspects):
+    """
+    Находит аспекты с одинаковым названием.
+
+    :param aspects: Queryset аспектов (в миграциях - исторической
+                    модели Aspect)
+    :return:        Словарь ID сохраняемого аспекта (наименьший
+                    ID с названием) -> список ID его повторов
+    """
+    names = aspects.order_by().values('aspect').annotate(
+        total=Count('id', distinct=True), keep=Min('id')
+    ).filter(total__gt=1).values_list('aspect', 'keep')
+
+    duplicates = {}
+    for name, keep in names:
+        duplicates[keep] = list(
+            aspects.filter(aspect=name).exclude(
+                id=keep
+            ).values_list('id', flat=True)
+        )
+    return duplicates
+
+
+def plan_merge(priority_model, keep, duplicate_ids):
+    """
+    Определяет, какие приоритеты останутся после слияния повторов
+    аспекта с сохраняемым аспектом.
+
+    Если у пользователя есть приоритеты на несколько повторов,
+    остается последний добавленный, как и при повторном создании
+    приоритета на тот же аспект.
+
+    :param priority_model: Модель UserPriority
+    :param keep:           ID сохраняемого аспекта
+    :param duplicate_ids:  ID повторов аспекта
+    :return:               Кортеж (ID удаляемых приоритетов, количество
+                           переводимых приоритетов, ID пользователей
+                           с приоритетами на повторы)
+    """
+    aspect_ids = [keep] + duplicate_ids
+    rows = priority_model.objects.filter(
+        aspect_id__in=aspect_ids
+    ).values('user_id').annotate(total=Count('id'), last=Max('id'))
+    conflicts = {row['user_id']: row['last'] for row in rows if row['total'] > 1}
+
+    removed, removed_duplicates = [], 0
+    for users in chunked(list(conflicts)):
+        for priority_id, user_id, aspect_id in priority_model.objects.filter(
+            aspect_id__in=aspect_ids,
+            user_id__in=users
+        ).values_list('id', 'user_id', 'aspect_id'):
+            if priority_id != conflicts[user_id]:
+                removed.append(priority_id)
+                removed_duplicates += aspect_id != keep
+
+    user_ids = set(priority_model.objects.filter(
+        aspect_id__in=duplicate_ids
+    ).values_list('user_id', flat=True))
+    repointed = priority_model.objects.filter(
+        aspect_id__in=duplicate_ids
+    ).count() - removed_duplicates
+    return removed, repointed, user_ids
+
+
+def merge_duplicate_aspects(aspect_model, priority_model, duplicates,
+                            batch_size=100, dry_run=False, on_merged=None):
+    """
+    Сливает повторы аспектов: приоритеты повторов массово
+    переводятся на сохраняемый аспект, а повторы удаляются.
+    Каждые batch_size аспектов обрабатываются в отдельной
+    транзакции, поэтому блокировки БД не держатся на все время
+    слияния.
+
+    :param aspect_model:   Модель Aspect
+    :param priority_model: Модель UserPriority
+    :param duplicates:     Результат find_duplicate_aspects
+    :param batch_size:     Количество сохраняемых аспектов в транзакции
+    :param dry_run:        Только подсчитать изменения
+    :param on_merged:      Функция, вызываемая внутри транзакции
+                           с ID пользователей, чьи приоритеты изменились
+    :return:               Словарь со счетчиками удаленных аспектов,
+                           переведенных и удаленных приоритетов
+                           и затронутых пользователей
+    """
+    report = {'aspects': 0, 'repointed': 0, 'removed': 0, 'users': 0}
+    groups = list(duplicates.items())
+
+    for batch in chunked(groups, batch_size):
+        with transaction.atomic():
+            user_ids = set()
+            for keep, duplicate_ids in batch:
+                removed, repointed, affected = plan_merge(
+                    priority_model, keep, duplicate_ids
+                )
+                user_ids |= affected
+                report['aspects'] += len(duplicate_ids)
+                report['removed'] += len(removed)
+                report['repointed'] += repointed
+                if dry_run:
+                    continue
+
+                for ids in chunked(removed):
+                    priority_model.objects.filter(id__in=ids).delete()
+                priority_model.objects.filter(
+                    aspect_id__in=duplicate_ids
+                ).update(aspect_id=keep)
+                aspect_model.objects.filter(id__in=duplicate_ids).delete()
+
+            report['users'] += len(user_ids)
+            if user_ids and not dry_run and on_merged is not None:
+                on_merged(user_ids)
+
+    return report
+
+
+def delete_orphan_aspects(aspect_model, batch_size=1000, dry_run=False):
+    """
+    Удаляет аспекты, на которые нет приоритетов.
+    Аспекты удаляются частями по batch_size, каждая - в отдельной
+    транзакции; отсутствие приоритетов проверяется повторно
+    в запросе удаления.
+
+    :param aspect_model: Модель Aspect
+    :param batch_size:   Количество аспектов в транзакции
+    :param dry_run:      Только подсчитать аспекты
+    :return:             Количество удаленных аспектов
+    """
+    orphans = aspect_model.objects.filter(userpriority__isnull=True)
+    if dry_run:
+        return orphans.count()
+
+    ids = list(orphans.values_list('id', flat=True))
+    deleted = 0
+    for batch in chunked(ids, min(batch_size, QUERY_CHUNK_SIZE)):
+        with transaction.atomic():
+            deleted += orphans.filter(id__in=batch).delete()[0]
+    return deleted
@@ -0,0 +1,261 @@
+import sqlite3
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Соединения, в которые направляются чтения текущего кода:
+# чтения реплики (READ_DATABASE) или соединение по умолчанию
+REPLICA, PRIMARY = 'replica', 'primary'
+
+# Цель чтений области replica_reads() или primary_reads()
+# (None - вне областей, чтения идут в соединение по умолчанию)
+_read_target = ContextVar('read_target', default=None)
+
+# Отметка чтений из реплики внутри блока track_replica_reads()
+# (None - вне блоков)
+_replica_reads = ContextVar('replica_reads', default=None)
+
+# Префикс ключей кэша с отметками о недавних изменениях приоритетов
+WRITTEN_KEY_PREFIX = 'soulmate:priorities-written'
+
+# Ключ кэша с версией данных, до которой копия основной БД
+# получила изменения (команда sync_replica)
+REPLICA_VERSION_KEY = 'soulmate:replica-version'
+
+
+def get_setting(name):
+    # Пакет matching сам импортирует этот модуль (чтения весов),
+    # поэтому настройки подбора импортируются при вызове
+    from .matching.conf import get_setting
+    return get_setting(name)
+
+
+def apply_pragmas(cursor, pragmas):
+    """
+    Выполняет прагмы SQLite в соединении.
+
+    :param cursor:  Курсор DB-API соединения SQLite
+    :param pragmas: Словарь имя прагмы -> значение
+    """
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Применяет прагмы SQLITE_PRAGMAS к каждому новому соединению
+    SQLite (сигнал connection_created). Режим журнала WAL хранится
+    в файле БД, поэтому соединения только для чтения получают его
+    от пишущего соединения, а прагма лишь возвращает текущий режим.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', None)
+    if pragmas:
+        with connection.cursor() as cursor:
+            apply_pragmas(cursor, pragmas)
+
+
+def copy_sqlite_database(source, target):
+    """
+    Копирует БД SQLite в другой файл через API резервного
+    копирования: копия согласована, а запись в исходную БД
+    ждет только копирования очередной части страниц.
+
+    :param source: Путь к исходной БД
+    :param target: Путь к копии (существующий файл заменяется)
+    """
+    source = sqlite3.connect(source)
+    target = sqlite3.connect(target)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def written_key(user_id):
+    return f'{WRITTEN_KEY_PREFIX}:{user_id}'
+
+
+def note_writes(user_ids):
+    """
+    Отмечает в кэше, что пользователи только что изменили
+    приоритеты: в течение READ_YOUR_WRITES_SECONDS секунд
+    их чтения идут в соединение по умолчанию, а не в реплику,
+    которая может еще не получить изменения.
+
+    :param user_ids: ID пользователей
+    """
+    timeout = get_setting('READ_YOUR_WRITES_SECONDS')
+    if timeout:
+        cache.set_many(
+            {written_key(user_id): True for user_id in user_ids},
+            timeout
+        )
+
+
+def wrote_recently(user_ids):
+    """
+    Проверяет, изменял ли кто-то из пользователей приоритеты
+    за последние READ_YOUR_WRITES_SECONDS секунд.
+
+    :param user_ids: ID пользователей (None пропускаются)
+    """
+    keys = [written_key(user_id) for user_id in user_ids if user_id is not None]
+    if not keys or not get_setting('READ_YOUR_WRITES_SECONDS'):
+        return False
+    return bool(cache.get_many(keys))
+
+
+@contextmanager
+def replica_reads(*user_ids):
+    """
+    Направляет чтения внутри блока в реплику (настройка
+    READ_DATABASE), если она настроена. Если кто-то из
+    пользователей user_ids недавно изменял приоритеты или
+    внешний блок закреплен за соединением по умолчанию
+    (primary_reads), чтения остаются в соединении по умолчанию.
+    Применяется и как декоратор функций чтения.
+
+    :param user_ids: ID пользователей, чьи чтения должны видеть
+                     их собственные записи
+    """
+    if _read_target.get() == PRIMARY or wrote_recently(user_ids):
+        token = _read_target.set(PRIMARY)
+    else:
+        token = _read_target.set(REPLICA)
+    try:
+        yield
+    finally:
+        _read_target.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Направляет чтения внутри блока, в том числе вложенных
+    блоков replica_reads(), в соединение по умолчанию.
+    """
+    token = _read_target.set(PRIMARY)
+    try:
+        yield
+    finally:
+        _read_target.reset(token)
+
+
+def read_your_writes(*user_ids):
+    """
+    Закрепляет оставшиеся чтения текущего блока replica_reads()
+    за соединением по умолчанию, если кто-то из пользователей
+    недавно изменял приоритеты. Применяется, когда пользователи
+    становятся известны уже внутри блока (например, после
+    аутентификации запроса).
+
+    :param user_ids: ID пользователей
+    """
+    if _read_target.get() == REPLICA and wrote_recently(user_ids):
+        _read_target.set(PRIMARY)
+
+
+class ReplicaReads:
+    """
+    Отметка чтений из реплики: общий объект для копий контекста,
+    в том числе в потоках sync_to_async.
+    """
+
+    def __init__(self):
+        self.used = False
+
+
+@contextmanager
+def track_replica_reads():
+    """
+    Отмечает, читал ли код внутри блока из реплики.
+
+    :return: Объект ReplicaReads, поле used которого становится
+             True при первом чтении из реплики
+    """
+    reads = ReplicaReads()
+    token = _replica_reads.set(reads)
+    try:
+        yield reads
+    finally:
+        _replica_reads.reset(token)
+
+
+def note_replica_synced(version):
+    """
+    Запоминает, что копия основной БД получила все изменения
+    до версии данных version (версия читается до копирования).
+    """
+    cache.set(REPLICA_VERSION_KEY, version, timeout=None)
+
+
+def replica_has_version(version):
+    """
+    Проверяет, получила ли реплика все изменения до версии данных
+    version. Соединение только для чтения к файлу основной БД
+    (file:) не отстает; копия, обновляемая sync_replica, содержит
+    изменения до версии, записанной при последнем копировании;
+    об остальных репликах (например, потоковой репликации
+    PostgreSQL) это неизвестно.
+    """
+    alias = get_setting('READ_DATABASE')
+    if str(connections[alias].settings_dict['NAME']).startswith('file:'):
+        return True
+    synced = cache.get(REPLICA_VERSION_KEY)
+    return synced is not None and synced >= version
+
+
+def read_database():
+    """
+    Возвращает псевдоним соединения для чтений: реплику
+    READ_DATABASE внутри replica_reads(), если она есть
+    в DATABASES и соединение по умолчанию не находится
+    в транзакции (иначе чтение не увидело бы
+    незафиксированных изменений этой транзакции).
+    """
+    alias = get_setting('READ_DATABASE')
+    if _read_target.get() != REPLICA or alias not in settings.DATABASES:
+        return None
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return None
+    return alias
+
+
+class ReplicaRouter:
+    """
+    Маршрутизатор БД: чтения, помеченные replica_reads()
+    (поиск совместимых пользователей, предвычисленные списки,
+    рассылка, списки админки), выполняются через реплику
+    READ_DATABASE - соединение только для чтения к той же БД
+    SQLite (производственный профиль) или отдельную БД,
+    копию основной. Записи и остальные чтения идут
+    в соединение по умолчанию.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = read_database()
+        reads = _replica_reads.get()
+        if alias is not None and reads is not None:
+            reads.used = True
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # Объекты, прочитанные из реплики, сохраняются в основную БД
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, get_setting('READ_DATABASE')}
+        if {obj1._state.db, obj2._state.db} <= aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == get_setting('READ_DATABASE'):
+            return False
+        return None
@@ -0,0 +1,206 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ...database import apply_pragmas, copy_sqlite_database
+from ...matching import get_setting
+from ...matching.sql import similarity_params, similarity_sql
+from ...models import CustomUser, UserPriority
+
+# Таймаут ожидания блокировки соединений по умолчанию в Django
+DEFAULT_TIMEOUT = 5
+
+
+def is_locked(error):
+    """
+    Проверяет, что ошибка SQLite вызвана блокировкой БД.
+    """
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure compatible-users SQL read throughput under concurrent '
+        'priority writes with the default SQLite settings and with the '
+        'production profile (WAL, pragmas, read-only reader connections)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--readers',
+            type=int,
+            default=4,
+            help='Number of concurrent reader threads'
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            default=5,
+            help='Duration of each run'
+        )
+        parser.add_argument(
+            '--write-interval',
+            type=float,
+            default=0.01,
+            help='Pause between priority writes in seconds'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for user and priority sampling'
+        )
+
+    def copy_database(self, directory, name):
+        """
+        Копирует БД по умолчанию в файл во временном каталоге.
+        """
+        path = os.path.join(directory, name)
+        copy_sqlite_database(connections['default'].settings_dict['NAME'], path)
+        return path
+
+    def connect(self, path, pragmas, read_only=False):
+        """
+        Открывает соединение, как это делает Django,
+        и применяет прагмы профиля.
+        """
+        database = f'file:{path}?mode=ro' if read_only else f'file:{path}'
+        conn = sqlite3.connect(
+            database, timeout=DEFAULT_TIMEOUT, uri=True,
+            check_same_thread=False, isolation_level=None
+        )
+        apply_pragmas(conn.cursor(), pragmas)
+        return conn
+
+    def run(self, path, pragmas, read_only, users, priorities, options):
+        """
+        Выполняет поиски на стороне БД в потоках читателей,
+        пока поток писателя изменяет веса приоритетов.
+
+        :return: Словарь с количеством чтений и записей,
+                 ошибок блокировки и задержками чтений в мс
+        """
+        stop = threading.Event()
+        lock = threading.Lock()
+        latencies, errors, writes = [], [0], [0]
+        # Запрос подбора с параметрами в стиле модуля sqlite3
+        query = similarity_sql().replace('%s', '?')
+        threshold = get_setting('COMPATIBILITY_THRESHOLD')
+
+        def read(seed):
+            conn = self.connect(path, pragmas, read_only)
+            rng = np.random.default_rng(seed)
+            measured = []
+            while not stop.is_set():
+                user_id, norm = users[rng.integers(len(users))]
+                start = time.perf_counter()
+                try:
+                    conn.execute(
+                        query, similarity_params(user_id, norm, threshold)
+                    ).fetchmany(get_setting('COMPATIBLE_USERS_LIMIT'))
+                except sqlite3.OperationalError as error:
+                    if not is_locked(error):
+                        raise
+                    with lock:
+                        errors[0] += 1
+                    continue
+                measured.append((time.perf_counter() - start) * 1000)
+            conn.close()
+            with lock:
+                latencies.extend(measured)
+
+        def write():
+            conn = self.connect(path, pragmas)
+            rng = np.random.default_rng(options['seed'])
+            while not stop.is_set():
+                priority_id = priorities[rng.integers(len(priorities))]
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.execute(
+                        f'UPDATE {UserPriority._meta.db_table} '
+                        f'SET signed_weight = -signed_weight WHERE id = ?',
+                        [priority_id]
+                    )
+                    conn.execute('COMMIT')
+                    writes[0] += 1
+                except sqlite3.OperationalError as error:
+                    if not is_locked(error):
+                        raise
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                    with lock:
+                        errors[0] += 1
+                time.sleep(options['write_interval'])
+            conn.close()
+
+        threads = [threading.Thread(target=write)] + [
+            threading.Thread(target=read, args=(options['seed'] + i,))
+            for i in range(options['readers'])
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(options['seconds'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        return {
+            'reads': len(latencies),
+            'writes': writes[0],
+            'errors': errors[0],
+            'latencies': np.array(latencies or [0.0]),
+        }
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('The default database is not SQLite')
+        if options['readers'] < 1 or options['seconds'] <= 0:
+            raise CommandError('--readers and --seconds must be positive')
+
+        users = list(CustomUser.objects.filter(
+            priority_norm__gt=0
+        ).values_list('id', 'priority_norm'))
+        priorities = list(UserPriority.objects.values_list('id', flat=True))
+        if not users:
+            raise CommandError('No users with priorities')
+
+        profiles = [
+            ('default', {'journal_mode': 'delete'}, False),
+            ('production', settings.SQLITE_PRODUCTION_PRAGMAS, True),
+        ]
+
+        self.stdout.write(
+            f"{'profile':<12}{'reads/s':>10}{'p50, ms':>10}"
+            f"{'p99, ms':>10}{'writes/s':>10}{'locked':>8}"
+        )
+        throughput = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, pragmas, read_only in profiles:
+                path = self.copy_database(directory, f'{name}.sqlite3')
+                # Режим журнала устанавливается в файле БД до запуска
+                # читателей, открывающих его только для чтения
+                self.connect(path, pragmas).close()
+
+                result = self.run(
+                    path, pragmas, read_only, users, priorities, options
+                )
+                throughput[name] = result['reads'] / options['seconds']
+                self.stdout.write(
+                    f"{name:<12}{throughput[name]:>10.1f}"
+                    f"{np.percentile(result['latencies'], 50):>10.2f}"
+                    f"{np.percentile(result['latencies'], 99):>10.2f}"
+                    f"{result['writes'] / options['seconds']:>10.1f}"
+                    f"{result['errors']:>8}"
+                )
+
+        if throughput['default']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Read throughput x{throughput['production'] / throughput['default']:.2f}"
+            ))
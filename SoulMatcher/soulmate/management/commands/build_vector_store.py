@@ -0,0 +1,28 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...matching import MatchingSnapshot, VectorStore, get_setting
+from ...matching.data import load_signed_weights
+
+
+class Command(BaseCommand):
+    help = 'Build or refresh the memory-mapped int8 vector store used by mmap search'
+
+    def handle(self, *args, **options):
+        snapshot = MatchingSnapshot.from_weights(*load_signed_weights())
+        path = get_setting('VECTOR_STORE_PATH')
+
+        try:
+            VectorStore.write(snapshot, path)
+        except ValueError as error:
+            raise CommandError(str(error))
+        # Версия данных не сдвигается: выдачи способов поиска,
+        # читающих хранилище, кэшируются под поколением его файла
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {len(snapshot.user_ids)} users and '
+            f'{snapshot.matrix.nnz} weights in {path} '
+            f'({os.path.getsize(path) / 2 ** 20:.1f} MiB, '
+            f'float64 matrix: {snapshot.size / 2 ** 20:.1f} MiB)'
+        ))
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...compaction import \
+    delete_orphan_aspects, \
+    find_duplicate_aspects, \
+    merge_duplicate_aspects
+from ...models import Aspect, UserPriority
+from ...signals import priorities_changed
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete aspects without priorities and merge aspects with the same '
+        'name, repointing their priorities to one row'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report the rows that would be reclaimed'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of aspects processed per transaction'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        dry_run = options['dry_run']
+
+        # Сначала удаляются аспекты без приоритетов, поэтому
+        # сливаются только повторы, на которые есть приоритеты
+        orphans = delete_orphan_aspects(
+            Aspect, options['batch_size'], dry_run
+        )
+        duplicates = find_duplicate_aspects(
+            Aspect.objects.filter(
+                id__in=UserPriority.objects.values('aspect_id')
+            )
+        )
+        report = merge_duplicate_aspects(
+            Aspect,
+            UserPriority,
+            duplicates,
+            options['batch_size'],
+            dry_run,
+            on_merged=priorities_changed
+        )
+
+        prefix = 'Would reclaim' if dry_run else 'Reclaimed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix} {orphans} orphaned aspects, '
+            f'{report["aspects"]} duplicate aspects and '
+            f'{report["removed"]} conflicting priorities; '
+            f'{report["repointed"]} priorities of {report["users"]} users '
+            f'repointed'
+        ))
@@ -0,0 +1,74 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...matching import bump_data_version, get_engine, get_setting
+from ...matching.neighbors import \
+    compute_neighbor_lists, \
+    rebuild_mutual_matches, \
+    refresh_changed_neighbor_lists, \
+    remove_stale_neighbor_lists, \
+    store_neighbor_lists
+
+
+class Command(BaseCommand):
+    help = 'Precompute the compatible users list of every user and mutual matches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=get_setting('COMPATIBLE_USERS_LIMIT'),
+            help='Number of compatible users to store per user'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of worker processes'
+        )
+        parser.add_argument(
+            '--block-size',
+            type=int,
+            default=1000,
+            help='Number of users scored and stored at once'
+        )
+
+    def handle(self, *args, **options):
+        if options['top'] < 1 or options['block_size'] < 1:
+            raise CommandError('--top and --block-size must be positive')
+
+        start = time.perf_counter()
+        computed_at = timezone.now()
+        snapshot = get_engine().snapshot()
+
+        users = neighbors = 0
+        for results in compute_neighbor_lists(
+            snapshot,
+            get_setting('COMPATIBILITY_THRESHOLD'),
+            options['top'],
+            options['workers'],
+            options['block_size']
+        ):
+            # Списки, исправленные на месте после изменения
+            # приоритетов во время вычисления, новее блока
+            store_neighbor_lists(
+                results, options['top'], computed_at, keep_newer=True
+            )
+            users += len(results)
+            neighbors += sum(len(matches) for matches in results.values())
+
+        remove_stale_neighbor_lists(computed_at)
+        changed = refresh_changed_neighbor_lists(snapshot)
+        mutual = rebuild_mutual_matches()
+        # Приоритеты не менялись: снимки движка не перестраиваются
+        bump_data_version(())
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {neighbors} compatible users for {users} users '
+            f'and {mutual} mutual pairs '
+            f'({changed} users changed during the run were re-patched) '
+            f'in {time.perf_counter() - start:.1f} s'
+        ))
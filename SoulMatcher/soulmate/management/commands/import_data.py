@@ -6,7 +6,8 @@ import uuid
 import transliterate
 from django.db import transaction
 from django.core.management.base import BaseCommand
-from ...models import CustomUser, Aspect, Attitude, Weight, Priority
+from ...models import CustomUser, Aspect, UserPriority
+from ...signals import priorities_changed
 
 
 class Command(BaseCommand):
@@ -29,14 +30,6 @@ class Command(BaseCommand):
             aspect.aspect: aspect
             for aspect in Aspect.objects.all()
         }
-        attitudes_cache = {
-            attitude.attitude: attitude
-            for attitude in Attitude.objects.all()
-        }
-        weights_cache = {
-            weight.weight: weight
-            for weight in Weight.objects.all()
-        }
 
         with open(file_name, 'r', encoding='utf-8') as file:
             for index, line in enumerate(
@@ -86,21 +79,11 @@ class Command(BaseCommand):
                         )
                         aspects_cache[aspect_name] = aspect
 
-                    attitude = attitudes_cache.get(attitude_name)
-                    if attitude is None:
-                        attitude = Attitude.objects.create(
-                            attitude=attitude_name
-                        )
-                        attitudes_cache[attitude_name] = attitude
-
-                    weight = weights_cache.get(weight_value)
-                    if weight is None:
-                        weight = Weight.objects.create(
-                            weight=weight_value
-                        )
-                        weights_cache[weight_value] = weight
-
-                    priority_relations.append((user, aspect, attitude, weight))
+                    priority_relations.append((
+                        user,
+                        aspect,
+                        UserPriority.to_signed_weight(attitude_name, weight_value)
+                    ))
 
         with transaction.atomic():
             tqdm.write("Writing users to DB...")
@@ -115,23 +98,24 @@ class Command(BaseCommand):
             }
 
             tqdm.write("Writing priorities to DB...")
-            progress_bar = tqdm(
-                total=len(priority_relations),
-                desc="Writing priorities to DB",
-                leave=False
+            UserPriority.objects.bulk_create(
+                [
+                    UserPriority(
+                        user=created_users_dict[temp_user.username],
+                        aspect=aspect,
+                        signed_weight=signed_weight
+                    )
+                    for temp_user, aspect, signed_weight in tqdm(
+                        priority_relations,
+                        desc="Writing priorities to DB",
+                        leave=False
+                    )
+                ],
+                batch_size=1000
+            )
+            # bulk_create не отправляет сигналы моделей
+            priorities_changed(
+                user.id for user in created_users_dict.values()
             )
-
-            for temp_user, aspect, attitude, weight in priority_relations:
-                user = created_users_dict[temp_user.username]
-
-                priority, created = Priority.objects.get_or_create(
-                    aspect=aspect,
-                    attitude=attitude,
-                    weight=weight
-                )
-                priority.users.add(user)
-                progress_bar.update(1)
-
-            progress_bar.close()
 
         self.stdout.write(self.style.SUCCESS('Successfully imported data'))
@@ -0,0 +1,85 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ...matching import SEARCH_MODES, find_compatible_users, get_engine
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare search modes against exact search: '
+        'recall of the compatible users list and query latency'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--modes',
+            nargs='+',
+            default=['lsh'],
+            help='Search modes to evaluate'
+        )
+        parser.add_argument(
+            '--sample',
+            type=int,
+            default=200,
+            help='Number of random users to query'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for user sampling'
+        )
+
+    def measure(self, mode, user_ids):
+        """
+        Выполняет поиск для каждого пользователя выборки.
+
+        :return: Кортеж из списка результатов и массива задержек в мс
+        """
+        # Первый запрос строит индекс режима и в замеры не входит
+        find_compatible_users(user_ids[0], mode)
+
+        results, latencies = [], []
+        for user_id in user_ids:
+            start = time.perf_counter()
+            matches = find_compatible_users(user_id, mode) or []
+            latencies.append((time.perf_counter() - start) * 1000)
+            results.append({match_id for match_id, _ in matches})
+        return results, np.array(latencies)
+
+    def handle(self, *args, **options):
+        unknown = set(options['modes']) - set(SEARCH_MODES)
+        if unknown:
+            raise CommandError(f"Unknown search modes: {', '.join(unknown)}")
+
+        snapshot = get_engine().snapshot()
+        user_ids = snapshot.user_ids[snapshot.norms > 0]
+        if not len(user_ids):
+            raise CommandError('No users with priorities')
+
+        rng = np.random.default_rng(options['seed'])
+        sample = rng.choice(
+            user_ids, size=min(options['sample'], len(user_ids)), replace=False
+        ).tolist()
+
+        reference, _ = self.measure('exact', sample)
+
+        self.stdout.write(
+            f"{'mode':<10}{'recall':>8}{'p50, ms':>10}"
+            f"{'p99, ms':>10}{'results':>9}"
+        )
+        for mode in ['exact', *options['modes']]:
+            results, latencies = self.measure(mode, sample)
+
+            found = sum(len(r & e) for r, e in zip(results, reference))
+            expected = sum(len(e) for e in reference)
+            recall = found / expected if expected else 1.0
+
+            self.stdout.write(
+                f"{mode:<10}{recall:>8.3f}"
+                f"{np.percentile(latencies, 50):>10.2f}"
+                f"{np.percentile(latencies, 99):>10.2f}"
+                f"{np.mean([len(r) for r in results]):>9.1f}"
+            )
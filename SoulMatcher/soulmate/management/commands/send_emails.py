@@ -4,22 +4,23 @@ from django.contrib.auth import get_user_model
 from django.core.mail import send_mail
 from django.db.models import Count
 
-from ...models import Priority
+from ...database import replica_reads
+from ...models import UserPriority
 
 
 class Command(BaseCommand):
     help = 'Отправка электронной почты пользователям с лучшими предпочтениями'
 
     def get_top_three_priorities(self, user):
-        user_priorities_ids = Priority.objects.filter(
-            users__in=[user]
+        user_priorities_ids = UserPriority.objects.filter(
+            user=user
         ).values_list(
-            'aspect__id',
+            'aspect_id',
             flat=True
         )
 
-        aspects_with_count = Priority.objects.exclude(
-            aspect__id__in=user_priorities_ids
+        aspects_with_count = UserPriority.objects.exclude(
+            aspect_id__in=user_priorities_ids
         ).values(
             'aspect__aspect'
         ).annotate(
@@ -27,7 +28,9 @@ class Command(BaseCommand):
         ).order_by('-total')[:3]
         return aspects_with_count
 
+    @replica_reads()
     def handle(self, *args, **kwargs):
+        # Рассылка только читает приоритеты, поэтому чтения идут в реплику
         users = get_user_model().objects.all()
         for user in users:
             top_priorities = self.get_top_three_priorities(user)
@@ -0,0 +1,54 @@
+import os
+import sqlite3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ...database import apply_pragmas, copy_sqlite_database, note_replica_synced
+from ...matching import get_data_version, get_setting
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the default SQLite database into the SQLite replica file '
+        'used for read-mostly traffic (READ_DATABASE)'
+    )
+
+    def handle(self, *args, **options):
+        alias = get_setting('READ_DATABASE')
+        if alias not in connections.settings:
+            raise CommandError(f'Database alias "{alias}" is not configured')
+
+        source = connections[DEFAULT_DB_ALIAS].settings_dict
+        replica = connections[alias].settings_dict
+        if source['ENGINE'] != replica['ENGINE'] or connections[alias].vendor != 'sqlite':
+            raise CommandError('Only a SQLite replica of a SQLite database can be synced')
+        target = str(replica['NAME'])
+        if target.startswith('file:'):
+            raise CommandError(
+                f'Database alias "{alias}" opens the default database file'
+            )
+
+        # Копия пишется рядом и подменяет реплику переименованием,
+        # поэтому читатели не видят частично скопированный файл
+        temporary = f'{target}.sync'
+        # Версия читается до копирования: изменения версий не новее
+        # нее зафиксированы до ее сдвига и попадут в копию
+        version = get_data_version()
+        copy_sqlite_database(str(source['NAME']), temporary)
+        # Реплика только читается: режим WAL, скопированный
+        # из основной БД, ей не нужен
+        conn = sqlite3.connect(temporary)
+        try:
+            apply_pragmas(conn.cursor(), {'journal_mode': 'delete'})
+        finally:
+            conn.close()
+        os.replace(temporary, target)
+        # Выдача, прочитанная из реплики, кэшируется под версиями
+        # данных не новее этой
+        note_replica_synced(version)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Copied {source["NAME"]} to {target} '
+            f'({os.path.getsize(target) / 2 ** 20:.1f} MiB)'
+        ))
@@ -0,0 +1,54 @@
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ...matching import IVFModel, get_engine, get_setting
+from ...matching.ivf import assign_clusters
+
+
+class Command(BaseCommand):
+    help = 'Train k-means clusters of user priority vectors for IVF search'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clusters',
+            type=int,
+            default=get_setting('IVF_CLUSTERS'),
+            help='Number of clusters'
+        )
+        parser.add_argument(
+            '--sample',
+            type=int,
+            default=None,
+            help='Train on a random sample of this many users'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed'
+        )
+
+    def handle(self, *args, **options):
+        snapshot = get_engine().snapshot()
+        if not (snapshot.norms > 0).any():
+            raise CommandError('No users with priorities')
+
+        model = IVFModel.train(
+            snapshot,
+            options['clusters'],
+            sample=options['sample'],
+            seed=options['seed']
+        )
+        path = get_setting('IVF_INDEX_PATH')
+        model.save(path)
+
+        labels = assign_clusters(
+            snapshot.matrix[snapshot.norms > 0], model.centroids
+        )
+        sizes = np.bincount(labels, minlength=model.n_clusters)
+        self.stdout.write(self.style.SUCCESS(
+            f'Trained {model.n_clusters} clusters for '
+            f'{len(labels)} users '
+            f'(cluster size: mean {sizes.mean():.1f}, max {sizes.max()}) '
+            f'and saved them to {path}'
+        ))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from ...matching.sql import update_priority_norms
+from ...models import CustomUser
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the priority vector norms used by SQL-side scoring '
+        '(needed after loading priorities in bypass of the ORM)'
+    )
+
+    def handle(self, *args, **options):
+        user_ids = list(CustomUser.objects.values_list('id', flat=True))
+        update_priority_norms(user_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated priority norms of {len(user_ids)} users'
+        ))
@@ -0,0 +1,62 @@
+from .batch import batch_search
+from .budget import budgeted_search, deadline_after
+from .cache import ResultCache, bump_data_version, get_data_version, result_cache
+from .conf import get_setting, to_percentage
+from .engine import MatchingEngine, MatchingSnapshot, get_engine
+from .executor import run_scoring
+from .inverted import InvertedIndex
+from .ivf import IVFIndex, IVFModel
+from .lsh import LSHIndex
+from .names import display_names
+from .neighbors import get_mutual_matches, get_neighbor_list
+from .ranking import rank_matches
+from .search import DATABASE_MODES, ENGINE_MODES, SEARCH_MODES, find_compatible_users, find_compatible_users_batch, \
+    find_mutual_users, uses_engine, warm_up
+from .sharded import ShardPool
+from .singleflight import SingleFlight, single_flight
+from .stream import decode_cursor, encode_cursor, iter_matches, matches_page
+from .tiered import TieredStore, tiered_store
+from .vector_store import VectorStore, uses_vector_store
+
+__all__ = [
+    'batch_search',
+    'budgeted_search',
+    'deadline_after',
+    'ResultCache',
+    'bump_data_version',
+    'get_data_version',
+    'result_cache',
+    'get_setting',
+    'to_percentage',
+    'MatchingEngine',
+    'MatchingSnapshot',
+    'get_engine',
+    'run_scoring',
+    'InvertedIndex',
+    'IVFIndex',
+    'IVFModel',
+    'LSHIndex',
+    'display_names',
+    'get_mutual_matches',
+    'get_neighbor_list',
+    'rank_matches',
+    'DATABASE_MODES',
+    'ENGINE_MODES',
+    'SEARCH_MODES',
+    'find_compatible_users',
+    'find_compatible_users_batch',
+    'find_mutual_users',
+    'uses_engine',
+    'warm_up',
+    'ShardPool',
+    'SingleFlight',
+    'single_flight',
+    'decode_cursor',
+    'encode_cursor',
+    'iter_matches',
+    'matches_page',
+    'TieredStore',
+    'tiered_store',
+    'VectorStore',
+    'uses_vector_store',
+]
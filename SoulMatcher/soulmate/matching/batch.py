@@ -0,0 +1,89 @@
+import numpy as np
+import scipy.sparse as sp
+
+from .conf import get_setting, threshold_similarity
+from .ranking import rank_matches
+
+# Запас на ошибки округления float32 при предварительном отборе,
+# окончательное сходство отобранных кандидатов считается во float64
+FLOAT32_TOLERANCE = 1e-5
+
+
+def normalized_float32(snapshot):
+    """
+    Возвращает нормированную матрицу снимка во float32
+    и ее транспонированную копию в формате CSR.
+    """
+    norms = snapshot.norms.copy()
+    norms[norms == 0] = 1
+    normalized = sp.csr_matrix(
+        sp.diags((1 / norms).astype(np.float32)) @ snapshot.matrix.astype(np.float32)
+    )
+    return normalized, sp.csr_matrix(normalized.T)
+
+
+def batch_search(snapshot, user_ids, threshold=None, limit=None):
+    """
+    Ищет совместимых пользователей сразу для многих пользователей.
+
+    Нормированные векторы запрашиваемых пользователей собираются
+    в одну матрицу, и сходства со всеми пользователями вычисляются
+    блоками строк одним произведением разреженных матриц во float32.
+    Размер блока (BATCH_BLOCK_SIZE) ограничивает пиковую память.
+    Для кандидатов, прошедших предварительный отбор, сходство
+    пересчитывается во float64, поэтому результат совпадает
+    с поиском для одного пользователя.
+
+    :param snapshot:  Снимок приоритетов
+    :param user_ids:  Список ID пользователей
+    :param threshold: Минимальный процент совместимости
+    :param limit:     Максимальное количество результатов на пользователя
+    :return:          Словарь ID пользователя -> список пар
+                      (ID пользователя, сходство) или None,
+                      если у пользователя нет приоритетов
+    """
+    if threshold is None:
+        threshold = get_setting('COMPATIBILITY_THRESHOLD')
+    if limit is None:
+        limit = get_setting('COMPATIBLE_USERS_LIMIT')
+
+    results = {
+        user_id: None
+        for user_id in user_ids if not snapshot.has_priorities(user_id)
+    }
+    queries = [
+        user_id for user_id in dict.fromkeys(user_ids)
+        if user_id not in results
+    ]
+    if not queries:
+        return results
+
+    normalized, transposed = snapshot.derived(normalized_float32)
+    rows = np.array([snapshot.row_of[user_id] for user_id in queries])
+    minimum = threshold_similarity(threshold) - FLOAT32_TOLERANCE
+    block_size = get_setting('BATCH_BLOCK_SIZE')
+
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        similarities = normalized[block_rows] @ transposed
+
+        for offset, row in enumerate(block_rows):
+            begin, end = similarities.indptr[offset:offset + 2]
+            candidates = similarities.indices[begin:end]
+            scores = similarities.data[begin:end]
+
+            keep = (candidates != row) & (scores >= minimum)
+            candidates, scores = candidates[keep], scores[keep]
+            if len(scores) > limit > 0:
+                boundary = np.partition(scores, -limit)[-limit]
+                keep = scores >= boundary - FLOAT32_TOLERANCE
+                candidates = candidates[keep]
+
+            results[int(snapshot.user_ids[row])] = rank_matches(
+                snapshot.user_ids[candidates],
+                snapshot.similarities(snapshot.matrix[row], candidates),
+                threshold,
+                limit
+            )
+
+    return results
@@ -0,0 +1,71 @@
+import time
+
+import numpy as np
+
+from .conf import get_setting
+from .ranking import rank_matches
+
+
+def deadline_after(budget_ms, started=None):
+    """
+    Возвращает момент окончания бюджета времени по часам
+    time.monotonic.
+
+    :param budget_ms: Бюджет в миллисекундах
+    :param started:   Момент начала отсчета (по умолчанию - текущий)
+    """
+    if started is None:
+        started = time.monotonic()
+    return started + budget_ms / 1000
+
+
+def budgeted_search(snapshot, user_id, deadline, threshold=None,
+                    limit=None, chunk_size=None):
+    """
+    Точный поиск по снимку, ограниченный по времени.
+
+    Строки матрицы просматриваются частями по chunk_size
+    (BUDGET_CHUNK_SIZE), и лучшие результаты сливаются после каждой
+    части. Перед каждой следующей частью проверяется, не истек ли
+    бюджет; если истек, возвращаются лучшие из уже просмотренных
+    пользователей. Первая часть просматривается всегда, поэтому
+    время ответа ограничено бюджетом и временем одной части,
+    а не количеством пользователей.
+
+    :param snapshot:   Снимок приоритетов
+    :param user_id:    ID пользователя
+    :param deadline:   Момент окончания бюджета по time.monotonic
+    :param threshold:  Минимальный процент совместимости
+    :param limit:      Максимальное количество результатов
+    :param chunk_size: Количество строк в части
+    :return:           Кортеж (список пар (ID пользователя, сходство)
+                       в порядке убывания сходства, доля просмотренных
+                       пользователей от 0 до 1)
+    """
+    if chunk_size is None:
+        chunk_size = get_setting('BUDGET_CHUNK_SIZE')
+
+    vector = snapshot.vector(user_id)
+    if vector is None:
+        return [], 1.0
+
+    total = len(snapshot.user_ids)
+    matches, scanned = [], 0
+    for start in range(0, total, chunk_size):
+        if start and time.monotonic() >= deadline:
+            break
+        rows = slice(start, min(start + chunk_size, total))
+        user_ids = snapshot.user_ids[rows]
+        similarities = snapshot.similarities(vector, rows)
+        others = user_ids != user_id
+
+        best_ids, best_similarities = zip(*matches) if matches else ((), ())
+        matches = rank_matches(
+            np.concatenate([best_ids, user_ids[others]]).astype(np.int64),
+            np.concatenate([best_similarities, similarities[others]]),
+            threshold,
+            limit
+        )
+        scanned = rows.stop
+
+    return matches, scanned / total
@@ -0,0 +1,213 @@
+import time
+
+from django.core.cache import cache
+
+from .conf import get_setting
+from .vector_store import VectorStore, uses_vector_store
+
+VERSION_KEY = 'soulmate:priorities-version'
+HITS_KEY = 'soulmate:result-cache:hits'
+MISSES_KEY = 'soulmate:result-cache:misses'
+CHANGES_KEY_PREFIX = 'soulmate:priorities-changes'
+
+
+def increment(key):
+    """
+    Увеличивает счетчик в кэше, создавая его при отсутствии.
+    """
+    try:
+        return cache.incr(key)
+    except ValueError:
+        if cache.add(key, 1, timeout=None):
+            return 1
+        return cache.incr(key)
+
+
+def get_data_version():
+    """
+    Возвращает текущую версию данных о приоритетах.
+
+    Начальное значение берется из текущего времени, чтобы после
+    очистки или вытеснения счетчика версии не повторялись
+    и старые записи кэша не оживали.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time.time_ns() // 1000, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def changes_key(version):
+    return f'{CHANGES_KEY_PREFIX}:{version}'
+
+
+def bump_data_version(user_ids=None):
+    """
+    Сдвигает версию данных: все закэшированные выдачи устаревают.
+
+    ID пользователей, изменивших приоритеты, сохраняются в кэше
+    под новой версией (DATA_CHANGES_TIMEOUT секунд): по ним снимки
+    движка в других процессах перечитывают только строки этих
+    пользователей (get_data_changes).
+
+    :param user_ids: ID пользователей, изменивших приоритеты
+                     (пустой набор - приоритеты не менялись),
+                     или None, если изменения неизвестны и снимки
+                     нужно построить заново
+    """
+    try:
+        version = cache.incr(VERSION_KEY)
+    except ValueError:
+        # Счетчика нет: новое значение из текущего времени
+        # и так больше всех прежних
+        get_data_version()
+        return
+    if user_ids is not None:
+        cache.set(
+            changes_key(version),
+            list(user_ids),
+            get_setting('DATA_CHANGES_TIMEOUT')
+        )
+
+
+def get_data_changes(since, until):
+    """
+    Возвращает ID пользователей, изменивших приоритеты после
+    версии данных since до версии until включительно.
+
+    :param since: Версия данных, по которой построен снимок
+    :param until: Текущая версия данных
+    :return:      Множество ID пользователей или None, если изменения
+                  известны не для всех версий (запись истекла,
+                  изменения неизвестны, счетчик версий сброшен
+                  или отставание больше DATA_CHANGES_LIMIT версий)
+    """
+    if since is None or not 0 < until - since <= get_setting('DATA_CHANGES_LIMIT'):
+        return None
+    keys = [changes_key(version) for version in range(since + 1, until + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) < len(keys):
+        return None
+    return set().union(*changes.values())
+
+
+class ResultCache:
+    """
+    Кэш выдачи совместимых пользователей в слое CACHES Django.
+
+    Ключ записи состоит из ID пользователя, способа поиска,
+    признака взаимной выдачи и глобальной версии данных о приоритетах, которую сдвигают
+    сигналы при любом изменении приоритетов, поэтому запись
+    отдается, пока данные не изменятся, и не требует явного
+    удаления. Для способов поиска, читающих хранилище векторов
+    (mmap, tiered), в ключ входит и поколение его файла: замена
+    файла (build_vector_store) делает устаревшими только их записи.
+    Хранятся только ID и сходства, имена подставляются
+    при каждой выдаче.
+    """
+
+    @staticmethod
+    def base_key(user_id, mode, version, mutual=False):
+        kind = 'mutual' if mutual else 'all'
+        return f'soulmate:compatible-users:{version}:{mode or "default"}:{kind}:{user_id}'
+
+    def key(self, user_id, mode, version, mutual=False):
+        key = self.base_key(user_id, mode, version, mutual)
+        if uses_vector_store(mode):
+            generation = VectorStore.generation()
+            if generation is not None:
+                key += ':store-{}-{}'.format(*generation)
+        return key
+
+    def lock_key(self, user_id, mode, version, mutual=False):
+        # Блокировка вычисления общая для всех поколений хранилища
+        return self.base_key(user_id, mode, version, mutual) + ':lock'
+
+    def get(self, user_id, mode, version, mutual=False):
+        """
+        Возвращает выдачу, закэшированную для версии данных version,
+        или None.
+        """
+        if not get_setting('RESULT_CACHE_TIMEOUT'):
+            return None
+
+        result = cache.get(self.key(user_id, mode, version, mutual))
+        increment(MISSES_KEY if result is None else HITS_KEY)
+        return result
+
+    def set(self, user_id, mode, result, version, mutual=False):
+        """
+        Сохраняет выдачу, вычисленную по данным версии version.
+        """
+        timeout = get_setting('RESULT_CACHE_TIMEOUT')
+        if timeout:
+            cache.set(self.key(user_id, mode, version, mutual), result, timeout)
+
+    def acquire(self, user_id, mode, version, mutual=False):
+        """
+        Захватывает блокировку вычисления выдачи в кэше, общую для
+        всех процессов. Блокировка снимается сама через
+        SINGLE_FLIGHT_LOCK_TIMEOUT секунд, если процесс,
+        захвативший ее, не успел снять ее.
+
+        :return: True, если блокировка захвачена
+        """
+        return cache.add(
+            self.lock_key(user_id, mode, version, mutual),
+            True,
+            get_setting('SINGLE_FLIGHT_LOCK_TIMEOUT')
+        )
+
+    def release(self, user_id, mode, version, mutual=False):
+        """
+        Снимает блокировку вычисления выдачи.
+        """
+        cache.delete(self.lock_key(user_id, mode, version, mutual))
+
+    def is_locked(self, user_id, mode, version, mutual=False):
+        return cache.get(
+            self.lock_key(user_id, mode, version, mutual)
+        ) is not None
+
+    def peek(self, user_id, mode, version, mutual=False):
+        """
+        Возвращает закэшированную выдачу без учета в статистике.
+        """
+        return cache.get(self.key(user_id, mode, version, mutual))
+
+    def wait(self, user_id, mode, version, mutual=False):
+        """
+        Ждет выдачу, которую вычисляет процесс, захвативший
+        блокировку, опрашивая кэш каждые SINGLE_FLIGHT_POLL_INTERVAL
+        секунд.
+
+        :return: Выдача или None, если блокировка снята
+                 (или истекла) без сохранения выдачи
+        """
+        interval = get_setting('SINGLE_FLIGHT_POLL_INTERVAL')
+        while True:
+            result = self.peek(user_id, mode, version, mutual)
+            if result is not None:
+                return result
+            if not self.is_locked(user_id, mode, version, mutual):
+                # Выдача могла быть сохранена перед снятием блокировки
+                return self.peek(user_id, mode, version, mutual)
+            time.sleep(interval)
+
+    @staticmethod
+    def stats():
+        """
+        Возвращает счетчики попаданий и промахов и текущую версию данных.
+        """
+        hits = cache.get(HITS_KEY, 0)
+        misses = cache.get(MISSES_KEY, 0)
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else None,
+            'version': get_data_version(),
+        }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,158 @@
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Минимальный процент совместимости для попадания в выдачу
+    'COMPATIBILITY_THRESHOLD': 75,
+    # Максимальное количество совместимых пользователей в выдаче
+    'COMPATIBLE_USERS_LIMIT': 20,
+    # Способ поиска совместимых пользователей:
+    # 'exact' - произведение вектора на всю матрицу,
+    # 'inverted' - инвертированный индекс с отсечением кандидатов,
+    # 'lsh' - приближенный поиск по сигнатурам случайных гиперплоскостей,
+    # 'ivf' - поиск только в ближайших кластерах k-means,
+    # 'sql' - вычисление сходства запросом к БД без резидентной матрицы,
+    # 'mmap' - поиск по общему файлу векторов, отображенному в память,
+    # 'sharded' - параллельный поиск в процессах шардов
+    # 'tiered' - недавно активные пользователи в памяти, остальные
+    # по файлу векторов
+    'SEARCH_MODE': 'inverted',
+    # Минимальное количество общих аспектов кандидата при поиске 'sql';
+    # кандидаты с меньшим пересечением отбрасываются в БД
+    # до вычисления сходства
+    'SQL_MIN_OVERLAP': 1,
+    # Длина сигнатуры LSH в битах и количество полос для корзин
+    'LSH_BITS': 64,
+    'LSH_BANDS': 8,
+    # Радиус Хэмминга перебора соседних корзин внутри полосы
+    'LSH_PROBE_RADIUS': 1,
+    # Максимальное расстояние Хэмминга сигнатур кандидата
+    # (None - вычислять по порогу совместимости)
+    'LSH_MAX_HAMMING': None,
+    'LSH_SEED': 0,
+    # Файл обученной модели кластеров (команда train_ivf_index)
+    'IVF_INDEX_PATH': settings.BASE_DIR / 'ivf_index.npz',
+    # Количество кластеров при обучении
+    'IVF_CLUSTERS': 64,
+    # Количество ближайших кластеров, просматриваемых при поиске
+    'IVF_NPROBE': 4,
+    # Количество пользователей, обрабатываемых одним произведением
+    # матриц в пакетном поиске
+    'BATCH_BLOCK_SIZE': 64,
+    # Максимальное количество пользователей в одном пакетном запросе
+    'BATCH_MAX_USERS': 1000,
+    # Максимальный возраст предвычисленных списков совместимых
+    # пользователей (команда compute_neighbors) в секундах;
+    # более старые списки не используются, 0 - не использовать
+    'NEIGHBORS_MAX_AGE': 26 * 60 * 60,
+    # Исправлять предвычисленные списки на месте при изменении
+    # приоритетов (иначе затронутые списки удаляются до следующего
+    # вычисления)
+    'NEIGHBORS_INCREMENTAL': True,
+    # Максимальное количество пользователей, изменивших приоритеты
+    # в одной транзакции, для исправления списков на месте;
+    # при больших изменениях все списки удаляются
+    'NEIGHBORS_INCREMENTAL_LIMIT': 1000,
+    # Максимальное количество имен пользователей в кэше процесса
+    'NAME_CACHE_SIZE': 10000,
+    # Интервал полного построения снимка движка в фоновом потоке
+    # в секундах (0 - только исправления строк изменившихся
+    # пользователей)
+    'SNAPSHOT_REBUILD_INTERVAL': 60 * 60,
+    # Применять изменения приоритетов к снимку движка в фоновом
+    # потоке (в обслуживающем процессе после warm_up, вне транзакций),
+    # а не в потоке запроса
+    'SNAPSHOT_APPLY_BACKGROUND': True,
+    # Сколько секунд запрос ждет фонового применения изменений,
+    # прежде чем искать по прежнему снимку (такая выдача не кэшируется)
+    'SNAPSHOT_APPLY_WAIT': 0.05,
+    # Пересчитывать нормы векторов и исправлять предвычисленные списки
+    # после записи приоритетов в фоновом потоке (в обслуживающем
+    # процессе после warm_up, вне транзакций), а не в потоке запроса
+    'PRIORITY_CHANGES_BACKGROUND': True,
+    # Время хранения выдачи в кэше (CACHES) в секундах, 0 - не кэшировать;
+    # запись устаревает раньше при любом изменении приоритетов
+    'RESULT_CACHE_TIMEOUT': 600,
+    # Время хранения в CACHES ID пользователей, изменивших приоритеты,
+    # для каждой версии данных в секундах: по ним снимки движка
+    # в других процессах перечитывают только измененные строки
+    'DATA_CHANGES_TIMEOUT': 60 * 60,
+    # Максимальное отставание снимка процесса от общей версии данных
+    # (в версиях), которое догоняется исправлением строк; при большем
+    # отставании снимок строится заново
+    'DATA_CHANGES_LIMIT': 1000,
+    # Согласовывать вычисление одинаковой выдачи между процессами
+    # блокировкой в CACHES: процессы, не захватившие блокировку,
+    # ждут выдачу в кэше вместо повторного вычисления
+    'SINGLE_FLIGHT_CACHE_LOCK': False,
+    # Время жизни блокировки и интервал опроса кэша в секундах
+    'SINGLE_FLIGHT_LOCK_TIMEOUT': 30,
+    'SINGLE_FLIGHT_POLL_INTERVAL': 0.05,
+    # Файл векторов int8 для поиска 'mmap' (команда build_vector_store)
+    'VECTOR_STORE_PATH': settings.BASE_DIR / 'vector_store.bin',
+    # Бюджет памяти горячего уровня поиска 'tiered' в байтах
+    'TIERED_HOT_BYTES': 64 * 1024 * 1024,
+    # Период полураспада оценки активности пользователя в секундах
+    'TIERED_HALF_LIFE': 60 * 60,
+    # Оценка активности для продвижения в горячий уровень:
+    # 1 - с первого обращения, 1.5 - со второго обращения
+    # в пределах периода полураспада
+    'TIERED_ADMISSION_SCORE': 1.5,
+    # Максимальное количество оценок активности негорячих пользователей
+    'TIERED_CANDIDATES': 100000,
+    # Количество процессов шардов для поиска 'sharded'
+    # (по числу ядер контейнера в docker-compose.yml)
+    'SHARDS': 4,
+    # Количество потоков для вычисления сходств
+    # в асинхронных представлениях
+    'SCORING_THREADS': 4,
+    # Размер страницы выдачи с курсором по умолчанию и максимальный
+    'RESULTS_PAGE_SIZE': 100,
+    'RESULTS_MAX_PAGE_SIZE': 1000,
+    # Количество записей, для которых имена загружаются
+    # одним запросом при потоковой выдаче
+    'STREAM_CHUNK_SIZE': 500,
+    # Бюджет времени поиска на лету в миллисекундах (None - без
+    # ограничения); параметр запроса budget_ms переопределяет его
+    'SEARCH_BUDGET_MS': None,
+    # Количество строк матрицы, просматриваемых между проверками
+    # бюджета времени
+    'BUDGET_CHUNK_SIZE': 20000,
+    # Псевдоним реплики из DATABASES, через которую выполняются
+    # чтения подбора, рассылки и списков админки (если его нет
+    # в DATABASES, используется соединение по умолчанию)
+    'READ_DATABASE': 'replica',
+    # Сколько секунд после изменения приоритетов чтения пользователя
+    # идут в основную БД, а не в реплику (0 или None - всегда в реплику)
+    'READ_YOUR_WRITES_SECONDS': 30,
+}
+
+
+def get_setting(name):
+    """
+    Возвращает значение настройки подбора совместимых пользователей.
+
+    Значения берутся из словаря SOULMATE_MATCHING в settings.py,
+    а при их отсутствии - из DEFAULTS.
+
+    :param name: Имя настройки
+    :return:     Значение настройки
+    """
+    return getattr(settings, 'SOULMATE_MATCHING', {}).get(
+        name, DEFAULTS[name]
+    )
+
+
+def to_percentage(similarity):
+    """
+    Переводит косинусное сходство (от -1 до 1)
+    в процент совместимости (от 0 до 100).
+    """
+    return (similarity + 1) / 2 * 100
+
+
+def threshold_similarity(threshold):
+    """
+    Переводит процент совместимости в косинусное сходство.
+    """
+    return threshold / 50 - 1
@@ -0,0 +1,57 @@
+import numpy as np
+
+from django.db.models.functions import Mod
+
+from ..database import primary_reads
+from ..models import UserPriority
+
+# Ограничение на количество параметров в одном запросе
+# (SQLite по умолчанию допускает не более 999 переменных)
+QUERY_CHUNK_SIZE = 500
+
+
+@primary_reads()
+def load_signed_weights(user_ids=None, shard=None, shards=None):
+    """
+    Загружает знаковые веса приоритетов пользователей.
+
+    Веса читаются из основной БД: снимок и нормы векторов
+    строятся сразу после изменения приоритетов и не должны
+    закрепить отстающее состояние реплики.
+
+    :param user_ids: Итерируемый объект с ID пользователей
+                     или None для загрузки всех пользователей
+    :param shard:    Номер шарда или None: загружаются только
+                     пользователи, чей ID по модулю shards равен shard
+    :param shards:   Количество шардов
+    :return:         Кортеж из трех массивов numpy одинаковой длины:
+                     ID пользователей, ID аспектов и знаковые веса
+                     в порядке ID пользователя и ID аспекта
+    """
+    fields = ('user_id', 'aspect_id', 'signed_weight')
+    # Порядок индекса уникальности: вектор каждого пользователя
+    # читается одним диапазоном индекса
+    queryset = UserPriority.objects.order_by('user_id', 'aspect_id')
+    if shard is not None:
+        queryset = queryset.alias(
+            shard=Mod('user_id', shards)
+        ).filter(shard=shard)
+
+    if user_ids is None:
+        chunks = [queryset.values_list(*fields)]
+    else:
+        user_ids = list(user_ids)
+        chunks = [
+            queryset.filter(
+                user_id__in=user_ids[i:i + QUERY_CHUNK_SIZE]
+            ).values_list(*fields)
+            for i in range(0, len(user_ids), QUERY_CHUNK_SIZE)
+        ]
+
+    rows = [row for chunk in chunks for row in chunk.iterator()]
+    if not rows:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.copy(), empty.copy()
+
+    users, aspects, weights = np.array(rows, dtype=np.int64).T
+    return users, aspects, weights
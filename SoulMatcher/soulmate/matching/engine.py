@@ -0,0 +1,730 @@
+import copy
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import numpy as np
+import scipy.sparse as sp
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from .cache import get_data_changes, get_data_version
+from .conf import get_setting
+from .data import load_signed_weights
+from .inverted import InvertedIndex
+from .ranking import rank_matches
+
+logger = logging.getLogger(__name__)
+
+# Снимок, закрепленный за текущим контекстом (MatchingEngine.pinned)
+_pinned_snapshot = ContextVar('pinned_snapshot', default=None)
+
+
+def deduplicate_weights(users, aspects, weights):
+    """
+    Оставляет по одному весу на каждую пару (пользователь, аспект).
+
+    При повторах побеждает последний добавленный приоритет,
+    так же как при заполнении вектора в цикле.
+    Результат упорядочен по ID пользователя и ID аспекта.
+    """
+    order = np.lexsort((np.arange(len(users)), aspects, users))
+    users, aspects, weights = users[order], aspects[order], weights[order]
+
+    last = np.ones(len(users), dtype=bool)
+    last[:-1] = (users[1:] != users[:-1]) | (aspects[1:] != aspects[:-1])
+    return users[last], aspects[last], weights[last]
+
+
+def map_to_positions(ids, values):
+    """
+    Возвращает позиции значений values в (неотсортированном) массиве ids.
+    Все значения обязаны присутствовать в ids.
+    """
+    sorter = np.argsort(ids, kind='stable')
+    return sorter[np.searchsorted(ids, values, sorter=sorter)]
+
+
+class MatchingSnapshot:
+    """
+    Неизменяемый снимок приоритетов всех пользователей.
+
+    Хранит разреженную матрицу CSR (пользователи x аспекты)
+    со знаковыми весами и заранее посчитанные нормы строк,
+    поэтому поиск совместимых пользователей сводится к одному
+    произведению разреженной строки на матрицу.
+
+    Attributes:
+        - matrix:           Матрица CSR знаковых весов
+        - user_ids:         ID пользователей в порядке строк
+        - aspect_ids:       ID аспектов в порядке столбцов
+        - norms:            Евклидовы нормы строк
+        - version:          Номер версии снимка
+        - changed_user_ids: ID пользователей, чьи строки изменились
+                            относительно предыдущей версии
+        - retained:         Маска строк предыдущей версии, перенесенных
+                            без изменений в начало этой версии
+                            (None, если снимок построен с нуля)
+        - data_version:     Общая версия данных о приоритетах
+                            (get_data_version), все изменения до которой
+                            учтены в снимке, или None
+    """
+
+    def __init__(self, matrix, user_ids, aspect_ids, version=0,
+                 changed_user_ids=frozenset(), retained=None, data_version=None):
+        self.matrix = matrix
+        self.user_ids = user_ids
+        self.aspect_ids = aspect_ids
+        self.version = version
+        self.changed_user_ids = changed_user_ids
+        self.retained = retained
+        self.data_version = data_version
+        self._derived = {}
+        # Производные структуры снимка, из которого этот получен
+        # исправлением строк (with_users), еще не перенесенные
+        # в этот снимок, или None
+        self._previous = None
+
+        self.norms = np.sqrt(
+            np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+        )
+        self.row_of = {
+            user_id: row for row, user_id in enumerate(user_ids.tolist())
+        }
+
+    @classmethod
+    def empty(cls):
+        """
+        Создает пустой снимок без пользователей и аспектов.
+        """
+        return cls(
+            sp.csr_matrix((0, 0), dtype=np.float64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64)
+        )
+
+    @classmethod
+    def from_weights(cls, users, aspects, weights, data_version=None):
+        """
+        Строит снимок по знаковым весам всех пользователей.
+
+        :param users:        Массив ID пользователей
+        :param aspects:      Массив ID аспектов
+        :param weights:      Массив знаковых весов
+        :param data_version: Версия данных, прочитанная до весов
+        :return:             Новый снимок
+        """
+        return cls.empty().with_users(
+            set(users.tolist()), users, aspects, weights, data_version
+        )
+
+    @property
+    def size(self):
+        """
+        Количество байт, занимаемых матрицей и нормами.
+        """
+        return (
+            self.matrix.data.nbytes
+            + self.matrix.indices.nbytes
+            + self.matrix.indptr.nbytes
+            + self.norms.nbytes
+        )
+
+    def with_users(self, user_ids, users, aspects, weights, data_version=None):
+        """
+        Возвращает новый снимок, в котором строки указанных пользователей
+        заменены свежими весами. Пользователи без весов удаляются.
+        Новые аспекты добавляются в конец, порядок существующих
+        столбцов сохраняется.
+
+        :param user_ids:     ID пользователей, чьи строки заменяются
+        :param users:        Массив ID пользователей свежих весов
+        :param aspects:      Массив ID аспектов свежих весов
+        :param weights:      Массив знаковых весов
+        :param data_version: Версия данных, прочитанная до весов
+                             (None - как у этого снимка)
+        :return:             Новый снимок
+        """
+        users, aspects, weights = deduplicate_weights(users, aspects, weights)
+
+        new_aspects = np.setdiff1d(aspects, self.aspect_ids)
+        aspect_ids = np.concatenate([self.aspect_ids, new_aspects])
+
+        keep = ~np.isin(self.user_ids, np.fromiter(user_ids, dtype=np.int64))
+        base = self.matrix[keep]
+        base = sp.csr_matrix(
+            (base.data, base.indices, base.indptr),
+            shape=(base.shape[0], len(aspect_ids))
+        )
+
+        added_user_ids = np.unique(users)
+        added = sp.csr_matrix(
+            (
+                weights.astype(np.float64),
+                (
+                    np.searchsorted(added_user_ids, users),
+                    map_to_positions(aspect_ids, aspects)
+                )
+            ),
+            shape=(len(added_user_ids), len(aspect_ids))
+        )
+
+        snapshot = MatchingSnapshot(
+            sp.vstack([base, added], format='csr'),
+            np.concatenate([self.user_ids[keep], added_user_ids]),
+            aspect_ids,
+            version=self.version + 1,
+            changed_user_ids=frozenset(user_ids),
+            retained=keep if len(self.user_ids) else None,
+            data_version=self.data_version if data_version is None else data_version
+        )
+        snapshot._previous = dict(self._derived) or None
+        return snapshot
+
+    def renumbered(self, version):
+        """
+        Возвращает снимок с теми же данными под номером версии
+        version, как построенный с нуля (без перенесенных строк).
+        Матрица и уже построенные производные структуры общие.
+        """
+        snapshot = copy.copy(self)
+        snapshot.version = version
+        snapshot.changed_user_ids = frozenset()
+        snapshot.retained = None
+        snapshot._derived = dict(self._derived)
+        snapshot._previous = None
+        return snapshot
+
+    def at_data_version(self, data_version):
+        """
+        Возвращает снимок с теми же данными и версией, учитывающий
+        изменения до версии данных data_version (изменения после
+        версии снимка не затронули его строк).
+        """
+        snapshot = copy.copy(self)
+        snapshot.data_version = data_version
+        return snapshot
+
+    def derived(self, factory, is_current=None):
+        """
+        Возвращает производную структуру (например, индекс),
+        построенную вызовом factory(snapshot). Снимок неизменяем,
+        поэтому структура строится один раз и живет вместе с ним.
+
+        :param factory:    Функция построения структуры
+        :param is_current: Проверка построенной структуры или None;
+                           структура, не прошедшая ее (например,
+                           построенная по прежней модели), строится
+                           заново
+        """
+        value = self._derived.get(factory)
+        if value is None or (is_current is not None and not is_current(value)):
+            value = self._derived[factory] = factory(self)
+            # Структура предыдущего снимка больше не нужна
+            # и не должна удерживать его в памяти
+            if self._previous is not None:
+                self._previous.pop(factory, None)
+        return value
+
+    def previous(self, factory):
+        """
+        Возвращает структуру factory, построенную для снимка,
+        из которого этот получен исправлением строк (with_users),
+        или None. По ней структура этого снимка может быть
+        построена только для изменившихся строк.
+        """
+        if self._previous is None:
+            return None
+        return self._previous.get(factory)
+
+    def vector(self, user_id):
+        """
+        Возвращает строку матрицы пользователя
+        или None, если у пользователя нет приоритетов.
+        """
+        row = self.row_of.get(user_id)
+        if row is None:
+            return None
+        return self.matrix[row]
+
+    def has_priorities(self, user_id):
+        """
+        Проверяет, есть ли у пользователя хотя бы один ненулевой вес.
+        """
+        row = self.row_of.get(user_id)
+        return row is not None and self.norms[row] > 0
+
+    def similarities(self, vector, rows=None):
+        """
+        Вычисляет косинусное сходство вектора со строками матрицы.
+
+        :param vector: Разреженная строка 1 x количество аспектов
+        :param rows:   Массив номеров строк-кандидатов
+                       или None для всех строк
+        :return:       Массив сходств в порядке строк
+        """
+        matrix, norms = self.matrix, self.norms
+        if rows is not None:
+            matrix, norms = matrix[rows], norms[rows]
+
+        dots = np.asarray((matrix @ vector.T).todense()).ravel()
+        denominators = norms * np.sqrt(vector.multiply(vector).sum())
+
+        similarities = np.zeros(len(dots))
+        np.divide(dots, denominators, out=similarities, where=denominators > 0)
+        return np.clip(similarities, -1, 1)
+
+    def search(self, user_id, threshold=None, limit=None):
+        """
+        Ищет пользователей, наиболее совместимых с заданным.
+
+        :param user_id:   ID пользователя
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства
+        """
+        vector = self.vector(user_id)
+        if vector is None:
+            return []
+
+        row = self.row_of[user_id]
+        return rank_matches(
+            np.delete(self.user_ids, row),
+            np.delete(self.similarities(vector), row),
+            threshold,
+            limit
+        )
+
+    def search_vector(self, user_id, aspects, weights, threshold=None, limit=None):
+        """
+        Ищет пользователей снимка, наиболее совместимых с вектором,
+        заданным вне снимка.
+
+        Норма берется по всему вектору: аспекты, которых нет
+        в снимке, не меняют скалярных произведений, но входят в норму.
+
+        :param user_id:   ID пользователя вектора (исключается из выдачи)
+        :param aspects:   Массив ID аспектов вектора
+        :param weights:   Массив знаковых весов вектора
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства
+        """
+        known = np.isin(aspects, self.aspect_ids)
+        vector = sp.csr_matrix(
+            (
+                weights[known],
+                (
+                    np.zeros(known.sum(), dtype=np.int64),
+                    map_to_positions(self.aspect_ids, aspects[known])
+                )
+            ),
+            shape=(1, len(self.aspect_ids))
+        )
+
+        dots = np.asarray((self.matrix @ vector.T).todense()).ravel()
+        denominators = self.norms * np.sqrt(np.sum(np.square(weights)))
+        similarities = np.zeros(len(dots))
+        np.divide(dots, denominators, out=similarities, where=denominators > 0)
+
+        rows = self.user_ids != user_id
+        return rank_matches(
+            self.user_ids[rows],
+            np.clip(similarities[rows], -1, 1),
+            threshold,
+            limit
+        )
+
+
+class MatchingEngine:
+    """
+    Резидентный движок подбора совместимых пользователей.
+
+    Снимок приоритетов строится один раз при первом обращении
+    (или при старте процесса) и затем поддерживается в актуальном
+    состоянии: сигналы записи приоритетов помечают пользователей
+    как измененных, и перед следующим поиском их строки
+    перечитываются из БД одним запросом. Изменения, сделанные
+    другими процессами, движок узнает по общей версии данных
+    в CACHES (snapshot).
+
+    В обслуживающем процессе (после warm_up) изменения применяются
+    в фоновом потоке (SNAPSHOT_APPLY_BACKGROUND): копия матрицы
+    с новыми строками и индекс способа поиска по умолчанию строятся
+    вне потока запроса, а запрос ждет их не дольше
+    SNAPSHOT_APPLY_WAIT секунд и иначе ищет по прежнему снимку.
+
+    Раз в SNAPSHOT_REBUILD_INTERVAL секунд снимок строится заново
+    в фоновом потоке (rebuild): столбцы удаленных аспектов
+    и перестановки строк, накопленные исправлениями, исчезают,
+    а индекс способа поиска по умолчанию строится заранее.
+    Готовый снимок подменяет текущий одним присваиванием ссылки,
+    поэтому запросы не ждут построения, а уже начатые поиски
+    завершаются по прежнему снимку. Пользователи, изменившие
+    приоритеты во время построения, перечитываются поверх нового
+    снимка перед следующим поиском.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._dirty = set()
+        self._build_lock = threading.Lock()
+        self._dirty_lock = threading.Lock()
+
+        # Пользователи, изменившие приоритеты во время фонового
+        # построения, или None, если построение не идет
+        self._rebuild_dirty = None
+        self._rebuild_thread = None
+        self._rebuild_lock = threading.Lock()
+        # Счетчик сбросов: снимок, построенный до сброса, не подставляется
+        self._generation = 0
+
+        # Поток фонового применения изменений или None
+        self._apply_thread = None
+        self._apply_lock = threading.Lock()
+        # Процесс обслуживает запросы (warm_up): изменения
+        # применяются в фоновом потоке
+        self.serving = False
+
+        self.built_at = None
+        self.build_seconds = None
+        self.rebuilds = 0
+
+    def mark_dirty(self, user_ids):
+        """
+        Помечает пользователей как изменивших приоритеты.
+        Пока снимок не построен и не строится, отметки не нужны:
+        построение прочитает все приоритеты.
+        """
+        if self._snapshot is None and not self._build_lock.locked():
+            return
+        with self._dirty_lock:
+            self._dirty.update(user_ids)
+            if self._rebuild_dirty is not None:
+                self._rebuild_dirty.update(user_ids)
+
+    def _take_dirty(self):
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    @staticmethod
+    def _build():
+        """
+        Строит снимок по всем приоритетам.
+
+        Веса читаются одним запросом по таблице связей
+        пользователей с приоритетами, поэтому снимок соответствует
+        одному согласованному состоянию БД. Версия данных читается
+        до весов: изменения, зафиксированные во время чтения,
+        будут применены повторно.
+
+        :return: Снимок и длительность построения в секундах
+        """
+        started = time.monotonic()
+        data_version = get_data_version()
+        snapshot = MatchingSnapshot.from_weights(
+            *load_signed_weights(), data_version=data_version
+        )
+        return snapshot, time.monotonic() - started
+
+    def _install(self, snapshot, build_seconds):
+        self._snapshot = snapshot
+        self.built_at = time.time()
+        self.build_seconds = build_seconds
+
+    def _replace(self, snapshot, build_seconds):
+        """
+        Подменяет текущий снимок построенным заново, продолжая
+        нумерацию версий.
+        """
+        current = self._snapshot
+        version = current.version + 1 if current is not None else 1
+        self._install(snapshot.renumbered(version), build_seconds)
+        self.rebuilds += 1
+        logger.info(
+            'Matching snapshot rebuilt in %.3f s: %d users, %d bytes',
+            build_seconds, len(snapshot.user_ids), snapshot.size
+        )
+
+    def _prepare(self, snapshot):
+        """
+        Строит индекс способа поиска по умолчанию для снимка,
+        который еще не подменил текущий.
+        """
+        if get_setting('SEARCH_MODE') == 'inverted':
+            InvertedIndex.for_snapshot(snapshot)
+
+    def _apply(self, data_version, prepare=False):
+        """
+        Применяет к снимку накопленные изменения: строит его, если
+        снимка нет, перечитывает строки измененных пользователей
+        (отмеченных сигналами и опубликованных другими процессами
+        до версии данных data_version) или, если изменения известны
+        не для всех версий, строит снимок заново.
+        Вызывается под блокировкой построения.
+
+        :param data_version: Текущая версия данных, прочитанная
+                             до весов
+        :param prepare:      Построить индекс способа поиска
+                             по умолчанию до подмены снимка
+        """
+        current = self._snapshot
+        dirty = self._take_dirty()
+        changes = set()
+        if current is not None and current.data_version != data_version:
+            changes = get_data_changes(current.data_version, data_version)
+
+        if current is None or changes is None:
+            snapshot, build_seconds = self._build()
+            if prepare:
+                self._prepare(snapshot)
+            if current is None:
+                self._install(snapshot, build_seconds)
+            else:
+                self._replace(snapshot, build_seconds)
+        elif dirty or changes:
+            dirty |= changes
+            snapshot = current.with_users(
+                dirty, *load_signed_weights(dirty), data_version
+            )
+            if prepare:
+                self._prepare(snapshot)
+            self._snapshot = snapshot
+        elif current.data_version != data_version:
+            self._snapshot = current.at_data_version(data_version)
+
+    def _applies_in_background(self):
+        """
+        Проверяет, применяются ли изменения в фоновом потоке.
+        Внутри транзакции изменения применяются в потоке запроса:
+        фоновый поток не увидел бы ее незафиксированных изменений.
+        """
+        return (
+            self.serving
+            and get_setting('SNAPSHOT_APPLY_BACKGROUND')
+            and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+        )
+
+    def _has_changes(self, data_version):
+        snapshot = self._snapshot
+        return bool(self._dirty) or snapshot.data_version != data_version
+
+    def apply_changes(self):
+        """
+        Применяет накопленные изменения к снимку в фоновом потоке,
+        если он еще не запущен.
+
+        :return: Поток фонового применения
+        """
+        with self._apply_lock:
+            if self._apply_thread is None:
+                self._apply_thread = threading.Thread(
+                    target=self._apply_changes,
+                    name='soulmate-snapshot-apply',
+                    daemon=True
+                )
+                self._apply_thread.start()
+            return self._apply_thread
+
+    def _apply_changes(self):
+        try:
+            data_version = get_data_version()
+            with self._build_lock:
+                self._apply(data_version, prepare=True)
+        except Exception:
+            logger.exception('Applying matching snapshot changes failed')
+        finally:
+            # Фоновый поток открыл собственные соединения с БД
+            connections.close_all()
+            with self._apply_lock:
+                self._apply_thread = None
+
+    def applied_snapshot(self):
+        """
+        Возвращает снимок, учитывающий все изменения, отмеченные
+        до вызова, применяя их в потоке вызывающего (например,
+        для исправления предвычисленных списков после записи).
+        Индекс способа поиска по умолчанию строится до подмены
+        снимка, поэтому поиски запросов его не строят.
+        """
+        data_version = get_data_version()
+        with self._build_lock:
+            self._apply(data_version, prepare=True)
+            return self._snapshot
+
+    def snapshot(self):
+        """
+        Возвращает актуальный снимок, при необходимости
+        построив его или применив накопленные изменения.
+        Внутри блока pinned возвращает закрепленный снимок
+        без обращения к БД.
+
+        Изменения других процессов движок узнает по общей версии
+        данных (get_data_version): если она сдвинулась после
+        построения снимка, перечитываются строки пользователей,
+        опубликованных bump_data_version, а если изменения известны
+        не для всех версий, снимок строится заново. В обслуживающем
+        процессе изменения применяются в фоновом потоке, и снимок,
+        не дождавшийся их за SNAPSHOT_APPLY_WAIT секунд, отстает
+        от текущей версии данных (его data_version меньше).
+        """
+        pinned = _pinned_snapshot.get()
+        if pinned is not None:
+            return pinned
+
+        data_version = get_data_version()
+        if self._snapshot is None or not self._applies_in_background():
+            with self._build_lock:
+                self._apply(data_version)
+        elif self._has_changes(data_version):
+            self.apply_changes().join(get_setting('SNAPSHOT_APPLY_WAIT'))
+        snapshot, built_at = self._snapshot, self.built_at
+
+        interval = get_setting('SNAPSHOT_REBUILD_INTERVAL')
+        if interval and time.time() - built_at >= interval:
+            self.rebuild()
+        return snapshot
+
+    @contextmanager
+    def pinned(self, snapshot):
+        """
+        Закрепляет снимок за текущим контекстом: поиски внутри блока
+        (в том числе в пуле потоков run_scoring, получающем копию
+        контекста) используют его и не обращаются к БД
+        за изменениями, накопленными после его получения.
+
+        :param snapshot: Снимок, полученный вызовом snapshot()
+        """
+        token = _pinned_snapshot.set(snapshot)
+        try:
+            yield snapshot
+        finally:
+            _pinned_snapshot.reset(token)
+
+    def rebuild(self, background=True):
+        """
+        Строит снимок заново и подменяет им текущий.
+
+        :param background: Строить в фоновом потоке
+        :return:           True, если построение запущено
+                           (False - уже идет другое)
+        """
+        with self._rebuild_lock:
+            if self._rebuild_thread is not None:
+                return False
+            with self._dirty_lock:
+                self._rebuild_dirty = set()
+            generation = self._generation
+            if background:
+                self._rebuild_thread = threading.Thread(
+                    target=self._rebuild,
+                    args=(generation, True),
+                    name='soulmate-snapshot-rebuild',
+                    daemon=True
+                )
+                self._rebuild_thread.start()
+                return True
+            self._rebuild_thread = threading.current_thread()
+
+        self._rebuild(generation)
+        return True
+
+    def _rebuild(self, generation, background=False):
+        snapshot = None
+        try:
+            snapshot, build_seconds = self._build()
+            self._prepare(snapshot)
+        except Exception:
+            logger.exception('Matching snapshot rebuild failed')
+        finally:
+            if background:
+                # Фоновый поток открыл собственные соединения с БД
+                connections.close_all()
+
+        with self._build_lock:
+            with self._dirty_lock:
+                dirty, self._rebuild_dirty = self._rebuild_dirty, None
+                if snapshot is not None:
+                    self._dirty.update(dirty)
+            if snapshot is not None and generation == self._generation:
+                self._replace(snapshot, build_seconds)
+        with self._rebuild_lock:
+            self._rebuild_thread = None
+
+    def wait_rebuild(self, timeout=None):
+        """
+        Ждет окончания фонового построения, если оно идет.
+        """
+        thread = self._rebuild_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def stats(self):
+        """
+        Возвращает сведения о текущем снимке: версию, размеры,
+        время и длительность последнего полного построения.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {'built': False, 'rebuilding': self._rebuild_thread is not None}
+        return {
+            'built': True,
+            'version': snapshot.version,
+            'users': len(snapshot.user_ids),
+            'aspects': len(snapshot.aspect_ids),
+            'weights': snapshot.matrix.nnz,
+            'bytes': snapshot.size,
+            'age_seconds': time.time() - self.built_at,
+            'build_seconds': self.build_seconds,
+            'rebuilds': self.rebuilds,
+            'rebuilding': self._rebuild_thread is not None,
+        }
+
+    def search(self, user_id, threshold=None, limit=None):
+        """
+        Ищет совместимых пользователей по актуальному снимку.
+        """
+        return self.snapshot().search(user_id, threshold, limit)
+
+    def warm_up(self):
+        """
+        Строит снимок заранее, чтобы первый запрос не ждал загрузки.
+        Ошибки БД (например, непримененные миграции) не мешают
+        старту процесса: снимок будет построен при первом запросе.
+        """
+        try:
+            self.snapshot()
+            self.serving = True
+        except DatabaseError:
+            logger.warning(
+                'Matching engine warm-up failed, '
+                'snapshot will be built on first request',
+                exc_info=True
+            )
+
+    def reset(self):
+        """
+        Сбрасывает снимок, следующий поиск построит его заново.
+        """
+        with self._build_lock:
+            self._snapshot = None
+            self._generation += 1
+            self._take_dirty()
+            self.built_at = self.build_seconds = None
+            self.rebuilds = 0
+            self.serving = False
+
+
+_engine = MatchingEngine()
+
+
+def get_engine():
+    """
+    Возвращает движок подбора текущего процесса.
+    """
+    return _engine
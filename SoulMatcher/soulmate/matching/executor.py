@@ -0,0 +1,67 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .conf import get_setting
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_background_executor = None
+
+
+def get_scoring_executor():
+    """
+    Возвращает пул потоков для вычисления сходств в асинхронных
+    представлениях, создавая его при первом обращении.
+
+    Размер пула (SCORING_THREADS) ограничивает количество
+    одновременно выполняемых поисков: NumPy и SciPy отпускают GIL
+    в произведениях матриц, поэтому поиски идут параллельно,
+    а цикл событий тем временем обслуживает остальные соединения.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_setting('SCORING_THREADS'),
+                thread_name_prefix='soulmate-scoring'
+            )
+        return _executor
+
+
+def get_background_executor():
+    """
+    Возвращает пул из одного потока для работы, отложенной
+    из потока запроса (например, обработки зафиксированных
+    изменений приоритетов), создавая его при первом обращении.
+
+    Задачи выполняются по одной в порядке отправки, поэтому
+    более поздние изменения применяются после более ранних.
+    """
+    global _background_executor
+    with _executor_lock:
+        if _background_executor is None:
+            _background_executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix='soulmate-background'
+            )
+        return _background_executor
+
+
+async def run_scoring(func, *args):
+    """
+    Выполняет вычисление в пуле потоков, не блокируя цикл событий.
+
+    Функция выполняется в копии контекста (contextvars) вызывающего
+    кода и видит, например, снимок, закрепленный за запросом
+    (MatchingEngine.pinned). Функция не должна обращаться к БД:
+    снимок для нее получается заранее в потоке sync_to_async.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_scoring_executor(), functools.partial(context.run, func, *args)
+    )
@@ -0,0 +1,160 @@
+import numpy as np
+import scipy.sparse as sp
+
+from .conf import get_setting, threshold_similarity
+from .ranking import rank_matches
+
+# Допуск на ошибки округления при сравнении верхних оценок с порогом,
+# чтобы не отсечь кандидата, чья совместимость ровно равна порогу
+BOUND_TOLERANCE = 1e-9
+
+
+class InvertedIndex:
+    """
+    Инвертированный индекс аспектов: для каждого аспекта хранится
+    список вхождений (строки пользователей и нормированные веса),
+    упорядоченный по строкам.
+
+    Поиск накапливает вклады аспектов по одному (term-at-a-time)
+    и отсекает кандидатов по схеме MaxScore: аспекты обрабатываются
+    по убыванию максимально возможного вклада, и как только сумма
+    вкладов оставшихся аспектов не позволяет новому пользователю
+    достичь порога, новые кандидаты больше не добавляются, а для
+    существующих вклады ищутся точечно, без полного обхода списков.
+    Порог - это максимум из порога совместимости и нижней оценки
+    limit-го лучшего кандидата, поэтому порог в 75% и ограничение
+    в 20 пользователей служат условиями раннего выхода.
+    При пороге не выше 50% порог проходят и пользователи без общих
+    аспектов (нулевое сходство), которых нет в списках вхождений,
+    поэтому поиск выполняется точным перебором снимка.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+        norms = snapshot.norms.copy()
+        norms[norms == 0] = 1
+        normalized = sp.diags(1 / norms) @ snapshot.matrix
+
+        postings = sp.csc_matrix(normalized)
+        postings.sort_indices()
+        self.indptr = postings.indptr
+        self.rows = postings.indices
+        self.weights = postings.data
+
+        # Максимальный и минимальный нормированный вес каждого аспекта
+        self.max_weights = np.zeros(postings.shape[1])
+        self.min_weights = np.zeros(postings.shape[1])
+        nonempty = np.diff(self.indptr) > 0
+        if len(self.weights):
+            starts = self.indptr[:-1][nonempty]
+            self.max_weights[nonempty] = np.maximum.reduceat(self.weights, starts)
+            self.min_weights[nonempty] = np.minimum.reduceat(self.weights, starts)
+
+        self.query_vectors = sp.csr_matrix(normalized)
+
+    @classmethod
+    def for_snapshot(cls, snapshot):
+        """
+        Возвращает индекс для снимка, строя его при первом обращении.
+        Снимок неизменяем, поэтому индекс живет вместе с ним.
+        """
+        return snapshot.derived(cls)
+
+    def postings(self, column):
+        """
+        Возвращает строки пользователей и нормированные веса аспекта.
+        """
+        start, end = self.indptr[column], self.indptr[column + 1]
+        return self.rows[start:end], self.weights[start:end]
+
+    def search(self, user_id, threshold=None, limit=None):
+        """
+        Ищет пользователей, наиболее совместимых с заданным.
+
+        :param user_id:   ID пользователя
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства
+        """
+        if threshold is None:
+            threshold = get_setting('COMPATIBILITY_THRESHOLD')
+        if limit is None:
+            limit = get_setting('COMPATIBLE_USERS_LIMIT')
+
+        row = self.snapshot.row_of.get(user_id)
+        if row is None or limit <= 0:
+            return []
+
+        minimum = threshold_similarity(threshold)
+        if minimum <= 0:
+            return self.snapshot.search(user_id, threshold, limit)
+
+        query = self.query_vectors[row]
+        columns, values = query.indices, query.data
+
+        # Границы вклада каждого аспекта запроса в итоговое сходство
+        extremes = np.stack([
+            values * self.max_weights[columns],
+            values * self.min_weights[columns]
+        ])
+        upper = np.maximum(extremes.max(axis=0), 0)
+        lower = np.minimum(extremes.min(axis=0), 0)
+
+        order = np.argsort(-upper, kind='stable')
+        columns, values = columns[order], values[order]
+        upper, lower = upper[order], lower[order]
+
+        # Суммы границ аспектов, начиная с i-го и до конца
+        remaining_upper = np.append(np.cumsum(upper[::-1])[::-1], 0)
+        remaining_lower = np.append(np.cumsum(lower[::-1])[::-1], 0)
+
+        # Аспекты, без которых пользователь все еще может достичь порога,
+        # обязательны: из их списков набираются кандидаты
+        essential = int(np.searchsorted(
+            -remaining_upper, -(minimum - BOUND_TOLERANCE), side='right'
+        ))
+
+        if essential == 0:
+            return []
+
+        rows = np.concatenate([
+            self.postings(column)[0] for column in columns[:essential]
+        ])
+        contributions = np.concatenate([
+            self.postings(column)[1] * value
+            for column, value in zip(columns[:essential], values[:essential])
+        ])
+        candidates, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions)
+
+        not_self = candidates != row
+        candidates, scores = candidates[not_self], scores[not_self]
+
+        for term in range(essential, len(columns)):
+            bound = minimum
+            if len(scores) > limit:
+                lower_bounds = scores + remaining_lower[term]
+                bound = max(
+                    bound,
+                    np.partition(lower_bounds, -limit)[-limit]
+                )
+
+            alive = scores + remaining_upper[term] >= bound - BOUND_TOLERANCE
+            candidates, scores = candidates[alive], scores[alive]
+            if not len(candidates):
+                return []
+
+            posting_rows, posting_weights = self.postings(columns[term])
+            positions = np.searchsorted(posting_rows, candidates)
+            positions = np.minimum(positions, len(posting_rows) - 1)
+            found = posting_rows[positions] == candidates
+            scores[found] += posting_weights[positions[found]] * values[term]
+
+        return rank_matches(
+            self.snapshot.user_ids[candidates],
+            np.clip(scores, -1, 1),
+            threshold,
+            limit
+        )
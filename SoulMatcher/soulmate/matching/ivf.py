@@ -0,0 +1,236 @@
+import os
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.cluster import MiniBatchKMeans
+
+from .conf import get_setting
+from .engine import map_to_positions
+from .ranking import rank_matches
+
+
+def normalize_rows(matrix):
+    """
+    Нормирует строки разреженной матрицы (нулевые строки не меняются).
+    """
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sp.csr_matrix(sp.diags(1 / norms) @ matrix)
+
+
+def assign_clusters(matrix, centroids):
+    """
+    Относит строки матрицы к кластеру с ближайшим
+    (по косинусному сходству) нормированным центроидом.
+    """
+    if not matrix.shape[0]:
+        return np.empty(0, dtype=np.int32)
+    scores = normalize_rows(matrix) @ centroids.T
+    return np.asarray(scores).argmax(axis=1).astype(np.int32)
+
+
+class IVFModel:
+    """
+    Обученное разбиение пользователей на кластеры (k-means).
+
+    Хранит нормированные центроиды в пространстве аспектов на момент
+    обучения. Модель обучается командой train_ivf_index и сохраняется
+    в файл IVF_INDEX_PATH, откуда ее подхватывают все процессы.
+    """
+
+    _lock = threading.Lock()
+    _cached = (None, None, None)
+
+    def __init__(self, centroids, aspect_ids):
+        self.centroids = centroids
+        self.aspect_ids = aspect_ids
+
+    @property
+    def n_clusters(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, snapshot, n_clusters, sample=None, seed=0):
+        """
+        Обучает модель по векторам снимка.
+
+        :param snapshot:   Снимок приоритетов
+        :param n_clusters: Количество кластеров
+        :param sample:     Размер случайной выборки пользователей
+                           для обучения или None для всех
+        :param seed:       Зерно генератора случайных чисел
+        :return:           Новая модель
+        """
+        matrix = snapshot.matrix[snapshot.norms > 0]
+        n_clusters = min(n_clusters, matrix.shape[0])
+
+        training = normalize_rows(matrix)
+        if sample is not None and sample < training.shape[0]:
+            rng = np.random.default_rng(seed)
+            training = training[rng.choice(training.shape[0], sample, replace=False)]
+
+        kmeans = MiniBatchKMeans(
+            n_clusters=n_clusters,
+            random_state=seed,
+            n_init=3,
+            batch_size=4096
+        ).fit(training)
+
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        centroid_norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.where(centroid_norms > 0, centroid_norms, 1)
+
+        return cls(centroids, snapshot.aspect_ids.copy())
+
+    def save(self, path):
+        """
+        Сохраняет модель в файл. Файл заменяется атомарно, поэтому
+        процессы никогда не прочитают его частично записанным.
+        """
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as file:
+            np.savez(
+                file,
+                centroids=self.centroids,
+                aspect_ids=self.aspect_ids
+            )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['aspect_ids'])
+
+    @classmethod
+    def current(cls):
+        """
+        Возвращает модель из файла IVF_INDEX_PATH, перечитывая его
+        при изменении, или None, если модель еще не обучена.
+        """
+        path = str(get_setting('IVF_INDEX_PATH'))
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        with cls._lock:
+            cached_path, cached_modified, model = cls._cached
+            if (cached_path, cached_modified) != (path, modified):
+                model = cls.load(path)
+                cls._cached = (path, modified, model)
+            return model
+
+
+class IVFIndex:
+    """
+    Индекс с инвертированными списками кластеров (IVF).
+
+    Пользователи снимка распределены по кластерам модели IVFModel.
+    Поиск сравнивает вектор пользователя только с центроидами,
+    выбирает nprobe ближайших кластеров и переранжирует точным
+    косинусным сходством лишь их участников.
+    Пользователи относятся к кластеру с ближайшим центроидом
+    при построении индекса, а появившиеся или изменившиеся
+    пользователи - при обновлении снимка.
+    """
+
+    def __init__(self, snapshot, model, previous=None):
+        self.snapshot = snapshot
+        self.model = model
+
+        # Центроиды в порядке столбцов снимка; аспекты,
+        # появившиеся после обучения, получают нулевые координаты
+        known = np.isin(model.aspect_ids, snapshot.aspect_ids)
+        self.centroids = np.zeros(
+            (model.n_clusters, len(snapshot.aspect_ids)), dtype=np.float32
+        )
+        self.centroids[:, map_to_positions(
+            snapshot.aspect_ids, model.aspect_ids[known]
+        )] = model.centroids[:, known]
+
+        if (
+            previous is not None
+            and previous.model is model
+            and snapshot.retained is not None
+            and previous.snapshot.version == snapshot.version - 1
+        ):
+            retained = previous.labels[snapshot.retained]
+            self.labels = np.concatenate([
+                retained,
+                assign_clusters(
+                    snapshot.matrix[len(retained):], self.centroids
+                )
+            ])
+        else:
+            self.labels = assign_clusters(snapshot.matrix, self.centroids)
+
+        self.members = np.argsort(self.labels, kind='stable').astype(np.int32)
+        self.offsets = np.searchsorted(
+            self.labels[self.members], np.arange(model.n_clusters + 1)
+        )
+
+    @classmethod
+    def for_snapshot(cls, snapshot):
+        """
+        Возвращает индекс для снимка и текущей модели
+        или None, если модель еще не обучена.
+        """
+        model = IVFModel.current()
+        if model is None:
+            return None
+        # Индекс, построенный по прежней модели, строится заново
+        return snapshot.derived(
+            cls._build_next, lambda index: index.model is model
+        )
+
+    @classmethod
+    def _build_next(cls, snapshot):
+        """
+        Строит индекс по текущей модели. Кластеры переносятся
+        из индекса снимка, из которого этот получен исправлением
+        строк, если он построен по той же модели.
+        """
+        return cls(
+            snapshot,
+            IVFModel.current(),
+            previous=snapshot.previous(cls._build_next)
+        )
+
+    def search(self, user_id, threshold=None, limit=None, nprobe=None):
+        """
+        Поиск пользователей, наиболее совместимых с заданным,
+        среди участников nprobe ближайших кластеров.
+
+        :param user_id:   ID пользователя
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :param nprobe:    Количество просматриваемых кластеров
+                          (по умолчанию IVF_NPROBE)
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства
+        """
+        if nprobe is None:
+            nprobe = get_setting('IVF_NPROBE')
+
+        row = self.snapshot.row_of.get(user_id)
+        if row is None:
+            return []
+
+        vector = self.snapshot.matrix[row]
+        scores = np.asarray(normalize_rows(vector) @ self.centroids.T).ravel()
+        nprobe = min(nprobe, len(scores))
+        clusters = np.argpartition(-scores, nprobe - 1)[:nprobe]
+
+        rows = np.concatenate([
+            self.members[self.offsets[cluster]:self.offsets[cluster + 1]]
+            for cluster in clusters
+        ])
+        rows = rows[rows != row]
+
+        return rank_matches(
+            self.snapshot.user_ids[rows],
+            self.snapshot.similarities(vector, rows),
+            threshold,
+            limit
+        )
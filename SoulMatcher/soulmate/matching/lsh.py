@@ -0,0 +1,218 @@
+import itertools
+import math
+
+import numpy as np
+
+from .conf import get_setting, threshold_similarity
+from .ranking import rank_matches
+
+# Количество единичных битов в каждом значении байта
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Количество строк, проецируемых на гиперплоскости за один шаг
+PROJECTION_BLOCK_SIZE = 65536
+
+
+def aspect_hyperplanes(aspect_ids, n_bits, seed):
+    """
+    Возвращает случайные гиперплоскости для столбцов аспектов.
+
+    Столбец каждого аспекта зависит только от его ID и seed,
+    поэтому при появлении новых аспектов сигнатуры существующих
+    пользователей не меняются, а все процессы получают одинаковые
+    гиперплоскости.
+
+    :return: Матрица float32 размера n_bits x количество аспектов
+    """
+    hyperplanes = np.empty((n_bits, len(aspect_ids)), dtype=np.float32)
+    for column, aspect_id in enumerate(aspect_ids.tolist()):
+        rng = np.random.default_rng([seed, aspect_id])
+        hyperplanes[:, column] = rng.standard_normal(n_bits)
+    return hyperplanes
+
+
+class LSHIndex:
+    """
+    Индекс приближенного поиска ближайших соседей
+    на основе случайных гиперплоскостей (SimHash).
+
+    Для каждого пользователя хранится сигнатура из n_bits знаков
+    проекций его вектора на случайные гиперплоскости, упакованная
+    в массив байт. Доля различающихся битов двух сигнатур оценивает
+    угол между векторами, поэтому кандидаты набираются из корзин
+    по полосам сигнатуры (с многозондовым перебором соседних корзин
+    на расстоянии Хэмминга до probe_radius внутри полосы),
+    отсеиваются по расстоянию Хэмминга всей сигнатуры
+    и только затем переранжируются точным косинусным сходством.
+    """
+
+    def __init__(self, snapshot, n_bits=None, n_bands=None,
+                 probe_radius=None, seed=None, previous=None):
+        self.snapshot = snapshot
+        self.n_bits = n_bits or get_setting('LSH_BITS')
+        self.n_bands = n_bands or get_setting('LSH_BANDS')
+        self.probe_radius = (
+            get_setting('LSH_PROBE_RADIUS')
+            if probe_radius is None else probe_radius
+        )
+        self.seed = get_setting('LSH_SEED') if seed is None else seed
+
+        if self.n_bits % 8 or self.n_bits % self.n_bands:
+            raise ValueError(
+                'LSH_BITS must be a multiple of 8 and of LSH_BANDS'
+            )
+        self.band_width = self.n_bits // self.n_bands
+        if self.band_width > 32:
+            raise ValueError('LSH band width must not exceed 32 bits')
+
+        if previous is not None and self._is_compatible(previous):
+            self._extend(previous)
+        else:
+            self.hyperplanes = aspect_hyperplanes(
+                snapshot.aspect_ids, self.n_bits, self.seed
+            )
+            self.signatures = self._sign(snapshot.matrix)
+
+        self._build_buckets()
+
+    @classmethod
+    def for_snapshot(cls, snapshot):
+        """
+        Возвращает индекс для снимка. Если индекс построен для снимка,
+        из которого этот получен исправлением строк, сигнатуры
+        вычисляются заново только для изменившихся пользователей.
+        """
+        return snapshot.derived(cls._build_next)
+
+    @classmethod
+    def _build_next(cls, snapshot):
+        return cls(snapshot, previous=snapshot.previous(cls._build_next))
+
+    def _is_compatible(self, previous):
+        return (
+            self.snapshot.retained is not None
+            and previous.snapshot.version == self.snapshot.version - 1
+            and (previous.n_bits, previous.seed) == (self.n_bits, self.seed)
+        )
+
+    def _extend(self, previous):
+        """
+        Переносит сигнатуры неизменившихся пользователей
+        из предыдущего индекса и вычисляет недостающие.
+        """
+        known = previous.hyperplanes.shape[1]
+        self.hyperplanes = np.hstack([
+            previous.hyperplanes,
+            aspect_hyperplanes(
+                self.snapshot.aspect_ids[known:], self.n_bits, self.seed
+            )
+        ])
+
+        retained = previous.signatures[self.snapshot.retained]
+        added = self._sign(self.snapshot.matrix[len(retained):])
+        self.signatures = np.vstack([retained, added])
+
+    def _sign(self, matrix):
+        """
+        Вычисляет упакованные сигнатуры строк матрицы.
+        """
+        blocks = [np.empty((0, self.n_bits // 8), dtype=np.uint8)]
+        for start in range(0, matrix.shape[0], PROJECTION_BLOCK_SIZE):
+            block = matrix[start:start + PROJECTION_BLOCK_SIZE]
+            projections = block @ self.hyperplanes.T
+            blocks.append(np.packbits(np.asarray(projections) > 0, axis=1))
+        return np.vstack(blocks)
+
+    def _build_buckets(self):
+        """
+        Раскладывает пользователей по корзинам каждой полосы:
+        ключ корзины - биты сигнатуры, попавшие в полосу.
+        """
+        bits = np.unpackbits(self.signatures, axis=1).reshape(
+            len(self.signatures), self.n_bands, self.band_width
+        )
+        powers = np.left_shift(
+            1, np.arange(self.band_width, dtype=np.int64)
+        )
+        self.band_keys = (bits.astype(np.int64) @ powers).astype(np.uint32)
+
+        self.bucket_rows = np.argsort(
+            self.band_keys, axis=0, kind='stable'
+        ).astype(np.int32).T
+        self.bucket_keys = np.take_along_axis(
+            self.band_keys.T, self.bucket_rows.astype(np.int64), axis=1
+        )
+
+        self.probe_masks = np.array([
+            sum(1 << bit for bit in flipped)
+            for radius in range(self.probe_radius + 1)
+            for flipped in itertools.combinations(
+                range(self.band_width), radius
+            )
+        ], dtype=np.uint32)
+
+    def max_hamming(self, threshold):
+        """
+        Допустимое расстояние Хэмминга для кандидата.
+
+        Для векторов с углом theta вероятность различия бита равна
+        theta / pi. Берется ожидаемое расстояние для угла, отвечающего
+        порогу совместимости, плюс два стандартных отклонения.
+        """
+        override = get_setting('LSH_MAX_HAMMING')
+        if override is not None:
+            return override
+
+        similarity = min(max(threshold_similarity(threshold), -1), 1)
+        probability = math.acos(similarity) / math.pi
+        spread = math.sqrt(self.n_bits * probability * (1 - probability))
+        return self.n_bits * probability + 2 * spread
+
+    def candidates(self, row, threshold):
+        """
+        Набирает строки кандидатов из корзин всех полос
+        и отсеивает их по расстоянию Хэмминга сигнатур.
+        """
+        ranges = [np.empty(0, dtype=np.int32)]
+        for band in range(self.n_bands):
+            probes = self.band_keys[row, band] ^ self.probe_masks
+            keys = self.bucket_keys[band]
+            starts = np.searchsorted(keys, probes, side='left')
+            ends = np.searchsorted(keys, probes, side='right')
+            ranges.extend(
+                self.bucket_rows[band, start:end]
+                for start, end in zip(starts, ends) if end > start
+            )
+
+        rows = np.unique(np.concatenate(ranges))
+        rows = rows[rows != row]
+
+        distances = POPCOUNT[
+            self.signatures[rows] ^ self.signatures[row]
+        ].sum(axis=1)
+        return rows[distances <= self.max_hamming(threshold)]
+
+    def search(self, user_id, threshold=None, limit=None):
+        """
+        Приближенный поиск пользователей, наиболее совместимых с заданным.
+
+        :param user_id:   ID пользователя
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства
+        """
+        if threshold is None:
+            threshold = get_setting('COMPATIBILITY_THRESHOLD')
+
+        row = self.snapshot.row_of.get(user_id)
+        if row is None:
+            return []
+
+        rows = self.candidates(row, threshold)
+        return rank_matches(
+            self.snapshot.user_ids[rows],
+            self.snapshot.similarities(self.snapshot.matrix[row], rows),
+            threshold,
+            limit
+        )
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+
+from ..database import replica_reads
+from ..models import CustomUser
+from .conf import get_setting
+
+
+def display_name(first_name, last_name, username):
+    """
+    Возвращает имя пользователя для выдачи.
+    Если first_name и last_name отсутствуют, возвращает username.
+    """
+    return f"{first_name} {last_name}".strip() or username
+
+
+class DisplayNameCache:
+    """
+    Ограниченный LRU-кэш имен пользователей текущего процесса.
+
+    Имена пользователей из выдачи, которых нет в кэше, загружаются
+    одним запросом. Запись пользователя удаляется из кэша сигналами
+    при сохранении и удалении пользователя.
+    """
+
+    def __init__(self):
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+        # Счетчик сбросов: имена, загруженные до сброса,
+        # в кэш не сохраняются
+        self._generation = 0
+
+    def get_many(self, user_ids, store=True):
+        """
+        Возвращает имена пользователей.
+
+        :param user_ids: Список ID пользователей
+        :param store:    Сохранять загруженные имена в кэше
+                         (при выгрузке всей выдачи не сохраняются,
+                         чтобы не вытеснять часто запрашиваемые)
+        :return:         Словарь ID пользователя -> имя
+                         (несуществующие пользователи пропускаются)
+        """
+        names = {}
+        with self._lock:
+            generation = self._generation
+            for user_id in user_ids:
+                if user_id in self._names:
+                    self._names.move_to_end(user_id)
+                    names[user_id] = self._names[user_id]
+
+        missing = [user_id for user_id in user_ids if user_id not in names]
+        if missing:
+            with replica_reads():
+                loaded = {
+                    user_id: display_name(first_name, last_name, username)
+                    for user_id, first_name, last_name, username
+                    in CustomUser.objects.filter(id__in=missing).values_list(
+                        'id', 'first_name', 'last_name', 'username'
+                    )
+                }
+            names.update(loaded)
+            if store:
+                self._store(loaded, generation)
+        return names
+
+    def _store(self, names, generation):
+        max_size = get_setting('NAME_CACHE_SIZE')
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._names.update(names)
+            while len(self._names) > max_size:
+                self._names.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._names.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._names.clear()
+
+
+display_names = DisplayNameCache()
@@ -0,0 +1,532 @@
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from ..database import replica_reads
+from ..models import CompatibleNeighbor, MutualMatch, NeighborList
+from .batch import batch_search
+from .conf import get_setting, threshold_similarity, to_percentage
+from .data import QUERY_CHUNK_SIZE, load_signed_weights
+from .engine import MatchingSnapshot
+from .inverted import InvertedIndex
+from .ranking import SIMILARITY_DECIMALS
+
+# Снимок, доступный процессам пула после fork
+_worker_snapshot = None
+
+
+def _init_worker(snapshot):
+    global _worker_snapshot
+    _worker_snapshot = snapshot
+
+
+def _score_block(user_ids, threshold, top):
+    return batch_search(_worker_snapshot, user_ids, threshold, top)
+
+
+def chunked(values):
+    """
+    Делит ID на части для условий __in.
+    """
+    values = list(values)
+    for start in range(0, len(values), QUERY_CHUNK_SIZE):
+        yield values[start:start + QUERY_CHUNK_SIZE]
+
+
+def compute_neighbor_lists(snapshot, threshold, top, workers, block_size):
+    """
+    Вычисляет списки совместимых пользователей для всех пользователей
+    снимка попарным блочным сравнением.
+
+    Пользователи делятся на блоки по block_size строк, блоки
+    обрабатываются пулом процессов (пакетным поиском), и в обработке
+    одновременно находится не больше двух блоков на процесс, поэтому
+    пиковая память ограничена размером блока, а не числом пользователей.
+    Процессы создаются через fork и получают снимок без копирования.
+
+    :param snapshot:   Снимок приоритетов
+    :param threshold:  Минимальный процент совместимости
+    :param top:        Количество совместимых пользователей в списке
+    :param workers:    Количество процессов
+    :param block_size: Количество пользователей в блоке
+    :return:           Генератор словарей ID пользователя -> список пар
+                       (ID пользователя, сходство), по одному на блок
+    """
+    user_ids = snapshot.user_ids[snapshot.norms > 0].tolist()
+    blocks = [
+        user_ids[start:start + block_size]
+        for start in range(0, len(user_ids), block_size)
+    ]
+
+    if workers <= 1:
+        for block in blocks:
+            yield batch_search(snapshot, block, threshold, top)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_worker,
+        initargs=(snapshot,)
+    ) as executor:
+        pending = []
+        for block in blocks:
+            pending.append(
+                executor.submit(_score_block, block, threshold, top)
+            )
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def store_neighbor_lists(results, top, computed_at, batch_size=5000,
+                         keep_newer=False):
+    """
+    Заменяет сохраненные списки совместимых пользователей.
+
+    Списки каждого пользователя заменяются в одной транзакции,
+    поэтому читатели видят либо старый, либо новый список целиком.
+
+    :param results:     Словарь ID пользователя -> список пар
+                        (ID пользователя, сходство)
+    :param top:         Максимальная длина списков
+    :param computed_at: Время вычисления списков
+    :param batch_size:  Размер пакета массовой вставки
+    :param keep_newer:  Не заменять списки, вычисленные позже
+                        computed_at (исправленные на месте
+                        после изменения приоритетов)
+    """
+    with transaction.atomic():
+        if keep_newer:
+            newer = set()
+            for chunk in chunked(results):
+                newer.update(NeighborList.objects.filter(
+                    user_id__in=chunk, computed_at__gt=computed_at
+                ).values_list('user_id', flat=True))
+            results = {
+                user_id: matches for user_id, matches in results.items()
+                if user_id not in newer
+            }
+
+        user_ids = list(results)
+        neighbors = [
+            CompatibleNeighbor(
+                user_id=user_id,
+                neighbor_id=neighbor_id,
+                similarity=similarity,
+                rank=rank
+            )
+            for user_id, matches in results.items()
+            for rank, (neighbor_id, similarity) in enumerate(matches, start=1)
+        ]
+
+        for chunk in chunked(user_ids):
+            CompatibleNeighbor.objects.filter(user_id__in=chunk).delete()
+        CompatibleNeighbor.objects.bulk_create(neighbors, batch_size=batch_size)
+        NeighborList.objects.bulk_create(
+            [
+                NeighborList(user_id=user_id, computed_at=computed_at, top=top)
+                for user_id in user_ids
+            ],
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['computed_at', 'top']
+        )
+
+
+def remove_stale_neighbor_lists(computed_at):
+    """
+    Удаляет списки, не обновленные при вычислении в момент computed_at
+    (пользователи, у которых больше нет приоритетов,
+    и списки, признанные устаревшими во время вычисления).
+    Списки, исправленные на месте во время вычисления, сохраняются.
+    """
+    with transaction.atomic():
+        NeighborList.objects.filter(computed_at__lt=computed_at).delete()
+        CompatibleNeighbor.objects.exclude(
+            user__neighbor_list__computed_at__gte=computed_at
+        ).delete()
+
+
+def changed_user_ids(old, new):
+    """
+    Находит пользователей, чьи веса различаются в двух снимках
+    (в том числе появившихся и удаленных).
+
+    :param old: Снимок приоритетов
+    :param new: Более поздний снимок приоритетов
+    :return:    Множество ID пользователей
+    """
+    def weights(snapshot):
+        matrix = snapshot.matrix.tocoo()
+        present = matrix.data != 0
+        return np.rec.fromarrays([
+            snapshot.user_ids[matrix.row[present]],
+            snapshot.aspect_ids[matrix.col[present]],
+            matrix.data[present]
+        ], names='user,aspect,weight')
+
+    # Каждая пара (пользователь, аспект) входит в снимок один раз,
+    # поэтому совпадающие веса встречаются ровно дважды
+    unique, counts = np.unique(
+        np.concatenate([weights(old), weights(new)]), return_counts=True
+    )
+    return set(unique['user'][counts == 1].tolist())
+
+
+def refresh_changed_neighbor_lists(snapshot):
+    """
+    Исправляет списки после изменения приоритетов во время
+    вычисления по снимку snapshot: блоки, вычисленные по снимку,
+    могли заменить списки, исправленные на месте, и не учитывают
+    изменений после его построения. Изменившиеся пользователи
+    находятся сравнением снимка с заново построенным снимком,
+    и их списки и списки, куда они входят, исправляются
+    как после изменения приоритетов (update_neighbor_lists).
+
+    :param snapshot: Снимок, по которому вычислялись списки
+    :return:         Количество изменившихся пользователей
+    """
+    fresh = MatchingSnapshot.from_weights(*load_signed_weights())
+    changed = changed_user_ids(snapshot, fresh)
+    if changed:
+        update_neighbor_lists(fresh, changed, neighbor_list_holders(changed))
+    return len(changed)
+
+
+def invalidate_neighbor_lists(user_ids, holders=()):
+    """
+    Помечает устаревшими списки пользователей с измененными
+    приоритетами и списки, в которых эти пользователи находятся:
+    до следующего вычисления совместимые пользователи ищутся на лету.
+
+    :param user_ids: ID пользователей с измененными приоритетами
+    :param holders:  ID пользователей, в списках которых измененные
+                     пользователи находились до изменения (записи
+                     удаленных пользователей удаляются каскадно)
+    """
+    for chunk in chunked(user_ids):
+        NeighborList.objects.filter(
+            Q(user_id__in=chunk)
+            | Q(user_id__in=CompatibleNeighbor.objects.filter(
+                neighbor_id__in=chunk
+            ).values('user_id'))
+        ).delete()
+    for chunk in chunked(holders):
+        NeighborList.objects.filter(user_id__in=chunk).delete()
+
+
+def invalidate_all_neighbor_lists():
+    """
+    Помечает устаревшими все списки до следующего вычисления.
+    """
+    NeighborList.objects.all().delete()
+
+
+def neighbor_list_holders(user_ids):
+    """
+    Возвращает ID пользователей, в сохраненных списках
+    которых находятся заданные пользователи.
+    """
+    holders = set()
+    for chunk in chunked(user_ids):
+        holders.update(CompatibleNeighbor.objects.filter(
+            neighbor_id__in=chunk
+        ).values_list('user_id', flat=True))
+    return holders
+
+
+def load_neighbor_lists(user_ids):
+    """
+    Загружает сохраненные списки пользователей.
+
+    :param user_ids: ID пользователей
+    :return:         Словарь ID пользователя -> кортеж (максимальная
+                     длина списка, список пар (ID пользователя, сходство));
+                     пользователи без списка в словарь не входят
+    """
+    lists = {}
+    for chunk in chunked(user_ids):
+        for user_id, top in NeighborList.objects.filter(
+            user_id__in=chunk
+        ).values_list('user_id', 'top'):
+            lists[user_id] = (top, [])
+
+        for user_id, neighbor_id, similarity in CompatibleNeighbor.objects.filter(
+            user_id__in=chunk
+        ).order_by('user_id', 'rank').values_list(
+            'user_id', 'neighbor_id', 'similarity'
+        ):
+            if user_id in lists:
+                lists[user_id][1].append((neighbor_id, similarity))
+    return lists
+
+
+def ranking_key(match):
+    """
+    Порядок выдачи: по убыванию сходства, при равенстве - по ID.
+    """
+    neighbor_id, similarity = match
+    return -similarity, neighbor_id
+
+
+def entering_similarities(snapshot, user_ids, threshold):
+    """
+    Вычисляет сходства измененных пользователей с пользователями,
+    которые могут включить их в свои списки.
+
+    Сходство выше порога возможно только при общем аспекте,
+    поэтому пересчитываются лишь пользователи из списков вхождений
+    аспектов измененного пользователя (при пороге не выше 50%
+    под него подходят и пользователи без общих аспектов,
+    и тогда пересчитываются все).
+
+    :return: Словарь ID пользователя -> словарь
+             ID измененного пользователя -> сходство
+    """
+    index = InvertedIndex.for_snapshot(snapshot)
+    scan_all = threshold_similarity(threshold) <= 0
+
+    entering = defaultdict(dict)
+    for user_id in user_ids:
+        row = snapshot.row_of[user_id]
+        vector = snapshot.matrix[row]
+        if scan_all:
+            rows = np.arange(len(snapshot.user_ids))
+        else:
+            rows = np.unique(np.concatenate([
+                index.postings(column)[0] for column in vector.indices
+            ]))
+        rows = rows[(rows != row) & (snapshot.norms[rows] > 0)]
+
+        similarities = np.round(
+            snapshot.similarities(vector, rows), SIMILARITY_DECIMALS
+        )
+        keep = to_percentage(similarities) >= threshold
+        for neighbor_id, similarity in zip(
+            snapshot.user_ids[rows[keep]].tolist(),
+            similarities[keep].tolist()
+        ):
+            entering[neighbor_id][user_id] = similarity
+    return entering
+
+
+def search_by_top(snapshot, tops, threshold):
+    """
+    Вычисляет списки пакетным поиском, группируя пользователей
+    по максимальной длине списка.
+
+    :param tops: Словарь ID пользователя -> максимальная длина списка
+    :return:     Словарь максимальная длина -> результат batch_search
+    """
+    groups = defaultdict(list)
+    for user_id, top in tops.items():
+        groups[top].append(user_id)
+    return {
+        top: batch_search(snapshot, user_ids, threshold, top)
+        for top, user_ids in groups.items()
+    }
+
+
+def update_neighbor_lists(snapshot, user_ids, holders=()):
+    """
+    Обновляет сохраненные списки после изменения приоритетов
+    пользователей без полного пересчета.
+
+    Список измененного пользователя вычисляется заново. В списках
+    остальных пользователей меняются только сходства с измененными
+    пользователями, поэтому эти списки исправляются на месте:
+    измененные пользователи удаляются из них и вставляются заново
+    с новым сходством, если проходят порог. Заново вычисляется
+    только полный список, из которого измененный пользователь
+    выбыл или опустился ниже последнего места, так как следующий
+    за последним пользователь в сохраненном списке неизвестен.
+
+    :param snapshot: Снимок, отражающий изменения
+    :param user_ids: ID пользователей с измененными приоритетами
+    :param holders:  ID пользователей, в списках которых измененные
+                     пользователи находились до изменения
+    """
+    threshold = get_setting('COMPATIBILITY_THRESHOLD')
+    default_top = get_setting('COMPATIBLE_USERS_LIMIT')
+    computed_at = timezone.now()
+    changed = set(user_ids)
+
+    stored = load_neighbor_lists(changed)
+    recompute = {
+        user_id: stored[user_id][0] if user_id in stored else default_top
+        for user_id in changed if snapshot.has_priorities(user_id)
+    }
+    removed = changed - set(recompute)
+
+    entering = entering_similarities(snapshot, recompute, threshold)
+    affected = (set(entering) | set(holders)) - changed
+
+    updates = defaultdict(dict)
+    for user_id, (top, old) in load_neighbor_lists(affected).items():
+        merged = [match for match in old if match[0] not in changed]
+        if user_id in holders and len(merged) == len(old):
+            # Измененный пользователь удален вместе со своими записями,
+            # и неизвестно, был ли список полным
+            recompute[user_id] = top
+            continue
+
+        merged.extend(entering.get(user_id, {}).items())
+        merged = sorted(merged, key=ranking_key)[:top]
+
+        if len(old) >= top and (
+            len(merged) < top
+            or ranking_key(merged[-1]) > ranking_key(old[-1])
+        ):
+            recompute[user_id] = top
+        elif merged != old:
+            updates[top][user_id] = merged
+
+    for top, results in search_by_top(snapshot, recompute, threshold).items():
+        for user_id, matches in results.items():
+            if matches is None:
+                removed.add(user_id)
+            else:
+                updates[top][user_id] = matches
+
+    with transaction.atomic():
+        for chunk in chunked(removed):
+            NeighborList.objects.filter(user_id__in=chunk).delete()
+            CompatibleNeighbor.objects.filter(user_id__in=chunk).delete()
+        for top, results in updates.items():
+            store_neighbor_lists(results, top, computed_at)
+        refresh_mutual_matches(
+            removed.union(*(results.keys() for results in updates.values()))
+        )
+
+
+@replica_reads()
+def get_neighbor_list(user_id, fresh_since, limit):
+    """
+    Возвращает предвычисленный список совместимых пользователей,
+    если он вычислен не раньше fresh_since.
+
+    :param user_id:     ID пользователя
+    :param fresh_since: Минимальное допустимое время вычисления
+    :param limit:       Максимальное количество результатов
+    :return:            Кортеж (время вычисления, список пар
+                        (ID пользователя, сходство)) или None
+    """
+    neighbor_list = NeighborList.objects.filter(
+        user_id=user_id, computed_at__gte=fresh_since
+    ).first()
+    if neighbor_list is None:
+        return None
+
+    matches = CompatibleNeighbor.objects.filter(
+        user_id=user_id
+    ).order_by('rank').values_list('neighbor_id', 'similarity')[:limit]
+    return neighbor_list.computed_at, list(matches)
+
+
+def mutual_pairs(neighbors):
+    """
+    Отбирает записи списков, пользователь которых находится
+    и в списке своего соседа.
+
+    :param neighbors: Запрос записей CompatibleNeighbor
+    :return:          Генератор объектов MutualMatch
+    """
+    reverse = CompatibleNeighbor.objects.filter(
+        user_id=OuterRef('neighbor_id'), neighbor_id=OuterRef('user_id')
+    )
+    for user_id, neighbor_id, similarity in neighbors.filter(
+        Exists(reverse)
+    ).values_list('user_id', 'neighbor_id', 'similarity').iterator():
+        yield MutualMatch(
+            user_low_id=min(user_id, neighbor_id),
+            user_high_id=max(user_id, neighbor_id),
+            similarity=similarity
+        )
+
+
+def store_mutual_matches(matches, batch_size=5000):
+    """
+    Сохраняет пары пакетами, пропуская уже сохраненные.
+    """
+    batch = []
+    for match in matches:
+        batch.append(match)
+        if len(batch) >= batch_size:
+            MutualMatch.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    MutualMatch.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def rebuild_mutual_matches():
+    """
+    Заново строит пары взаимно совместимых пользователей
+    по всем сохраненным спискам: пара - это пересечение прямого
+    и обратного списков, каждая пара берется один раз,
+    из списка пользователя с меньшим ID.
+
+    :return: Количество пар
+    """
+    with transaction.atomic():
+        MutualMatch.objects.all().delete()
+        store_mutual_matches(mutual_pairs(
+            CompatibleNeighbor.objects.filter(user_id__lt=F('neighbor_id'))
+        ))
+        return MutualMatch.objects.count()
+
+
+def refresh_mutual_matches(user_ids):
+    """
+    Пересчитывает пары взаимно совместимых пользователей
+    с участием пользователей, чьи списки изменились или удалены.
+
+    :param user_ids: ID пользователей
+    """
+    with transaction.atomic():
+        for chunk in chunked(user_ids):
+            MutualMatch.objects.filter(
+                Q(user_low_id__in=chunk) | Q(user_high_id__in=chunk)
+            ).delete()
+        for chunk in chunked(user_ids):
+            store_mutual_matches(mutual_pairs(
+                CompatibleNeighbor.objects.filter(user_id__in=chunk)
+            ))
+
+
+@replica_reads()
+def get_mutual_matches(user_id, fresh_since, limit):
+    """
+    Возвращает взаимно совместимых пользователей из предвычисленных
+    пар, если список пользователя вычислен не раньше fresh_since.
+
+    Пара пропадает вместе со списком любого из пользователей:
+    при изменении приоритетов списки, содержащие измененного
+    пользователя, исправляются или удаляются вместе с его списком,
+    поэтому достаточно проверить свежесть списка самого пользователя.
+
+    :param user_id:     ID пользователя
+    :param fresh_since: Минимальное допустимое время вычисления
+    :param limit:       Максимальное количество результатов
+    :return:            Кортеж (время вычисления, список пар
+                        (ID пользователя, сходство)) или None
+    """
+    neighbor_list = NeighborList.objects.filter(
+        user_id=user_id, computed_at__gte=fresh_since
+    ).first()
+    if neighbor_list is None:
+        return None
+
+    matches = [
+        (user_high_id if user_low_id == user_id else user_low_id, similarity)
+        for user_low_id, user_high_id, similarity in MutualMatch.objects.filter(
+            Q(user_low_id=user_id) | Q(user_high_id=user_id)
+        ).values_list('user_low_id', 'user_high_id', 'similarity')
+    ]
+    return neighbor_list.computed_at, sorted(matches, key=ranking_key)[:limit]
@@ -0,0 +1,50 @@
+import numpy as np
+
+from .conf import get_setting, to_percentage
+
+# Сходства округляются, чтобы разные способы вычисления,
+# отличающиеся лишь ошибками округления, давали одинаковый порядок
+SIMILARITY_DECIMALS = 12
+
+
+def rank_matches(user_ids, similarities, threshold=None, limit=None):
+    """
+    Отбирает лучших кандидатов по косинусному сходству.
+
+    Кандидаты с процентом совместимости ниже порога отбрасываются,
+    оставшиеся сортируются по убыванию сходства, а при равенстве -
+    по возрастанию ID, что делает порядок выдачи детерминированным.
+
+    :param user_ids:     Массив ID кандидатов
+    :param similarities: Массив косинусных сходств кандидатов
+    :param threshold:    Минимальный процент совместимости
+                         (по умолчанию COMPATIBILITY_THRESHOLD)
+    :param limit:        Максимальное количество результатов
+                         (по умолчанию COMPATIBLE_USERS_LIMIT)
+    :return:             Список пар (ID пользователя, сходство)
+    """
+    if threshold is None:
+        threshold = get_setting('COMPATIBILITY_THRESHOLD')
+    if limit is None:
+        limit = get_setting('COMPATIBLE_USERS_LIMIT')
+
+    user_ids = np.asarray(user_ids)
+    similarities = np.round(
+        np.asarray(similarities, dtype=np.float64), SIMILARITY_DECIMALS
+    )
+
+    mask = to_percentage(similarities) >= threshold
+    user_ids, similarities = user_ids[mask], similarities[mask]
+
+    # Перед полной сортировкой отсекаем кандидатов хуже limit-го,
+    # сохраняя всех, чье сходство равно пограничному
+    if len(similarities) > limit > 0:
+        boundary = np.partition(-similarities, limit - 1)[limit - 1]
+        mask = -similarities <= boundary
+        user_ids, similarities = user_ids[mask], similarities[mask]
+
+    order = np.lexsort((user_ids, -similarities))[:limit]
+    return [
+        (int(user_ids[i]), float(similarities[i]))
+        for i in order
+    ]
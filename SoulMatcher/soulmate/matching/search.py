@@ -0,0 +1,222 @@
+from .batch import batch_search
+from .conf import get_setting
+from .data import load_signed_weights
+from .engine import deduplicate_weights, get_engine
+from .inverted import InvertedIndex
+from .ivf import IVFIndex
+from .lsh import LSHIndex
+from .sharded import ShardPool
+from .sql import sql_search
+from .tiered import tiered_store
+from .vector_store import VectorStore
+
+
+def exact_search(user_id, threshold=None, limit=None):
+    """
+    Точный поиск: сходство с каждым пользователем вычисляется
+    одним произведением разреженной строки на матрицу снимка.
+    """
+    snapshot = get_engine().snapshot()
+    if not snapshot.has_priorities(user_id):
+        return None
+    return snapshot.search(user_id, threshold, limit)
+
+
+def inverted_search(user_id, threshold=None, limit=None):
+    """
+    Точный поиск по инвертированному индексу аспектов
+    с отсечением кандидатов, не способных попасть в выдачу.
+    """
+    snapshot = get_engine().snapshot()
+    if not snapshot.has_priorities(user_id):
+        return None
+    return InvertedIndex.for_snapshot(snapshot).search(
+        user_id, threshold, limit
+    )
+
+
+def lsh_search(user_id, threshold=None, limit=None):
+    """
+    Приближенный поиск: кандидаты набираются по сигнатурам LSH
+    и переранжируются точным косинусным сходством.
+    """
+    snapshot = get_engine().snapshot()
+    if not snapshot.has_priorities(user_id):
+        return None
+    return LSHIndex.for_snapshot(snapshot).search(user_id, threshold, limit)
+
+
+def ivf_search(user_id, threshold=None, limit=None):
+    """
+    Поиск среди участников ближайших кластеров k-means.
+    Пока модель кластеров не обучена, выполняется точный поиск.
+    """
+    snapshot = get_engine().snapshot()
+    if not snapshot.has_priorities(user_id):
+        return None
+
+    index = IVFIndex.for_snapshot(snapshot)
+    if index is None:
+        return snapshot.search(user_id, threshold, limit)
+    return index.search(user_id, threshold, limit)
+
+
+def mmap_search(user_id, threshold=None, limit=None):
+    """
+    Поиск по общему для всех процессов файлу векторов,
+    отображенному в память. Вектор самого пользователя читается
+    из БД, остальные - из файла на момент его построения.
+    Пока файл не построен, выполняется поиск запросом к БД,
+    чтобы процесс не строил резидентную матрицу.
+    """
+    store = VectorStore.current()
+    if store is None:
+        return sql_search(user_id, threshold, limit)
+
+    _, aspects, weights = deduplicate_weights(*load_signed_weights([user_id]))
+    if not weights.any():
+        return None
+    return store.search(user_id, aspects, weights, threshold, limit)
+
+
+def sharded_search(user_id, threshold=None, limit=None):
+    """
+    Точный поиск, разделенный между процессами шардов:
+    каждый шард ищет среди своих пользователей, а результаты
+    сливаются в общую выдачу. Процесс запроса резидентного
+    снимка не строит: шарды загружают срезы из БД, а вектор
+    пользователя читается из БД.
+    """
+    return ShardPool.get().search(user_id, threshold, limit)
+
+
+def tiered_search(user_id, threshold=None, limit=None):
+    """
+    Поиск по двум уровням векторов: недавно активные пользователи
+    сравниваются по горячему уровню в памяти процесса, остальные -
+    по файлу векторов, отображенному в память. Вектор самого
+    пользователя читается из горячего уровня или из БД.
+    Пока файл не построен, выполняется поиск запросом к БД,
+    чтобы процесс не строил резидентную матрицу.
+    """
+    store = VectorStore.current()
+    if store is None:
+        return sql_search(user_id, threshold, limit)
+    return tiered_store.search(store, user_id, threshold, limit)
+
+
+# Способы поиска, обращающиеся к БД при каждом запросе
+DATABASE_MODES = frozenset({'sql', 'mmap', 'sharded', 'tiered'})
+
+# Способы поиска по резидентному снимку движка подбора
+ENGINE_MODES = frozenset({'exact', 'inverted', 'lsh', 'ivf'})
+
+SEARCH_MODES = {
+    'exact': exact_search,
+    'inverted': inverted_search,
+    'lsh': lsh_search,
+    'ivf': ivf_search,
+    'sql': sql_search,
+    'mmap': mmap_search,
+    'sharded': sharded_search,
+    'tiered': tiered_search,
+}
+
+
+def find_compatible_users(user_id, mode=None, threshold=None, limit=None):
+    """
+    Ищет совместимых пользователей выбранным способом.
+
+    :param user_id:   ID пользователя
+    :param mode:      Способ поиска из SEARCH_MODES
+                      (по умолчанию настройка SEARCH_MODE)
+    :param threshold: Минимальный процент совместимости
+    :param limit:     Максимальное количество результатов
+    :return:          Список пар (ID пользователя, сходство)
+                      в порядке убывания сходства или None,
+                      если у пользователя нет приоритетов
+    """
+    if mode is None:
+        mode = get_setting('SEARCH_MODE')
+    return SEARCH_MODES[mode](user_id, threshold, limit)
+
+
+def find_compatible_users_batch(user_ids, mode=None, threshold=None, limit=None):
+    """
+    Ищет совместимых пользователей сразу для многих пользователей:
+    при способе поиска по снимку движка - одним пакетным поиском
+    по снимку, иначе - отдельным поиском выбранным способом
+    для каждого пользователя, чтобы не строить снимок.
+
+    :param user_ids:  Список ID пользователей
+    :param mode:      Способ поиска из SEARCH_MODES
+                      (по умолчанию настройка SEARCH_MODE)
+    :param threshold: Минимальный процент совместимости
+    :param limit:     Максимальное количество результатов
+                      на пользователя
+    :return:          Словарь ID пользователя -> список пар
+                      (ID пользователя, сходство) или None,
+                      если у пользователя нет приоритетов
+    """
+    if uses_engine(mode):
+        return batch_search(get_engine().snapshot(), user_ids, threshold, limit)
+    return {
+        user_id: find_compatible_users(user_id, mode, threshold, limit)
+        for user_id in dict.fromkeys(user_ids)
+    }
+
+
+def find_mutual_users(user_id, mode=None, threshold=None, limit=None):
+    """
+    Ищет взаимно совместимых пользователей на лету: пользователей
+    из выдачи, в выдаче которых находится и сам пользователь.
+    Обратные выдачи вычисляются find_compatible_users_batch.
+
+    :param user_id:   ID пользователя
+    :param mode:      Способ поиска прямой выдачи из SEARCH_MODES
+    :param threshold: Минимальный процент совместимости
+    :param limit:     Длина прямой и обратных выдач
+    :return:          Список пар (ID пользователя, сходство)
+                      в порядке убывания сходства или None,
+                      если у пользователя нет приоритетов
+    """
+    matches = find_compatible_users(user_id, mode, threshold, limit)
+    if matches is None:
+        return None
+
+    reverse = find_compatible_users_batch(
+        [match_id for match_id, _ in matches], mode, threshold, limit
+    )
+    return [
+        (match_id, similarity)
+        for match_id, similarity in matches
+        if any(
+            reverse_id == user_id
+            for reverse_id, _ in reverse[match_id] or ()
+        )
+    ]
+
+
+def uses_engine(mode=None):
+    """
+    Проверяет, ищет ли способ поиска по резидентному снимку движка
+    подбора. При остальных способах снимок строится только
+    при первом обращении к нему.
+
+    :param mode: Способ поиска из SEARCH_MODES
+                 (по умолчанию настройка SEARCH_MODE)
+    """
+    return (mode or get_setting('SEARCH_MODE')) in ENGINE_MODES
+
+
+def warm_up():
+    """
+    Отмечает процесс как обслуживающий запросы и строит снимок
+    движка до приема первых запросов, если способ поиска
+    по умолчанию ищет по нему.
+    """
+    engine = get_engine()
+    if uses_engine():
+        engine.warm_up()
+    else:
+        engine.serving = True
@@ -0,0 +1,328 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from .cache import get_data_changes, get_data_version
+from .conf import get_setting
+from .data import load_signed_weights
+from .engine import MatchingSnapshot, deduplicate_weights
+
+# Срез снимка, хранимый процессом шарда
+_shard_snapshot = MatchingSnapshot.empty()
+
+
+def _load(users, aspects, weights):
+    global _shard_snapshot
+    _shard_snapshot = MatchingSnapshot.from_weights(users, aspects, weights)
+
+
+def _update(user_ids, users, aspects, weights):
+    global _shard_snapshot
+    _shard_snapshot = _shard_snapshot.with_users(
+        user_ids, users, aspects, weights
+    )
+
+
+def _search(user_id, aspects, weights, threshold, limit):
+    return _shard_snapshot.search_vector(
+        user_id, aspects, weights, threshold, limit
+    )
+
+
+SHARD_COMMANDS = {
+    'load': _load,
+    'update': _update,
+    'search': _search,
+}
+
+
+def _serve_shard(connection):
+    """
+    Цикл процесса шарда: выполняет команды из канала по очереди
+    и отправляет обратно результат или исключение вместе
+    с ID запроса.
+    """
+    while True:
+        try:
+            request_id, command, args = connection.recv()
+        except EOFError:
+            return
+        if command is None:
+            return
+        try:
+            connection.send((request_id, True, SHARD_COMMANDS[command](*args)))
+        except Exception as error:
+            connection.send((request_id, False, error))
+
+
+class ShardPool:
+    """
+    Пул долгоживущих процессов, между которыми поделены пользователи.
+
+    Пользователь относится к шарду по остатку от деления ID на число
+    шардов, и каждый процесс хранит собственный снимок только своих
+    пользователей. Запрос рассылается всем шардам, каждый возвращает
+    свои лучшие limit результатов, и они сливаются кучей в общую
+    выдачу, поэтому задержка одного запроса делится между ядрами.
+
+    Родительский процесс снимка не хранит: срезы шардов читаются
+    из БД по одному и сразу пересылаются, а вектор пользователя
+    запроса читается из БД. Перед запросом шарды догоняют общую
+    версию данных (get_data_version): им пересылаются строки
+    пользователей, изменивших приоритеты (отмеченных сигналами
+    процесса и опубликованных другими процессами), а если изменения
+    неизвестны, срезы загружаются заново.
+
+    Каждое сообщение шарду несет ID запроса, а ответы разбираются
+    потоками-получателями, поэтому одновременно выполняются
+    несколько запросов: шард обрабатывает их по очереди, пока
+    остальные шарды заняты своими частями.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, shards):
+        context = multiprocessing.get_context('fork')
+        self.pid = os.getpid()
+        self.connections, self.processes = [], []
+        for _ in range(shards):
+            connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=_serve_shard, args=(child_connection,), daemon=True
+            )
+            process.start()
+            child_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+        # Версия данных, до которой синхронизированы шарды, или None
+        self.data_version = None
+        self.broken = False
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+        # (номер шарда, ID запроса) -> Future ответа шарда
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._send_locks = [threading.Lock() for _ in range(shards)]
+        self._receivers = [
+            threading.Thread(
+                target=self._receive,
+                args=(shard, connection),
+                name=f'soulmate-shard-{shard}',
+                daemon=True
+            )
+            for shard, connection in enumerate(self.connections)
+        ]
+        for receiver in self._receivers:
+            receiver.start()
+
+    @property
+    def shards(self):
+        return len(self.processes)
+
+    @classmethod
+    def get(cls):
+        """
+        Возвращает пул текущего процесса, запуская его при первом
+        обращении, после fork или гибели одного из процессов шардов.
+        """
+        shards = get_setting('SHARDS')
+        with cls._instance_lock:
+            pool = cls._instance
+            if pool is None or not pool.is_usable(shards):
+                if pool is not None and pool.pid == os.getpid():
+                    pool.close()
+                pool = cls._instance = cls(shards)
+            return pool
+
+    @classmethod
+    def shutdown(cls):
+        """
+        Останавливает пул текущего процесса.
+        """
+        with cls._instance_lock:
+            pool, cls._instance = cls._instance, None
+            if pool is not None and pool.pid == os.getpid():
+                pool.close()
+
+    @classmethod
+    def mark_dirty(cls, user_ids):
+        """
+        Помечает пользователей как изменивших приоритеты, если пул
+        текущего процесса запущен: их строки пересылаются шардам
+        перед следующим запросом.
+        """
+        pool = cls._instance
+        if pool is not None and pool.pid == os.getpid():
+            with pool._dirty_lock:
+                pool._dirty.update(user_ids)
+
+    def is_usable(self, shards):
+        return (
+            self.pid == os.getpid()
+            and not self.broken
+            and self.shards == shards
+            and all(process.is_alive() for process in self.processes)
+        )
+
+    def close(self):
+        for shard, connection in enumerate(self.connections):
+            try:
+                with self._send_locks[shard]:
+                    connection.send((None, None, ()))
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        # Процессы шардов завершены, и потоки-получатели получили
+        # конец канала: каналы закрываются, когда их никто не читает
+        for receiver in self._receivers:
+            receiver.join(timeout=5)
+        for connection in self.connections:
+            connection.close()
+
+    def _receive(self, shard, connection):
+        """
+        Цикл потока-получателя: передает ответы шарда ожидающим
+        их запросам. Если канал закрыт, пул помечается сломанным
+        и перезапускается при следующем обращении.
+        """
+        while True:
+            try:
+                request_id, ok, result = connection.recv()
+            except (EOFError, OSError):
+                self._fail(shard)
+                return
+            with self._pending_lock:
+                future = self._pending.pop((shard, request_id), None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def _fail(self, shard):
+        with self._pending_lock:
+            self.broken = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(EOFError(f'Shard {shard} connection closed'))
+
+    def _send(self, shard, request_id, command, *args):
+        """
+        Отправляет команду шарду.
+
+        :return: Future ответа шарда
+        """
+        future = Future()
+        with self._pending_lock:
+            if self.broken:
+                raise EOFError('Shard pool is broken')
+            self._pending[shard, request_id] = future
+        try:
+            with self._send_locks[shard]:
+                self.connections[shard].send((request_id, command, args))
+        except OSError:
+            self._fail(shard)
+            raise
+        return future
+
+    def _scatter(self, commands):
+        """
+        Отправляет шардам по команде одного запроса и собирает ответы.
+
+        :param commands: Итерируемый объект пар (команда, аргументы)
+                         по числу шардов; команда следующего шарда
+                         строится после отправки предыдущей
+        :return:         Список результатов в порядке шардов
+        """
+        request_id = next(self._request_ids)
+        futures = [
+            self._send(shard, request_id, command, *args)
+            for shard, (command, args) in enumerate(commands)
+        ]
+        return [future.result() for future in futures]
+
+    def _sync(self):
+        """
+        Приводит шарды в соответствие с текущей версией данных.
+        """
+        data_version = get_data_version()
+        if self.data_version == data_version and not self._dirty:
+            return
+
+        with self._sync_lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, set()
+            changes = set()
+            if self.data_version is not None and self.data_version != data_version:
+                changes = get_data_changes(self.data_version, data_version)
+
+            synced, self.data_version = self.data_version, None
+            if synced is None or changes is None:
+                # Срез каждого шарда читается из БД после отправки
+                # предыдущего, поэтому в памяти не бывает всех весов
+                self._scatter(
+                    ('load', load_signed_weights(shard=shard, shards=self.shards))
+                    for shard in range(self.shards)
+                )
+            elif dirty or changes:
+                changed = np.fromiter(dirty | changes, dtype=np.int64)
+                users, aspects, weights = load_signed_weights(changed)
+                commands = []
+                for shard in range(self.shards):
+                    rows = users % self.shards == shard
+                    commands.append(('update', (
+                        set(changed[changed % self.shards == shard].tolist()),
+                        users[rows], aspects[rows], weights[rows]
+                    )))
+                self._scatter(commands)
+            self.data_version = data_version
+
+    def search(self, user_id, threshold=None, limit=None):
+        """
+        Ищет пользователей, наиболее совместимых с заданным,
+        параллельно во всех шардах.
+
+        :param user_id:   ID пользователя
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства или None,
+                          если у пользователя нет приоритетов
+        """
+        if threshold is None:
+            threshold = get_setting('COMPATIBILITY_THRESHOLD')
+        if limit is None:
+            limit = get_setting('COMPATIBLE_USERS_LIMIT')
+
+        self._sync()
+        _, aspects, weights = deduplicate_weights(
+            *load_signed_weights([user_id])
+        )
+        if not weights.any():
+            return None
+
+        results = self._scatter([(
+            'search',
+            (user_id, aspects, weights.astype(np.float64), threshold, limit)
+        )] * self.shards)
+
+        # Выдачи шардов упорядочены по (-сходство, ID), как и общая
+        merged = heapq.merge(
+            *results, key=lambda match: (-match[1], match[0])
+        )
+        return list(itertools.islice(merged, limit))
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых вычислений в процессе.
+
+    Первый вызов с ключом выполняет вычисление, а вызовы с тем же
+    ключом, пришедшие до его окончания, ждут его Future и получают
+    тот же результат (или то же исключение). После окончания
+    вычисления ключ освобождается, поэтому результат не хранится
+    дольше, чем идет вычисление. Future потокобезопасен, так что
+    синхронные потоки и асинхронные представления ждут одни
+    и те же вычисления.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        """
+        Возвращает Future вычисления с ключом и признак того,
+        что вычисление должен выполнить вызывающий.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func):
+        """
+        Выполняет func() или ждет результата уже идущего вызова
+        с тем же ключом.
+
+        :param key:  Ключ вычисления (хешируемый)
+        :param func: Функция без аргументов
+        :return:     Результат func
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as error:
+            self._finish(key, future, error=error)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def ado(self, key, func):
+        """
+        Асинхронный вариант do: func - асинхронная функция без
+        аргументов, ожидание не блокирует цикл событий.
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func()
+        except BaseException as error:
+            self._finish(key, future, error=error)
+            raise
+        self._finish(key, future, result)
+        return result
+
+
+single_flight = SingleFlight()
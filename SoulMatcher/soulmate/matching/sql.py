@@ -0,0 +1,178 @@
+import numpy as np
+
+from django.db import connections, router
+
+from ..database import replica_reads
+from ..models import CustomUser, UserPriority
+from .conf import get_setting, threshold_similarity
+from .data import QUERY_CHUNK_SIZE, load_signed_weights
+from .engine import deduplicate_weights
+from .ranking import rank_matches
+
+# Допуск на ошибки округления при сравнении сходства с порогом
+# и с последним местом выдачи; окончательный отбор и порядок
+# определяются округленными сходствами в rank_matches
+SIMILARITY_TOLERANCE = 1e-9
+
+# Количество строк результата, читаемых из курсора за раз
+FETCH_SIZE = 100
+
+
+def update_priority_norms(user_ids):
+    """
+    Пересчитывает нормы векторов приоритетов пользователей
+    (поле CustomUser.priority_norm).
+
+    :param user_ids: ID пользователей
+    """
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+        chunk = user_ids[start:start + QUERY_CHUNK_SIZE]
+        users, _, weights = deduplicate_weights(*load_signed_weights(chunk))
+
+        norms = dict.fromkeys(chunk, 0.0)
+        if len(users):
+            unique, inverse = np.unique(users, return_inverse=True)
+            squares = np.bincount(inverse, weights=weights.astype(float) ** 2)
+            norms.update(zip(unique.tolist(), np.sqrt(squares).tolist()))
+
+        CustomUser.objects.bulk_update(
+            [
+                CustomUser(id=user_id, priority_norm=norm)
+                for user_id, norm in norms.items()
+            ],
+            ['priority_norm']
+        )
+
+
+def similarity_sql():
+    """
+    Возвращает запрос косинусных сходств пользователя со всеми,
+    у кого есть общие с ним аспекты: скалярное произведение
+    вычисляется одним сгруппированным соединением по аспекту
+    и делится на нормы из поля priority_norm. Мои веса читаются
+    диапазоном индекса уникальности (user, aspect), а веса других
+    пользователей - диапазонами покрывающего индекса
+    (aspect, user, signed_weight) по моим аспектам.
+
+    Перед вычислением сходств кандидаты отбираются группировкой
+    тех же строк индекса: остаются пользователи с заданным
+    минимумом общих аспектов, для которых сходство еще может
+    достичь порога. По неравенству Коши - Буняковского сходство
+    с кандидатом не превышает ||a_C|| / ||a||, где a_C - часть
+    моего вектора на общих аспектах, поэтому кандидат
+    с SUM(a_i^2) по общим аспектам меньше s^2 * ||a||^2 заведомо
+    не проходит порог s.
+
+    Параметры: ID пользователя (дважды), минимальное количество
+    общих аспектов, граница суммы квадратов моих весов на общих
+    аспектах, ID пользователя и минимальное сходство.
+    """
+    users = CustomUser._meta.db_table
+    priorities = UserPriority._meta.db_table
+    return f"""
+        WITH mine AS (
+            SELECT aspect_id, signed_weight AS weight
+            FROM {priorities}
+            WHERE user_id = %s
+        ),
+        candidates AS (
+            SELECT theirs.user_id
+            FROM mine
+            JOIN {priorities} theirs ON theirs.aspect_id = mine.aspect_id
+            WHERE theirs.user_id <> %s
+            GROUP BY theirs.user_id
+            HAVING COUNT(*) >= %s
+               AND SUM(mine.weight * mine.weight) >= %s
+        )
+        SELECT theirs.user_id,
+               SUM(mine.weight * theirs.signed_weight)
+                   / (them.priority_norm * me.priority_norm) AS similarity
+        FROM candidates
+        JOIN {priorities} theirs ON theirs.user_id = candidates.user_id
+        JOIN mine ON mine.aspect_id = theirs.aspect_id
+        JOIN {users} them ON them.id = theirs.user_id
+        JOIN {users} me ON me.id = %s
+        WHERE me.priority_norm > 0
+          AND them.priority_norm > 0
+        GROUP BY theirs.user_id, them.priority_norm, me.priority_norm
+        HAVING SUM(mine.weight * theirs.signed_weight)
+            >= %s * them.priority_norm * me.priority_norm
+        ORDER BY similarity DESC, theirs.user_id
+    """
+
+
+def similarity_params(user_id, norm, threshold):
+    """
+    Возвращает параметры запроса similarity_sql.
+
+    :param user_id:   ID пользователя
+    :param norm:      Норма вектора приоритетов пользователя
+    :param threshold: Минимальный процент совместимости
+    """
+    minimum = threshold_similarity(threshold) - SIMILARITY_TOLERANCE
+    bound = max(minimum, 0) ** 2 * norm ** 2
+    return [
+        user_id, user_id, get_setting('SQL_MIN_OVERLAP'), bound, user_id, minimum
+    ]
+
+
+def fetch_rows(cursor):
+    """
+    Читает строки результата из курсора порциями.
+    """
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+@replica_reads()
+def sql_search(user_id, threshold=None, limit=None):
+    """
+    Поиск совместимых пользователей на стороне БД.
+
+    Не требует резидентной матрицы: в Python передаются только
+    ID и сходства кандидатов, прошедших порог, причем чтение
+    прекращается, как только набрано limit результатов.
+    Учитываются только пользователи, у которых не меньше
+    SQL_MIN_OVERLAP общих аспектов, поэтому при пороге не выше 50%
+    пользователи с нулевым сходством в выдачу не попадают.
+
+    :param user_id:   ID пользователя
+    :param threshold: Минимальный процент совместимости
+    :param limit:     Максимальное количество результатов
+    :return:          Список пар (ID пользователя, сходство)
+                      в порядке убывания сходства или None,
+                      если у пользователя нет приоритетов
+    """
+    if threshold is None:
+        threshold = get_setting('COMPATIBILITY_THRESHOLD')
+    if limit is None:
+        limit = get_setting('COMPATIBLE_USERS_LIMIT')
+
+    norm = CustomUser.objects.filter(id=user_id).values_list(
+        'priority_norm', flat=True
+    ).first()
+    if not norm:
+        return None
+
+    user_ids, similarities = [], []
+    with connections[router.db_for_read(UserPriority)].cursor() as cursor:
+        cursor.execute(
+            similarity_sql(), similarity_params(user_id, norm, threshold)
+        )
+        for candidate_id, similarity in fetch_rows(cursor):
+            # Строки, равные последнему месту с точностью до ошибок
+            # округления, дочитываются, чтобы порядок при равенстве
+            # определялся так же, как в остальных способах поиска
+            if limit and len(user_ids) >= limit and \
+                    similarity < similarities[limit - 1] - SIMILARITY_TOLERANCE:
+                break
+            user_ids.append(candidate_id)
+            similarities.append(similarity)
+
+    return rank_matches(
+        user_ids, np.clip(similarities, -1, 1), threshold, limit
+    )
@@ -0,0 +1,122 @@
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+import numpy as np
+
+from .conf import get_setting, to_percentage
+from .ranking import SIMILARITY_DECIMALS, rank_matches
+
+
+def scored_candidates(snapshot, user_id, threshold, after=None):
+    """
+    Вычисляет сходства пользователя со всеми пользователями снимка
+    и отбирает прошедших порог.
+
+    :param snapshot:  Снимок приоритетов
+    :param user_id:   ID пользователя
+    :param threshold: Минимальный процент совместимости
+    :param after:     Курсор - пара (сходство, ID пользователя):
+                      отбираются только пользователи, идущие в выдаче
+                      после него, или None
+    :return:          Массивы ID пользователей и округленных сходств
+                      (без упорядочивания)
+    """
+    row = snapshot.row_of[user_id]
+    similarities = np.round(
+        snapshot.similarities(snapshot.matrix[row]), SIMILARITY_DECIMALS
+    )
+
+    keep = to_percentage(similarities) >= threshold
+    keep[row] = False
+    if after is not None:
+        similarity, last_id = after
+        keep &= (similarities < similarity) | (
+            (similarities == similarity) & (snapshot.user_ids > last_id)
+        )
+    return snapshot.user_ids[keep], similarities[keep]
+
+
+def iter_matches(snapshot, user_id, threshold=None, chunk_size=None):
+    """
+    Выдает всех пользователей с совместимостью не ниже порога
+    частями в порядке убывания сходства (при равенстве - по ID).
+
+    В памяти держатся только массивы ID и сходств кандидатов,
+    а списки пар создаются по одной части за раз.
+
+    :param snapshot:   Снимок приоритетов
+    :param user_id:    ID пользователя
+    :param threshold:  Минимальный процент совместимости
+    :param chunk_size: Количество пар в части (STREAM_CHUNK_SIZE)
+    :return:           Генератор списков пар (ID пользователя, сходство)
+    """
+    if threshold is None:
+        threshold = get_setting('COMPATIBILITY_THRESHOLD')
+    if chunk_size is None:
+        chunk_size = get_setting('STREAM_CHUNK_SIZE')
+
+    user_ids, similarities = scored_candidates(snapshot, user_id, threshold)
+    order = np.lexsort((user_ids, -similarities))
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        yield list(zip(
+            user_ids[chunk].tolist(), similarities[chunk].tolist()
+        ))
+
+
+def matches_page(snapshot, user_id, threshold=None, after=None, size=None):
+    """
+    Возвращает страницу выдачи, следующую за курсором.
+
+    Отбор лучших выполняется частичной сортировкой, поэтому
+    страница не требует упорядочивания всех кандидатов.
+
+    :param snapshot:  Снимок приоритетов
+    :param user_id:   ID пользователя
+    :param threshold: Минимальный процент совместимости
+    :param after:     Курсор (сходство, ID пользователя) последней
+                      записи предыдущей страницы или None
+    :param size:      Размер страницы (RESULTS_PAGE_SIZE)
+    :return:          Кортеж (список пар (ID пользователя, сходство),
+                      курсор следующей страницы или None)
+    """
+    if threshold is None:
+        threshold = get_setting('COMPATIBILITY_THRESHOLD')
+    if size is None:
+        size = get_setting('RESULTS_PAGE_SIZE')
+
+    user_ids, similarities = scored_candidates(
+        snapshot, user_id, threshold, after
+    )
+    matches = rank_matches(user_ids, similarities, threshold, size + 1)
+    if len(matches) <= size:
+        return matches, None
+
+    matches = matches[:size]
+    last_id, similarity = matches[-1]
+    return matches, (similarity, last_id)
+
+
+def encode_cursor(after):
+    """
+    Кодирует курсор (сходство, ID пользователя) в строку для URL.
+    """
+    similarity, user_id = after
+    return urlsafe_b64encode(
+        f'{similarity!r}:{user_id}'.encode()
+    ).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Декодирует курсор, закодированный encode_cursor.
+
+    :raises ValueError: Если строка не является курсором
+    """
+    try:
+        similarity, user_id = urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)
+        ).decode().split(':')
+        return float(similarity), int(user_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid cursor: {cursor}')
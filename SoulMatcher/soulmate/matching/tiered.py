@@ -0,0 +1,218 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .cache import get_data_changes, get_data_version
+from .conf import get_setting
+from .data import load_signed_weights
+from .engine import MatchingSnapshot, deduplicate_weights
+from .ranking import rank_matches
+
+
+class TieredStore:
+    """
+    Векторы пользователей в двух уровнях с бюджетом памяти.
+
+    Горячий уровень - снимок (матрица CSR и нормы) только недавно
+    активных пользователей, размер которого ограничен настройкой
+    TIERED_HOT_BYTES. Холодный уровень - файл векторов int8
+    (build_vector_store), отображенный в память: его страницы
+    принадлежат страничному кэшу ОС и общие для всех процессов,
+    поэтому память процесса не растет с количеством участников.
+
+    При поиске вектор пользователя берется из горячего уровня
+    или читается из БД. Горячие пользователи сравниваются по своим
+    актуальным векторам в памяти, остальные - по файлу, и выдачи
+    сливаются. Файл просматривается при каждом поиске (границы
+    сходства по аспектам не отсекают холодных пользователей),
+    поэтому поиск не быстрее режима mmap: горячий уровень дает
+    актуальные векторы активных пользователей без чтения из БД
+    и ограничивает память процесса, а не задержку. Активность пользователя оценивается счетчиком
+    обращений, который убывает вдвое каждые TIERED_HALF_LIFE
+    секунд, поэтому учитываются и частота, и давность обращений.
+    Пользователь продвигается в горячий уровень, когда оценка
+    достигает TIERED_ADMISSION_SCORE (разовые обращения не вытесняют
+    активных пользователей и не перестраивают уровень), а при
+    превышении бюджета вытесняются пользователи с наименьшей
+    оценкой. Оценки негорячих пользователей хранятся в ограниченном
+    списке (TIERED_CANDIDATES) с вытеснением давно не обращавшихся.
+
+    Строки горячих пользователей, изменивших приоритеты (в том числе
+    в других процессах, по общей версии данных), перечитываются
+    из БД перед следующим поиском.
+    """
+
+    def __init__(self):
+        self.hot = MatchingSnapshot.empty()
+        # ID пользователя -> (оценка, время последнего обращения):
+        # горячие и продвигаемые пользователи и остальные
+        self._scores = {}
+        self._candidates = OrderedDict()
+        self._dirty = set()
+        # Версия данных, изменения до которой учтены в горячем уровне
+        self._data_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def mark_dirty(self, user_ids):
+        """
+        Помечает пользователей как изменивших приоритеты.
+        """
+        with self._lock:
+            self._dirty.update(user_ids)
+
+    def reset(self):
+        """
+        Очищает горячий уровень и оценки активности.
+        """
+        with self._lock:
+            self.hot = MatchingSnapshot.empty()
+            self._scores.clear()
+            self._candidates.clear()
+            self._dirty.clear()
+            self._data_version = None
+            self.hits = self.misses = 0
+
+    @staticmethod
+    def _decayed(score, accessed_at, now):
+        half_life = get_setting('TIERED_HALF_LIFE')
+        return score * 0.5 ** ((now - accessed_at) / half_life)
+
+    def _remember(self, user_id, score):
+        """
+        Сохраняет оценку негорячего пользователя.
+        """
+        self._candidates[user_id] = score
+        self._candidates.move_to_end(user_id)
+        while len(self._candidates) > get_setting('TIERED_CANDIDATES'):
+            self._candidates.popitem(last=False)
+
+    def _refresh(self, data_version):
+        """
+        Перечитывает строки горячих пользователей,
+        изменивших приоритеты (в том числе продвигаемых, чьи веса
+        могли быть прочитаны до изменения). Если общая версия данных
+        сдвинулась, добавляются пользователи, опубликованные другими
+        процессами, а если изменения неизвестны - все горячие.
+
+        :param data_version: Текущая версия данных, прочитанная
+                             до весов
+        """
+        if data_version != self._data_version:
+            changes = get_data_changes(self._data_version, data_version)
+            self._dirty.update(self._scores if changes is None else changes)
+            self._data_version = data_version
+        dirty = [user_id for user_id in self._dirty if user_id in self._scores]
+        self._dirty.clear()
+        if dirty:
+            self.hot = self.hot.with_users(
+                set(dirty), *load_signed_weights(dirty)
+            )
+
+    def _evict(self, now):
+        """
+        Вытесняет пользователей с наименьшей оценкой активности,
+        пока горячий уровень не уложится в бюджет памяти.
+        """
+        budget = get_setting('TIERED_HOT_BYTES')
+        if self.hot.size <= budget or not len(self.hot.user_ids):
+            return
+
+        # Место, занимаемое строкой, оценивается по среднему
+        bytes_per_user = self.hot.size / len(self.hot.user_ids)
+        excess = int(np.ceil((self.hot.size - budget) / bytes_per_user))
+        victims = sorted(
+            self._scores,
+            key=lambda user_id: self._decayed(*self._scores[user_id], now)
+        )[:excess]
+        for user_id in victims:
+            self._remember(user_id, self._scores.pop(user_id))
+        self.hot = self.hot.with_users(
+            set(victims), *(np.empty(0, dtype=np.int64),) * 3
+        )
+
+    def vector(self, user_id):
+        """
+        Возвращает вектор пользователя, засчитывая обращение
+        и при достаточной активности продвигая пользователя
+        в горячий уровень.
+
+        :return: Массивы ID аспектов и знаковых весов
+        """
+        now = time.monotonic()
+        data_version = get_data_version()
+        with self._lock:
+            self._refresh(data_version)
+            scores = self._scores if user_id in self._scores else self._candidates
+            score, accessed_at = scores.pop(user_id, (0, now))
+            score = (self._decayed(score, accessed_at, now) + 1, now)
+
+            row = self.hot.row_of.get(user_id)
+            if row is not None:
+                self._scores[user_id] = score
+                self.hits += 1
+                vector = self.hot.matrix[row]
+                return self.hot.aspect_ids[vector.indices], vector.data
+
+            self.misses += 1
+            promote = score[0] >= get_setting('TIERED_ADMISSION_SCORE')
+            if promote:
+                self._scores[user_id] = score
+            else:
+                self._remember(user_id, score)
+
+        users, aspects, weights = deduplicate_weights(
+            *load_signed_weights([user_id])
+        )
+        if promote:
+            with self._lock:
+                if not len(users):
+                    self._scores.pop(user_id, None)
+                elif user_id in self._scores and user_id not in self.hot.row_of:
+                    self.hot = self.hot.with_users({user_id}, users, aspects, weights)
+                    self._evict(now)
+        return aspects, weights.astype(np.float64)
+
+    def search(self, store, user_id, threshold=None, limit=None):
+        """
+        Ищет пользователей, наиболее совместимых с заданным,
+        в горячем уровне и в файле векторов.
+
+        :param store:     Холодный уровень (VectorStore)
+        :param user_id:   ID пользователя
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства или None,
+                          если у пользователя нет приоритетов
+        """
+        aspects, weights = self.vector(user_id)
+        if not weights.any():
+            return None
+
+        hot = self.hot
+        matches = hot.search_vector(user_id, aspects, weights, threshold, limit)
+        matches += store.search(
+            user_id, aspects, weights, threshold, limit, exclude=hot.user_ids
+        )
+        user_ids, similarities = zip(*matches) if matches else ((), ())
+        return rank_matches(user_ids, similarities, threshold, limit)
+
+    def stats(self):
+        """
+        Возвращает размер горячего уровня и счетчики попаданий.
+        """
+        hot = self.hot
+        return {
+            'hot_users': len(hot.user_ids),
+            'hot_bytes': hot.size,
+            'budget_bytes': get_setting('TIERED_HOT_BYTES'),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+tiered_store = TieredStore()
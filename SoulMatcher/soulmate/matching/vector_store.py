@@ -0,0 +1,244 @@
+import os
+import struct
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+
+from .conf import get_setting, threshold_similarity
+from .ranking import rank_matches
+
+MAGIC = b'SMVSTORE'
+FORMAT_VERSION = 1
+# Сигнатура, версия формата, количество пользователей,
+# аспектов и ненулевых весов
+HEADER = struct.Struct('<8sIqqq')
+# Выравнивание начала каждого массива в файле
+ALIGNMENT = 64
+
+# Массивы файла в порядке записи: имя, тип и измерение длины
+LAYOUT = (
+    ('user_ids', np.int64, 'users'),
+    ('norms', np.float64, 'users'),
+    ('aspect_ids', np.int64, 'aspects'),
+    # Списки вхождений аспектов: матрица CSC пользователи x аспекты
+    ('column_indptr', np.int64, 'aspects+1'),
+    ('column_rows', np.int32, 'nnz'),
+    ('column_data', np.int8, 'nnz'),
+)
+
+# Способы поиска, читающие хранилище векторов
+STORE_MODES = frozenset({'mmap', 'tiered'})
+
+
+def uses_vector_store(mode=None):
+    """
+    Проверяет, читает ли способ поиска хранилище векторов.
+
+    :param mode: Способ поиска (по умолчанию настройка SEARCH_MODE)
+    """
+    return (mode or get_setting('SEARCH_MODE')) in STORE_MODES
+
+
+def array_offsets(n_users, n_aspects, nnz):
+    """
+    Вычисляет смещения и длины массивов файла.
+
+    :return: Список кортежей (имя, тип, смещение, длина)
+             и общий размер файла
+    """
+    lengths = {
+        'users': n_users,
+        'aspects': n_aspects,
+        'aspects+1': n_aspects + 1,
+        'nnz': nnz,
+    }
+    offsets, position = [], HEADER.size
+    for name, dtype, dimension in LAYOUT:
+        position = -(-position // ALIGNMENT) * ALIGNMENT
+        length = lengths[dimension]
+        offsets.append((name, dtype, position, length))
+        position += length * np.dtype(dtype).itemsize
+    return offsets, position
+
+
+class VectorStore:
+    """
+    Компактное хранилище векторов приоритетов в одном файле.
+
+    Знаковые веса (от -10 до 10) хранятся в int8, номера столбцов
+    и строк - в int32, рядом лежат нормы векторов, поэтому файл
+    в несколько раз меньше матрицы float64. Файл отображается
+    в память только для чтения, и все процессы WSGI/ASGI делят
+    одну физическую копию через страничный кэш. Пользователи
+    упорядочены по ID, а веса сгруппированы по аспектам (CSC),
+    поэтому сходства вычисляются прямо из отображенных массивов
+    по спискам вхождений аспектов запроса.
+
+    Файл строится командой build_vector_store и заменяется
+    атомарным переименованием: процессы замечают новый файл
+    при следующем поиске, а уже открытые отображения старого
+    остаются действительными до освобождения.
+    """
+
+    _lock = threading.Lock()
+    _cached = (None, None, None)
+
+    def __init__(self, buffer, n_users, n_aspects, nnz):
+        self.buffer = buffer
+        offsets, _ = array_offsets(n_users, n_aspects, nnz)
+        for name, dtype, offset, length in offsets:
+            setattr(self, name, np.frombuffer(
+                buffer, dtype=dtype, count=length, offset=offset
+            ))
+
+    @property
+    def size(self):
+        return len(self.user_ids)
+
+    @staticmethod
+    def write(snapshot, path):
+        """
+        Записывает векторы снимка в файл, атомарно заменяя прежний.
+
+        :param snapshot: Снимок приоритетов
+        :param path:     Путь к файлу
+        """
+        order = np.argsort(snapshot.user_ids, kind='stable')
+        columns = sp.csc_matrix(snapshot.matrix[order])
+        columns.sort_indices()
+
+        if columns.nnz and np.abs(columns.data).max() > np.iinfo(np.int8).max:
+            raise ValueError('Signed weights do not fit into int8')
+
+        arrays = {
+            'user_ids': snapshot.user_ids[order],
+            'norms': snapshot.norms[order],
+            'aspect_ids': snapshot.aspect_ids,
+            'column_indptr': columns.indptr,
+            'column_rows': columns.indices,
+            'column_data': columns.data,
+        }
+        n_users, n_aspects = columns.shape
+        offsets, total = array_offsets(n_users, n_aspects, columns.nnz)
+
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, n_users, n_aspects, columns.nnz
+            ))
+            for name, dtype, offset, _ in offsets:
+                file.seek(offset)
+                file.write(np.ascontiguousarray(
+                    arrays[name], dtype=dtype
+                ).tobytes())
+            file.truncate(total)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Отображает файл в память только для чтения.
+        """
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, n_users, n_aspects, nnz = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a vector store file')
+        return cls(buffer, n_users, n_aspects, nnz)
+
+    @staticmethod
+    def generation():
+        """
+        Возвращает поколение файла VECTOR_STORE_PATH (номер inode
+        и время изменения), которое меняется при каждой замене
+        файла, или None, если файл еще не построен.
+        """
+        try:
+            stat = os.stat(get_setting('VECTOR_STORE_PATH'))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    @classmethod
+    def current(cls):
+        """
+        Возвращает хранилище из файла VECTOR_STORE_PATH, отображая
+        его заново после замены, или None, если файл еще не построен.
+        """
+        path = str(get_setting('VECTOR_STORE_PATH'))
+        identity = cls.generation()
+        if identity is None:
+            return None
+
+        with cls._lock:
+            cached_path, cached_identity, store = cls._cached
+            if (cached_path, cached_identity) != (path, identity):
+                store = cls.open(path)
+                cls._cached = (path, identity, store)
+            return store
+
+    def row(self, user_id):
+        """
+        Возвращает номер строки пользователя или None.
+        """
+        row = np.searchsorted(self.user_ids, user_id)
+        if row < self.size and self.user_ids[row] == user_id:
+            return int(row)
+        return None
+
+    def search(self, user_id, aspects, weights, threshold=None, limit=None,
+               exclude=None):
+        """
+        Ищет пользователей, наиболее совместимых с вектором.
+
+        Скалярные произведения накапливаются в int32 по спискам
+        вхождений аспектов вектора, поэтому просматриваются только
+        пользователи с общими аспектами (при пороге не выше 50%
+        подходят и остальные, с нулевым сходством).
+
+        :param user_id:   ID пользователя (исключается из выдачи)
+        :param aspects:   Массив ID аспектов вектора
+        :param weights:   Массив знаковых весов вектора
+        :param threshold: Минимальный процент совместимости
+        :param limit:     Максимальное количество результатов
+        :param exclude:   Массив ID пользователей, исключаемых из выдачи
+        :return:          Список пар (ID пользователя, сходство)
+                          в порядке убывания сходства
+        """
+        if threshold is None:
+            threshold = get_setting('COMPATIBILITY_THRESHOLD')
+
+        norm = np.sqrt(np.sum(np.square(weights, dtype=np.float64)))
+        dots = np.zeros(self.size, dtype=np.int32)
+        touched = np.zeros(self.size, dtype=bool)
+
+        columns = np.searchsorted(self.aspect_ids, aspects)
+        for column, aspect, weight in zip(columns, aspects, weights):
+            if column >= len(self.aspect_ids) or self.aspect_ids[column] != aspect:
+                continue
+            start, end = self.column_indptr[column:column + 2]
+            rows = self.column_rows[start:end]
+            dots[rows] += int(weight) * self.column_data[start:end].astype(np.int32)
+            touched[rows] = True
+
+        if threshold_similarity(threshold) <= 0:
+            touched[:] = True
+        touched &= self.norms > 0
+        own_row = self.row(user_id)
+        if own_row is not None:
+            touched[own_row] = False
+        if exclude is not None and len(exclude):
+            rows = np.searchsorted(self.user_ids, exclude)
+            found = rows < self.size
+            found[found] = self.user_ids[rows[found]] == exclude[found]
+            touched[rows[found]] = False
+
+        rows = np.flatnonzero(touched)
+        similarities = np.clip(
+            dots[rows] / (self.norms[rows] * norm), -1, 1
+        )
+        return rank_matches(
+            self.user_ids[rows], similarities, threshold, limit
+        )
@@ -0,0 +1,40 @@
+# Generated by Django 4.1.9 on 2026-10-17 02:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NeighborList',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='neighbor_list', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('computed_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CompatibleNeighbor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('similarity', models.FloatField()),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compatible_neighbors', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='compatibleneighbor',
+            index=models.Index(fields=['neighbor'], name='compatible_neighbor_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='compatibleneighbor',
+            constraint=models.UniqueConstraint(fields=('user', 'rank'), name='unique_compatible_neighbor_rank'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.9 on 2026-10-17 02:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0002_neighbor_tables'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='neighborlist',
+            name='top',
+            field=models.PositiveSmallIntegerField(default=20),
+            preserve_default=False,
+        ),
+    ]
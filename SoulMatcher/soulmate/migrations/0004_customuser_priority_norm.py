@@ -0,0 +1,54 @@
+# Generated by Django 4.1.9 on 2026-10-17 02:28
+
+import math
+
+from django.db import migrations, models
+
+
+def fill_priority_norms(apps, schema_editor):
+    """
+    Вычисляет нормы векторов приоритетов существующих пользователей.
+    При нескольких приоритетах на один аспект учитывается последний.
+    """
+    CustomUser = apps.get_model('soulmate', 'CustomUser')
+    Priority = apps.get_model('soulmate', 'Priority')
+
+    weights = {}
+    for user_id, aspect_id, attitude, weight in Priority.users.through.objects.order_by(
+        'id'
+    ).values_list(
+        'customuser_id',
+        'priority__aspect_id',
+        'priority__attitude__attitude',
+        'priority__weight__weight'
+    ).iterator():
+        weights[user_id, aspect_id] = weight if attitude == 'positive' else -weight
+
+    squares = {}
+    for (user_id, _), weight in weights.items():
+        squares[user_id] = squares.get(user_id, 0) + weight ** 2
+
+    CustomUser.objects.bulk_update(
+        [
+            CustomUser(id=user_id, priority_norm=math.sqrt(total))
+            for user_id, total in squares.items()
+        ],
+        ['priority_norm'],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0003_neighbor_list_top'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='priority_norm',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_priority_norms, migrations.RunPython.noop),
+    ]
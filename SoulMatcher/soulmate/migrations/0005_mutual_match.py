@@ -0,0 +1,32 @@
+# Generated by Django 4.1.9 on 2026-10-17 02:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0004_customuser_priority_norm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MutualMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('similarity', models.FloatField()),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='mutualmatch',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_mutual_match'),
+        ),
+        migrations.AddConstraint(
+            model_name='mutualmatch',
+            constraint=models.CheckConstraint(check=models.Q(('user_low__lt', models.F('user_high'))), name='mutual_match_ordered'),
+        ),
+    ]
@@ -0,0 +1,97 @@
+# Generated by Django 4.1.9 on 2026-10-17 09:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+
+def copy_priorities(apps, schema_editor):
+    """
+    Переносит связи пользователей с общими приоритетами в таблицу
+    приоритетов пользователей. При нескольких приоритетах
+    на один аспект остается последний добавленный.
+    """
+    Priority = apps.get_model('soulmate', 'Priority')
+    UserPriority = apps.get_model('soulmate', 'UserPriority')
+
+    weights = {}
+    for user_id, aspect_id, attitude, weight in Priority.users.through.objects.order_by(
+        'id'
+    ).values_list(
+        'customuser_id',
+        'priority__aspect_id',
+        'priority__attitude__attitude',
+        'priority__weight__weight'
+    ).iterator():
+        weights[user_id, aspect_id] = weight if attitude == 'positive' else -weight
+
+    UserPriority.objects.bulk_create(
+        [
+            UserPriority(user_id=user_id, aspect_id=aspect_id, signed_weight=weight)
+            for (user_id, aspect_id), weight in weights.items()
+        ],
+        batch_size=BATCH_SIZE
+    )
+
+
+def restore_priorities(apps, schema_editor):
+    """
+    Восстанавливает общие приоритеты по приоритетам пользователей.
+    """
+    Attitude = apps.get_model('soulmate', 'Attitude')
+    Weight = apps.get_model('soulmate', 'Weight')
+    Priority = apps.get_model('soulmate', 'Priority')
+    UserPriority = apps.get_model('soulmate', 'UserPriority')
+
+    priorities, relations = {}, []
+    for user_id, aspect_id, signed_weight in UserPriority.objects.order_by(
+        'id'
+    ).values_list('user_id', 'aspect_id', 'signed_weight').iterator():
+        key = aspect_id, 'negative' if signed_weight < 0 else 'positive', abs(signed_weight)
+        if key not in priorities:
+            # Справочники могут содержать повторяющиеся строки
+            attitude = Attitude.objects.filter(attitude=key[1]).first() \
+                or Attitude.objects.create(attitude=key[1])
+            weight = Weight.objects.filter(weight=key[2]).first() \
+                or Weight.objects.create(weight=key[2])
+            priorities[key] = Priority.objects.create(
+                aspect_id=aspect_id, attitude=attitude, weight=weight
+            )
+        relations.append(Priority.users.through(
+            customuser_id=user_id, priority_id=priorities[key].id
+        ))
+
+    Priority.users.through.objects.bulk_create(relations, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0005_mutual_match'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPriority',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('signed_weight', models.SmallIntegerField()),
+                ('aspect', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='soulmate.aspect')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='priorities', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='userpriority',
+            constraint=models.UniqueConstraint(fields=('user', 'aspect'), name='unique_user_priority'),
+        ),
+        migrations.AddIndex(
+            model_name='userpriority',
+            index=models.Index(fields=['aspect', 'user', 'signed_weight'], name='user_priority_aspect_idx'),
+        ),
+        migrations.RunPython(copy_priorities, restore_priorities),
+        migrations.DeleteModel(
+            name='Priority',
+        ),
+    ]
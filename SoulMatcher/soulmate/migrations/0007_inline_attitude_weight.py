@@ -0,0 +1,36 @@
+# Generated by Django 4.1.9 on 2026-10-17 03:09
+
+from django.db import migrations, models
+
+MAX_WEIGHT = 10
+
+
+def clamp_weights(apps, schema_editor):
+    """
+    Ограничивает знаковые веса диапазоном весов справочника,
+    который раньше проверялся только формами.
+    """
+    UserPriority = apps.get_model('soulmate', 'UserPriority')
+    UserPriority.objects.filter(signed_weight__gt=MAX_WEIGHT).update(signed_weight=MAX_WEIGHT)
+    UserPriority.objects.filter(signed_weight__lt=-MAX_WEIGHT).update(signed_weight=-MAX_WEIGHT)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0006_userpriority'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='Attitude',
+        ),
+        migrations.DeleteModel(
+            name='Weight',
+        ),
+        migrations.RunPython(clamp_weights, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userpriority',
+            constraint=models.CheckConstraint(check=models.Q(('signed_weight__gte', -10), ('signed_weight__lte', 10)), name='user_priority_weight_range'),
+        ),
+    ]
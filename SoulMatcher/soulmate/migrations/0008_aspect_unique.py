@@ -0,0 +1,115 @@
+# Generated by Django 4.1.9 on 2026-10-17 03:12
+
+import math
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+
+# Ограничение на количество параметров в одном запросе
+# (SQLite по умолчанию допускает не более 999 переменных).
+# Миграция не импортирует код приложения, который может измениться
+CHUNK_SIZE = 500
+
+
+def chunked(values):
+    return [values[i:i + CHUNK_SIZE] for i in range(0, len(values), CHUNK_SIZE)]
+
+
+def find_duplicate_aspects(Aspect):
+    """
+    Находит аспекты с одинаковым названием.
+
+    :return: Словарь ID сохраняемого аспекта (наименьший
+             ID с названием) -> список ID его повторов
+    """
+    names = Aspect.objects.order_by().values('aspect').annotate(
+        total=Count('id', distinct=True), keep=Min('id')
+    ).filter(total__gt=1).values_list('aspect', 'keep')
+
+    return {
+        keep: list(
+            Aspect.objects.filter(aspect=name).exclude(
+                id=keep
+            ).values_list('id', flat=True)
+        )
+        for name, keep in names
+    }
+
+
+def merge_duplicates(UserPriority, keep, duplicate_ids):
+    """
+    Переводит приоритеты повторов аспекта на сохраняемый аспект.
+    Если у пользователя есть приоритеты на несколько повторов,
+    остается последний добавленный.
+
+    :return: ID пользователей с приоритетами на повторы
+    """
+    aspect_ids = [keep] + duplicate_ids
+    rows = UserPriority.objects.filter(
+        aspect_id__in=aspect_ids
+    ).values('user_id').annotate(total=Count('id'), last=Max('id'))
+    conflicts = {row['user_id']: row['last'] for row in rows if row['total'] > 1}
+
+    removed = []
+    for users in chunked(list(conflicts)):
+        for priority_id, user_id in UserPriority.objects.filter(
+            aspect_id__in=aspect_ids,
+            user_id__in=users
+        ).values_list('id', 'user_id'):
+            if priority_id != conflicts[user_id]:
+                removed.append(priority_id)
+
+    user_ids = set(UserPriority.objects.filter(
+        aspect_id__in=duplicate_ids
+    ).values_list('user_id', flat=True))
+    for ids in chunked(removed):
+        UserPriority.objects.filter(id__in=ids).delete()
+    UserPriority.objects.filter(
+        aspect_id__in=duplicate_ids
+    ).update(aspect_id=keep)
+    return user_ids
+
+
+def merge_aspects(apps, schema_editor):
+    """
+    Сливает аспекты с одинаковым названием перед добавлением
+    ограничения уникальности и пересчитывает нормы векторов
+    пользователей, чьи приоритеты изменились.
+    """
+    Aspect = apps.get_model('soulmate', 'Aspect')
+    CustomUser = apps.get_model('soulmate', 'CustomUser')
+    UserPriority = apps.get_model('soulmate', 'UserPriority')
+
+    user_ids = set()
+    for keep, duplicate_ids in find_duplicate_aspects(Aspect).items():
+        user_ids |= merge_duplicates(UserPriority, keep, duplicate_ids)
+        Aspect.objects.filter(id__in=duplicate_ids).delete()
+
+    for users in chunked(list(user_ids)):
+        squares = dict.fromkeys(users, 0)
+        for user_id, weight in UserPriority.objects.filter(
+            user_id__in=users
+        ).values_list('user_id', 'signed_weight'):
+            squares[user_id] += weight ** 2
+        CustomUser.objects.bulk_update(
+            [
+                CustomUser(id=user_id, priority_norm=math.sqrt(total))
+                for user_id, total in squares.items()
+            ],
+            ['priority_norm']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0007_inline_attitude_weight'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_aspects, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='aspect',
+            constraint=models.UniqueConstraint(fields=('aspect',), name='unique_aspect'),
+        ),
+    ]
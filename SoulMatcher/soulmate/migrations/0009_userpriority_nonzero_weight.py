@@ -0,0 +1,31 @@
+# Generated by Django 4.1.9 on 2026-10-17 04:10
+
+from django.db import migrations, models
+
+
+def delete_zero_weights(apps, schema_editor):
+    """
+    Удаляет приоритеты с нулевым весом: они не соответствуют
+    ни одной паре отношение/вес и не влияют на сходство.
+    """
+    UserPriority = apps.get_model('soulmate', 'UserPriority')
+    UserPriority.objects.filter(signed_weight=0).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('soulmate', '0008_aspect_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_zero_weights, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name='userpriority',
+            name='user_priority_weight_range',
+        ),
+        migrations.AddConstraint(
+            model_name='userpriority',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('signed_weight__gte', -10), ('signed_weight__lte', -1)), models.Q(('signed_weight__gte', 1), ('signed_weight__lte', 10)), _connector='OR'), name='user_priority_weight_range'),
+        ),
+    ]
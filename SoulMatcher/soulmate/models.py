@@ -10,6 +10,9 @@ class CustomUser(AbstractUser):
         null=True,
         blank=True
     )
+    # Евклидова норма вектора знаковых весов приоритетов
+    # для вычисления совместимости на стороне БД
+    priority_norm = models.FloatField(default=0, editable=False)
 
     def __str__(self):
         return self.username
@@ -18,37 +21,181 @@ class CustomUser(AbstractUser):
 class Aspect(models.Model):
     aspect = models.CharField(max_length=100)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['aspect'], name='unique_aspect'),
+        ]
+
     def __str__(self):
         return self.aspect
 
 
-class Attitude(models.Model):
-    attitude = models.CharField(
-        max_length=10,
-        choices=[
-            ('positive', 'Положительное'),
-            ('negative', 'Отрицательное'),
+# Максимальный вес приоритета
+MAX_WEIGHT = 10
+
+
+class UserPriority(models.Model):
+    """
+    Приоритет пользователя: аспект и знаковый вес (положительный
+    при отношении 'positive' и отрицательный при 'negative').
+    Отношение и вес хранятся в строке приоритета одним числом,
+    без справочных таблиц. У пользователя не больше одного
+    приоритета на аспект.
+
+    Индекс (user, aspect) уникальности дает чтение вектора
+    пользователя одним диапазоном индекса, а покрывающий индекс
+    (aspect, user, signed_weight) - поиск пользователей
+    по аспекту без обращения к таблице.
+    """
+    ATTITUDES = [
+        ('positive', 'Положительное'),
+        ('negative', 'Отрицательное'),
+    ]
+    WEIGHTS = [(i, str(i)) for i in range(1, MAX_WEIGHT + 1)]
+
+    # Отдельные индексы внешних ключей не нужны: user_id и aspect_id -
+    # префиксы индекса уникальности и покрывающего индекса
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='priorities',
+        db_index=False
+    )
+    aspect = models.ForeignKey(
+        Aspect,
+        on_delete=models.CASCADE,
+        db_index=False
+    )
+    signed_weight = models.SmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'aspect'],
+                name='unique_user_priority'
+            ),
+            # Нулевой вес не соответствует ни одной паре
+            # отношение/вес (веса от 1 до MAX_WEIGHT)
+            models.CheckConstraint(
+                check=models.Q(
+                    signed_weight__gte=-MAX_WEIGHT,
+                    signed_weight__lte=-1
+                ) | models.Q(
+                    signed_weight__gte=1,
+                    signed_weight__lte=MAX_WEIGHT
+                ),
+                name='user_priority_weight_range'
+            ),
         ]
+        indexes = [
+            models.Index(
+                fields=['aspect', 'user', 'signed_weight'],
+                name='user_priority_aspect_idx'
+            ),
+        ]
+
+    @staticmethod
+    def to_signed_weight(attitude, weight):
+        """
+        Возвращает знаковый вес по отношению и весу.
+        """
+        return weight if attitude == 'positive' else -weight
+
+    @property
+    def attitude(self):
+        return 'negative' if self.signed_weight < 0 else 'positive'
+
+    @property
+    def weight(self):
+        return abs(self.signed_weight)
+
+    def __str__(self):
+        return f"{self.aspect} ({self.attitude}, {self.weight})"
+
+
+class NeighborList(models.Model):
+    """
+    Заголовок предвычисленного списка совместимых пользователей.
+    Наличие записи означает, что список пользователя вычислен,
+    даже если в нем нет ни одного совместимого пользователя.
+    top - максимальная длина списка: неполный список содержит
+    всех пользователей с совместимостью не ниже порога.
+    """
+    user = models.OneToOneField(
+        CustomUser,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='neighbor_list'
     )
+    computed_at = models.DateTimeField()
+    top = models.PositiveSmallIntegerField()
 
     def __str__(self):
-        return self.attitude
+        return f"{self.user} ({self.computed_at})"
 
 
-class Weight(models.Model):
-    weight = models.PositiveIntegerField(
-        choices=[(i, str(i)) for i in range(1, 11)]
+class CompatibleNeighbor(models.Model):
+    """
+    Запись предвычисленного списка совместимых пользователей:
+    совместимый пользователь, косинусное сходство и место в списке.
+    """
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='compatible_neighbors'
     )
+    neighbor = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    similarity = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'rank'],
+                name='unique_compatible_neighbor_rank'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['neighbor'], name='compatible_neighbor_idx'),
+        ]
 
     def __str__(self):
-        return str(self.weight)
+        return f"{self.user} -> {self.neighbor} ({self.similarity:.3f})"
+
 
+class MutualMatch(models.Model):
+    """
+    Пара взаимно совместимых пользователей: каждый находится
+    в предвычисленном списке другого. Пара хранится один раз,
+    пользователь с меньшим ID - в поле user_low.
+    """
+    user_low = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    user_high = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    similarity = models.FloatField()
 
-class Priority(models.Model):
-    aspect = models.ForeignKey(Aspect, on_delete=models.CASCADE)
-    attitude = models.ForeignKey(Attitude, on_delete=models.CASCADE)
-    weight = models.ForeignKey(Weight, on_delete=models.CASCADE)
-    users = models.ManyToManyField(CustomUser)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user_low', 'user_high'],
+                name='unique_mutual_match'
+            ),
+            models.CheckConstraint(
+                check=models.Q(user_low__lt=models.F('user_high')),
+                name='mutual_match_ordered'
+            ),
+        ]
 
     def __str__(self):
-        return f"{self.aspect} ({self.attitude}, {self.weight})"
+        return f"{self.user_low} <-> {self.user_high} ({self.similarity:.3f})"
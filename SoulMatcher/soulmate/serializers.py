@@ -4,7 +4,8 @@ from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
 from django.contrib.auth import get_user_model
 
-from .models import CustomUser, Priority, Aspect, Attitude, Weight
+from .matching import decode_cursor, get_setting
+from .models import CustomUser, UserPriority, Aspect
 
 User = get_user_model()
 
@@ -88,7 +89,9 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
 
 class PrioritySerializer(serializers.ModelSerializer):
     """
-    Сериализатор для модели Priority.
+    Сериализатор для модели UserPriority.
+
+    Отношение и вес хранятся в приоритете одним знаковым весом.
 
     Fields:
         - id:                ID приоритета
@@ -111,10 +114,9 @@ class PrioritySerializer(serializers.ModelSerializer):
         - validate_aspect:   Проверяет валидность аспекта
                              и возвращает объект Aspect
         - validate_attitude: Проверяет валидность отношения
-                             и возвращает объект Attitude
         - validate_weight:   Проверяет валидность веса
-                             и возвращает объект Weight
-        - create:            Создает новый приоритет
+        - create:            Создает новый приоритет пользователя
+                             или заменяет приоритет на тот же аспект
         - update:            Обновляет существующий приоритет
     """
     aspect = serializers.CharField(write_only=True)
@@ -125,14 +127,14 @@ class PrioritySerializer(serializers.ModelSerializer):
         source='aspect.aspect', read_only=True
     )
     display_attitude = serializers.StringRelatedField(
-        source='attitude.attitude', read_only=True
+        source='attitude', read_only=True
     )
     display_weight = serializers.StringRelatedField(
-        source='weight.weight', read_only=True
+        source='weight', read_only=True
     )
 
     class Meta:
-        model = Priority
+        model = UserPriority
         fields = [
             'id',
             'aspect',
@@ -166,36 +168,33 @@ class PrioritySerializer(serializers.ModelSerializer):
 
     def validate_attitude(self, value):
         """
-        Проверяет валидность отношения и возвращает объект Attitude.
+        Проверяет валидность отношения.
 
         Args:
             value: Значение отношения.
 
         Returns:
-            Объект Attitude.
+            Значение отношения.
 
         Raises:
             serializers.ValidationError: Если значение отношения некорректно.
         """
-        ALLOWED_ATTITUDES = {'positive', 'negative'}
-
-        if value not in ALLOWED_ATTITUDES:
+        if value not in dict(UserPriority.ATTITUDES):
             raise serializers.ValidationError(
                 "Некорректное значение отношения"
             )
 
-        attitude, created = Attitude.objects.get_or_create(attitude=value)
-        return attitude
+        return value
 
     def validate_weight(self, value):
         """
-        Проверяет валидность веса и возвращает объект Weight.
+        Проверяет валидность веса.
 
         Args:
             value: Значение веса.
 
         Returns:
-            Объект Weight.
+            Значение веса.
 
         Raises:
             serializers.ValidationError: Если значение веса некорректно.
@@ -205,28 +204,30 @@ class PrioritySerializer(serializers.ModelSerializer):
                 "Вес должен быть в диапазоне от 1 до 10"
             )
 
-        weight, created = Weight.objects.get_or_create(weight=value)
-        return weight
+        return value
 
     def create(self, validated_data):
         """
-        Создает новый приоритет.
+        Создает новый приоритет пользователя. Приоритет
+        пользователя на тот же аспект заменяется.
 
         Args:
             validated_data: Валидированные данные,
-                            содержащие информацию о приоритете.
+                            содержащие информацию о приоритете
+                            и пользователя (user).
 
         Returns:
-            Созданный объект приоритета.
+            Созданный или замененный объект приоритета.
         """
-        aspect = validated_data.pop('aspect')
-        attitude = validated_data.pop('attitude')
-        weight = validated_data.pop('weight')
-
-        priority = Priority.objects.create(
-            aspect=aspect,
-            attitude=attitude,
-            weight=weight
+        priority, created = UserPriority.objects.update_or_create(
+            user=validated_data['user'],
+            aspect=validated_data['aspect'],
+            defaults={
+                'signed_weight': UserPriority.to_signed_weight(
+                    validated_data['attitude'],
+                    validated_data['weight']
+                )
+            }
         )
 
         return priority
@@ -242,19 +243,127 @@ class PrioritySerializer(serializers.ModelSerializer):
 
         Returns:
             Обновленный объект приоритета.
-        """
-        aspect = validated_data.pop('aspect', None)
-        attitude = validated_data.pop('attitude', None)
-        weight = validated_data.pop('weight', None)
 
-        if aspect is not None:
+        Raises:
+            serializers.ValidationError: Если у пользователя уже есть
+                                         другой приоритет на аспект.
+        """
+        aspect = validated_data.get('aspect')
+
+        if aspect is not None and aspect.pk != instance.aspect_id:
+            if UserPriority.objects.filter(
+                user_id=instance.user_id, aspect=aspect
+            ).exists():
+                raise serializers.ValidationError(
+                    {"aspect": "Приоритет на этот аспект уже существует"}
+                )
             instance.aspect = aspect
 
-        if attitude is not None:
-            instance.attitude = attitude
-
-        if weight is not None:
-            instance.weight = weight
+        instance.signed_weight = UserPriority.to_signed_weight(
+            validated_data.get('attitude', instance.attitude),
+            validated_data.get('weight', instance.weight)
+        )
 
         instance.save()
         return instance
+
+
+class CompatibleUsersBatchSerializer(serializers.Serializer):
+    """
+    Сериализатор запроса пакетного поиска совместимых пользователей.
+
+    Fields:
+        - user_ids: Список ID пользователей
+                    (не более BATCH_MAX_USERS)
+    """
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False
+    )
+
+    def validate_user_ids(self, value):
+        """
+        Проверяет количество пользователей в запросе.
+
+        Args:
+            value: Список ID пользователей.
+
+        Returns:
+            Список ID пользователей.
+
+        Raises:
+            serializers.ValidationError: Если пользователей слишком много.
+        """
+        max_users = get_setting('BATCH_MAX_USERS')
+        if len(value) > max_users:
+            raise serializers.ValidationError(
+                f"Не более {max_users} пользователей в одном запросе"
+            )
+        return value
+
+
+class CompatibleUsersListingSerializer(serializers.Serializer):
+    """
+    Сериализатор параметров полной выдачи совместимых пользователей
+    (потоковой или постраничной).
+
+    Fields:
+        - threshold: Минимальный процент совместимости
+                     (по умолчанию COMPATIBILITY_THRESHOLD)
+        - page_size: Размер страницы (не более RESULTS_MAX_PAGE_SIZE)
+        - cursor:    Курсор следующей страницы из предыдущего ответа
+    """
+    threshold = serializers.FloatField(
+        min_value=0, max_value=100, required=False
+    )
+    page_size = serializers.IntegerField(min_value=1, required=False)
+    cursor = serializers.CharField(required=False)
+
+    def validate_page_size(self, value):
+        """
+        Проверяет размер страницы.
+
+        Args:
+            value: Размер страницы.
+
+        Returns:
+            Размер страницы.
+
+        Raises:
+            serializers.ValidationError: Если страница слишком большая.
+        """
+        max_size = get_setting('RESULTS_MAX_PAGE_SIZE')
+        if value > max_size:
+            raise serializers.ValidationError(
+                f"Не более {max_size} пользователей на странице"
+            )
+        return value
+
+    def validate_cursor(self, value):
+        """
+        Декодирует курсор.
+
+        Args:
+            value: Курсор.
+
+        Returns:
+            Пара (сходство, ID пользователя).
+
+        Raises:
+            serializers.ValidationError: Если курсор некорректен.
+        """
+        try:
+            return decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError("Некорректный курсор")
+
+
+class CompatibleUsersSearchSerializer(serializers.Serializer):
+    """
+    Сериализатор параметров поиска совместимых пользователей на лету.
+
+    Fields:
+        - budget_ms: Бюджет времени поиска в миллисекундах
+                     (по умолчанию SEARCH_BUDGET_MS)
+    """
+    budget_ms = serializers.IntegerField(min_value=1, required=False)
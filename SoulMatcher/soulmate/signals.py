@@ -0,0 +1,226 @@
+import logging
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from .database import note_writes
+from .models import CustomUser, UserPriority
+from .matching import \
+    ShardPool, \
+    bump_data_version, \
+    display_names, \
+    get_engine, \
+    get_setting, \
+    tiered_store, \
+    uses_engine
+from .matching.executor import get_background_executor
+from .matching.neighbors import \
+    invalidate_all_neighbor_lists, \
+    invalidate_neighbor_lists, \
+    neighbor_list_holders, \
+    update_neighbor_lists
+from .matching.sql import update_priority_norms
+
+logger = logging.getLogger(__name__)
+
+
+class CommittedChanges:
+    """
+    Изменения приоритетов, накопленные в текущей транзакции.
+
+    Применяются одним вызовом после фиксации, поэтому массовые
+    изменения (например, импорт данных) обрабатываются вместе,
+    а не по одному.
+    """
+
+    def __init__(self):
+        self.user_ids = set()
+        # ID пользователей, в списках которых находились измененные,
+        # или None, если списки не обновляются на месте
+        self.holders = None
+        self.applied = False
+
+    @classmethod
+    def pending(cls):
+        """
+        Возвращает изменения, уже ожидающие фиксации текущей
+        транзакции, или None.
+        """
+        connection = transaction.get_connection()
+        if connection.in_atomic_block:
+            for entry in connection.run_on_commit:
+                if isinstance(entry[1], cls) and not entry[1].applied:
+                    return entry[1]
+        return None
+
+    def add(self, user_ids, holders):
+        self.user_ids |= user_ids
+        if holders is not None:
+            self.holders = (self.holders or set()) | holders
+
+    def __call__(self):
+        self.applied = True
+        priorities_committed(self.user_ids, self.holders)
+
+
+def priorities_changed(user_ids):
+    """
+    Сообщает движку подбора об изменении приоритетов пользователей.
+
+    Пользователи помечаются сразу (чтобы изменения были видны
+    в этой же транзакции) и повторно после фиксации транзакции,
+    чтобы параллельное обновление снимка не закрепило
+    незафиксированное состояние. После фиксации пересчитываются
+    нормы векторов пользователей, а затронутые предвычисленные
+    списки исправляются на месте (NEIGHBORS_INCREMENTAL),
+    иначе они удаляются сразу. Версия данных, входящая в ключи
+    кэша выдачи, сдвигается, и закэшированные выдачи устаревают.
+
+    :param user_ids: ID пользователей с измененными приоритетами
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    get_engine().mark_dirty(user_ids)
+    tiered_store.mark_dirty(user_ids)
+    ShardPool.mark_dirty(user_ids)
+
+    holders = None
+    if get_setting('NEIGHBORS_MAX_AGE'):
+        if get_setting('NEIGHBORS_INCREMENTAL'):
+            # Запоминаются до фиксации: при удалении пользователя
+            # его записи в чужих списках удаляются каскадно
+            holders = neighbor_list_holders(user_ids)
+        else:
+            invalidate_neighbor_lists(user_ids)
+
+    changes = CommittedChanges.pending()
+    if changes is not None:
+        changes.add(user_ids, holders)
+    else:
+        # Версия данных сдвигается при первом изменении в транзакции
+        # и после фиксации, когда применены все изменения
+        bump_data_version(user_ids)
+        changes = CommittedChanges()
+        changes.add(user_ids, holders)
+        transaction.on_commit(changes)
+
+
+def priorities_committed(user_ids, holders):
+    """
+    Применяет зафиксированные изменения приоритетов.
+
+    В потоке фиксации пользователи только помечаются, а версия
+    данных сдвигается. Пересчет норм векторов и исправление
+    предвычисленных списков, которое применяет изменения к снимку
+    движка, в обслуживающем процессе выполняются в фоновом потоке
+    (PRIORITY_CHANGES_BACKGROUND), поэтому запрос записи не ждет
+    ни их, ни построения снимка.
+
+    :param user_ids: ID пользователей с измененными приоритетами
+    :param holders:  ID пользователей, в списках которых они
+                     находились, или None, если списки
+                     не обновляются на месте
+    """
+    get_engine().mark_dirty(user_ids)
+    tiered_store.mark_dirty(user_ids)
+    ShardPool.mark_dirty(user_ids)
+    # Чтения этих пользователей какое-то время идут в основную БД,
+    # пока реплика не получила изменения
+    note_writes(user_ids)
+    if not applies_in_background():
+        apply_committed_changes(user_ids, holders)
+        return
+
+    bump_data_version(user_ids)
+    get_background_executor().submit(
+        apply_committed_changes_safely, user_ids, holders
+    )
+
+
+def applies_in_background():
+    """
+    Проверяет, обрабатываются ли зафиксированные изменения
+    в фоновом потоке. Внутри транзакции они обрабатываются
+    в потоке вызывающего: фоновый поток не увидел бы
+    ее незафиксированных изменений.
+    """
+    return (
+        get_engine().serving
+        and get_setting('PRIORITY_CHANGES_BACKGROUND')
+        and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+    )
+
+
+def apply_committed_changes(user_ids, holders):
+    """
+    Пересчитывает нормы векторов пользователей и исправляет
+    предвычисленные списки.
+    """
+    try:
+        update_priority_norms(user_ids)
+        if holders is not None:
+            update_neighbor_lists_safely(user_ids, holders)
+    finally:
+        # Сдвигается последней: иначе выдача по еще не исправленным
+        # спискам и нормам закэшировалась бы под новой версией
+        bump_data_version(user_ids)
+
+
+def apply_committed_changes_safely(user_ids, holders):
+    try:
+        apply_committed_changes(user_ids, holders)
+    except Exception:
+        logger.exception('Failed to apply committed priority changes')
+    finally:
+        # Фоновый поток открыл собственные соединения с БД
+        connections.close_all()
+
+
+def update_neighbor_lists_safely(user_ids, holders):
+    """
+    Исправляет предвычисленные списки на месте, а при ошибке
+    или слишком большом изменении удаляет их. Если способ поиска
+    по умолчанию не использует резидентный снимок движка (sql,
+    mmap, tiered), списки удаляются, чтобы исправление не строило
+    снимок в каждом процессе.
+    """
+    if len(user_ids) > get_setting('NEIGHBORS_INCREMENTAL_LIMIT'):
+        # Исправление на месте дороже полного пересчета
+        invalidate_all_neighbor_lists()
+        return
+    if not uses_engine():
+        invalidate_neighbor_lists(user_ids, holders)
+        return
+
+    try:
+        update_neighbor_lists(get_engine().applied_snapshot(), user_ids, holders)
+    except DatabaseError:
+        logger.exception('Failed to update precomputed neighbor lists')
+        invalidate_neighbor_lists(user_ids, holders)
+
+
+@receiver(post_save, sender=UserPriority)
+@receiver(post_delete, sender=UserPriority)
+def priority_changed(sender, instance, **kwargs):
+    priorities_changed([instance.user_id])
+
+
+@receiver(pre_delete, sender=CustomUser)
+def user_deleting(sender, instance, **kwargs):
+    priorities_changed([instance.pk])
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def user_changed(sender, instance, **kwargs):
+    """
+    Удаляет имя пользователя из кэша имен сразу и после фиксации
+    транзакции, чтобы параллельный запрос не закэшировал
+    незафиксированное старое имя.
+    """
+    user_id = instance.pk
+    display_names.invalidate(user_id)
+    transaction.on_commit(lambda: display_names.invalidate(user_id))
@@ -1,8 +1,17 @@
+from django.core.cache import cache
+from django.test import override_settings
+
 from rest_framework.test import APITestCase
 
+from ..matching import display_names, get_engine, tiered_store
 from ..models import CustomUser
 
 
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+})
 class BaseTestCase(APITestCase):
     """
     Базовый класс для тестов API.
@@ -19,10 +28,15 @@ class BaseTestCase(APITestCase):
         Настройка тестового случая.
 
         Этот метод вызывается перед выполнением каждого метода теста.
+        Сбрасывает резидентный снимок движка подбора, горячий уровень
+        векторов, кэш имен и кэш выдачи, так как откат транзакции теста не порождает
+        сигналов об изменении приоритетов и пользователей.
 
         """
-
-        # Код настройки
+        get_engine().reset()
+        tiered_store.reset()
+        display_names.clear()
+        cache.clear()
 
     def create_user(
             self, username='testuser',
@@ -1,29 +1,43 @@
+import json
+import threading
 import time
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
 
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
 
 from rest_framework import status
 
 from .base import BaseTestCase
-from ..models import CustomUser, Priority, Aspect, Attitude, Weight
+from ..management.commands import compute_neighbors as neighbors_command
+from ..matching import display_names, get_data_version, get_engine, result_cache, to_percentage, warm_up
+from ..matching.executor import get_background_executor
+from ..matching.neighbors import load_neighbor_lists
+from ..models import CustomUser, UserPriority, Aspect, NeighborList, CompatibleNeighbor, MutualMatch
 
 
-class CompatibleUsersViewTestCase(BaseTestCase):
+class CompatibleUsersBaseTestCase(BaseTestCase):
     """
-    Тесты для представления CompatibleUsersView.
+    Подготовка данных для тестов совместимых пользователей.
     """
 
     def setUp(self):
         """
         Подготовка данных для тестов.
         """
+        super().setUp()
         self.aspect1 = Aspect.objects.create(aspect="Aspect 1")
         self.aspect2 = Aspect.objects.create(aspect="Aspect 2")
 
-        self.weight = Weight.objects.create(weight=1)
+        self.weight = 1
 
-        self.attitude_positive = Attitude.objects.create(attitude="positive")
-        self.attitude_negative = Attitude.objects.create(attitude="negative")
+        self.attitude_positive = "positive"
+        self.attitude_negative = "negative"
 
         self.user1 = self.create_custom_user(username="user1", email="user1@example.com")
         self.user2 = self.create_custom_user(username="user2", email="user2@example.com")
@@ -36,12 +50,20 @@ class CompatibleUsersViewTestCase(BaseTestCase):
 
     def create_priority(self, user, aspect, weight, attitude):
         """
-        Создание приоритета для пользователя.
+        Создание (замена) приоритета пользователя на аспект.
         """
-        priority = Priority.objects.create(aspect=aspect, weight=weight, attitude=attitude)
-        priority.users.add(user)
+        priority, _ = UserPriority.objects.update_or_create(
+            user=user, aspect=aspect,
+            defaults={'signed_weight': UserPriority.to_signed_weight(attitude, weight)}
+        )
         return priority
 
+
+class CompatibleUsersViewTestCase(CompatibleUsersBaseTestCase):
+    """
+    Тесты для представления CompatibleUsersView.
+    """
+
     def test_different_aspects(self):
         """
         Тестирование ситуации, когда у пользователей разные аспекты ->
@@ -132,7 +154,7 @@ class CompatibleUsersViewTestCase(BaseTestCase):
         """
         self.create_priority(self.user1, self.aspect1, self.weight, self.attitude_positive)
 
-        weight2 = Weight.objects.create(weight=2)
+        weight2 = 2
         self.create_priority(self.user2, self.aspect1, weight2, self.attitude_positive)
 
         url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
@@ -168,37 +190,31 @@ class CompatibleUsersViewTestCase(BaseTestCase):
         aspect4 = Aspect.objects.create(aspect="Aspect 4")
         aspect5 = Aspect.objects.create(aspect="Aspect 5")
 
-        weight10 = Weight.objects.create(weight=10)
-        weight5 = Weight.objects.create(weight=5)
-        weight0 = Weight.objects.create(weight=0)
+        # Нулевых весов нет: аспект без приоритета не входит в вектор
+        weight10 = 10
+        weight5 = 5
 
         # Приоритеты для user1
         self.create_priority(self.user1, self.aspect1, weight10, self.attitude_positive)
         self.create_priority(self.user1, self.aspect2, weight10, self.attitude_positive)
         self.create_priority(self.user1, aspect3, weight10, self.attitude_positive)
         self.create_priority(self.user1, aspect4, weight10, self.attitude_positive)
-        self.create_priority(self.user1, aspect5, weight0, self.attitude_positive)
 
         # Приоритеты для user2 (87.5% совместимости)
         self.create_priority(self.user2, self.aspect1, weight5, self.attitude_positive)
         self.create_priority(self.user2, self.aspect2, weight5, self.attitude_positive)
         self.create_priority(self.user2, aspect3, weight5, self.attitude_positive)
-        self.create_priority(self.user2, aspect4, weight0, self.attitude_positive)
         self.create_priority(self.user2, aspect5, weight5, self.attitude_positive)
 
         # Приоритеты для user3 (90.8% совместимости)
         self.create_priority(user3, self.aspect1, weight5, self.attitude_positive)
         self.create_priority(user3, self.aspect2, weight5, self.attitude_positive)
         self.create_priority(user3, aspect3, weight10, self.attitude_positive)
-        self.create_priority(user3, aspect4, weight0, self.attitude_positive)
-        self.create_priority(user3, aspect5, weight0, self.attitude_positive)
 
         # Приоритеты для user4 (93.3% совместимости)
         self.create_priority(user4, self.aspect1, weight5, self.attitude_positive)
         self.create_priority(user4, self.aspect2, weight5, self.attitude_positive)
         self.create_priority(user4, aspect3, weight5, self.attitude_positive)
-        self.create_priority(user4, aspect4, weight10, self.attitude_positive)
-        self.create_priority(user4, aspect4, weight0, self.attitude_positive)
 
         url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
         response = self.client.get(url)
@@ -276,3 +292,557 @@ class CompatibleUsersViewTestCase(BaseTestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertLessEqual(execution_time, max_execution_time)
+
+    def test_search_modes(self):
+        """
+        Тестирование выбора способа поиска параметром mode ->
+        Все способы находят пользователя с идентичными приоритетами
+        """
+        self.create_priority(self.user1, self.aspect1, self.weight, self.attitude_positive)
+        self.create_priority(self.user2, self.aspect1, self.weight, self.attitude_positive)
+
+        url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
+        for mode in ('exact', 'inverted', 'lsh'):
+            response = self.client.get(url, {'mode': mode})
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([user['user_id'] for user in response.data['compatible_users']], [self.user2.id])
+
+    def test_sql_search_matches_exact(self):
+        """
+        Тестирование совпадения выдачи на стороне БД с точным поиском,
+        в том числе при повторном приоритете на тот же аспект
+        """
+        users = [self.create_custom_user(username=f"user{i}", email=f"user{i}@example.com") for i in range(3, 30)]
+        weights = list(range(2, 11))
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, user in enumerate([self.user1, self.user2] + users):
+                self.create_priority(user, self.aspect1, weights[i % 9], self.attitude_positive)
+                attitude = self.attitude_positive if i % 3 else self.attitude_negative
+                self.create_priority(user, self.aspect2, weights[(i * 7) % 9], attitude)
+            self.create_priority(users[0], self.aspect1, self.weight, self.attitude_negative)
+
+        for user in [self.user1, self.user2] + users:
+            url = reverse('compatible-users', kwargs={'user_id': user.id})
+            sql = self.client.get(url, {'mode': 'sql'})
+            exact = self.client.get(url, {'mode': 'exact'})
+
+            self.assertEqual(sql.status_code, status.HTTP_200_OK)
+            self.assertEqual(sql.data['compatible_users'], exact.data['compatible_users'])
+
+    def test_sql_search_min_overlap(self):
+        """
+        Тестирование отбора кандидатов поиска на стороне БД
+        по минимальному количеству общих аспектов
+        """
+        user3 = self.create_custom_user(username="user3", email="user3@example.com")
+        strong = 10
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_priority(self.user1, self.aspect1, strong, self.attitude_positive)
+            self.create_priority(self.user1, self.aspect2, self.weight, self.attitude_positive)
+            self.create_priority(self.user2, self.aspect1, strong, self.attitude_positive)
+            self.create_priority(user3, self.aspect1, strong, self.attitude_positive)
+            self.create_priority(user3, self.aspect2, self.weight, self.attitude_positive)
+
+        url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
+        for min_overlap, expected in ((1, [user3.id, self.user2.id]), (2, [user3.id]), (3, [])):
+            cache.clear()
+            with override_settings(SOULMATE_MATCHING={'SQL_MIN_OVERLAP': min_overlap}):
+                response = self.client.get(url, {'mode': 'sql'})
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([user['user_id'] for user in response.data['compatible_users']], expected)
+
+    def test_names_loaded_in_one_query(self):
+        """
+        Тестирование загрузки имен одним запросом после отбора
+        и обновления имени после изменения пользователя
+        """
+        users = [self.create_custom_user(username=f"user{i}", email=f"user{i}@example.com") for i in range(3, 33)]
+        for user in users:
+            self.create_priority(user, self.aspect1, self.weight, self.attitude_positive)
+        self.create_priority(self.user1, self.aspect1, self.weight, self.attitude_positive)
+
+        url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
+        self.client.get(url, {'mode': 'exact'})
+        display_names.clear()
+
+        # Выдача берется из кэша, имена 20 пользователей - одним запросом
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'mode': 'exact'})
+        self.assertEqual(response.data['compatible_users'][0]['name'], users[0].username)
+
+        # Имена берутся из кэша имен
+        with self.assertNumQueries(0):
+            self.client.get(url, {'mode': 'exact'})
+
+        users[0].first_name = "Ivan"
+        users[0].save()
+
+        response = self.client.get(url, {'mode': 'exact'})
+        self.assertEqual(response.data['compatible_users'][0]['name'], "Ivan")
+
+    def test_result_cache(self):
+        """
+        Тестирование кэширования выдачи до изменения приоритетов
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_priority(self.user1, self.aspect1, self.weight, self.attitude_positive)
+            self.create_priority(self.user2, self.aspect1, self.weight, self.attitude_positive)
+        user3 = self.create_custom_user(username="user3", email="user3@example.com")
+
+        url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
+        first = self.client.get(url)
+        second = self.client.get(url)
+        self.assertEqual(first.data, second.data)
+
+        stats_url = reverse('compatible-users-cache-stats')
+        self.assertEqual(self.client.get(stats_url).status_code, status.HTTP_401_UNAUTHORIZED)
+        admin = self.create_custom_user(username="admin", email="admin@example.com")
+        admin.is_staff = True
+        admin.save()
+        self.client.force_authenticate(admin)
+
+        stats = self.client.get(stats_url).data
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_priority(user3, self.aspect1, self.weight, self.attitude_positive)
+        response = self.client.get(url)
+
+        self.assertEqual([user['user_id'] for user in response.data['compatible_users']], [self.user2.id, user3.id])
+        self.assertEqual(self.client.get(stats_url).data['misses'], 2)
+
+    @override_settings(SOULMATE_MATCHING={'SINGLE_FLIGHT_CACHE_LOCK': True, 'SINGLE_FLIGHT_POLL_INTERVAL': 0.01})
+    def test_cache_lock(self):
+        """
+        Тестирование блокировки вычисления в кэше, захваченной другим процессом ->
+        Запрос ждет выдачу другого процесса, а если блокировка снята
+        без выдачи - вычисляет ее сам
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_priority(self.user1, self.aspect1, self.weight, self.attitude_positive)
+            self.create_priority(self.user2, self.aspect1, self.weight, self.attitude_positive)
+        url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
+        other = {"matches": [(self.user1.id, 0.5)], "source": "live", "computed_at": None}
+
+        for stored, expected in ((other, [self.user1.id]), (None, [self.user2.id])):
+            cache.clear()
+            version = get_data_version()
+            self.assertTrue(result_cache.acquire(self.user1.id, 'exact', version))
+
+            def finish():
+                time.sleep(0.1)
+                if stored is not None:
+                    result_cache.set(self.user1.id, 'exact', stored, version)
+                result_cache.release(self.user1.id, 'exact', version)
+
+            thread = threading.Thread(target=finish)
+            thread.start()
+            response = self.client.get(url, {'mode': 'exact'})
+            thread.join()
+
+            self.assertEqual([user['user_id'] for user in response.data['compatible_users']], expected)
+
+    def test_unknown_search_mode(self):
+        """
+        Тестирование неизвестного способа поиска
+        """
+        url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
+        response = self.client.get(url, {'mode': 'unknown'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CompatibleUsersBatchViewTestCase(CompatibleUsersBaseTestCase):
+    """
+    Тесты для представления CompatibleUsersBatchView.
+    """
+
+    def post_batch(self, user_ids):
+        """
+        Выполнение пакетного запроса.
+        """
+        return self.client.post(reverse('compatible-users-batch'), {'user_ids': user_ids}, format='json')
+
+    def test_batch_matches_single_requests(self):
+        """
+        Тестирование совпадения пакетной выдачи с выдачей для одного пользователя
+        """
+        users = [self.create_custom_user(username=f"user{i}", email=f"user{i}@example.com") for i in range(3, 30)]
+        weights = list(range(2, 11))
+        for i, user in enumerate([self.user1, self.user2] + users):
+            self.create_priority(user, self.aspect1, weights[i % 9], self.attitude_positive)
+            attitude = self.attitude_positive if i % 3 else self.attitude_negative
+            self.create_priority(user, self.aspect2, weights[(i * 7) % 9], attitude)
+
+        user_ids = [self.user1.id, self.user2.id, users[5].id]
+        response = self.post_batch(user_ids)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for user_id in user_ids:
+            single = self.client.get(reverse('compatible-users', kwargs={'user_id': user_id}))
+            self.assertEqual(response.data['compatible_users'][user_id], single.data['compatible_users'])
+
+    def test_batch_errors(self):
+        """
+        Тестирование пользователей без приоритетов и несуществующих пользователей
+        """
+        self.create_priority(self.user1, self.aspect1, self.weight, self.attitude_positive)
+        self.create_priority(self.user2, self.aspect1, self.weight, self.attitude_positive)
+
+        response = self.post_batch([self.user1.id, self.user2.id + 100])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['compatible_users'][self.user1.id]), 1)
+        self.assertIn(self.user2.id + 100, response.data['errors'])
+
+    def test_batch_invalid_request(self):
+        """
+        Тестирование пустого списка пользователей
+        """
+        response = self.post_batch([])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CompatibleNeighborsTestCase(CompatibleUsersBaseTestCase):
+    """
+    Тесты для предвычисленных списков совместимых пользователей.
+    """
+
+    def setUp(self):
+        """
+        Подготовка пользователей с различными приоритетами.
+        """
+        super().setUp()
+        self.users = [self.create_custom_user(username=f"user{i}", email=f"user{i}@example.com") for i in range(3, 30)]
+        weights = list(range(2, 11))
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, user in enumerate([self.user1, self.user2] + self.users):
+                self.create_priority(user, self.aspect1, weights[i % 9], self.attitude_positive)
+                attitude = self.attitude_positive if i % 3 else self.attitude_negative
+                self.create_priority(user, self.aspect2, weights[(i * 7) % 9], attitude)
+
+    def get_compatible_users(self, user_id, **params):
+        """
+        Выполнение запроса списка совместимых пользователей.
+        """
+        return self.client.get(reverse('compatible-users', kwargs={'user_id': user_id}), params)
+
+    def test_precomputed_matches_live(self):
+        """
+        Тестирование совпадения предвычисленной выдачи с выдачей на лету
+        """
+        call_command('compute_neighbors', workers=2, block_size=7, stdout=StringIO())
+
+        for user in [self.user1, self.user2] + self.users:
+            precomputed = self.get_compatible_users(user.id)
+            live = self.get_compatible_users(user.id, mode='exact')
+
+            self.assertEqual(precomputed.data['source'], 'precomputed')
+            self.assertIsNotNone(precomputed.data['computed_at'])
+            self.assertEqual(live.data['source'], 'live')
+            self.assertEqual(precomputed.data['compatible_users'], live.data['compatible_users'])
+
+    def assertListsMatchLive(self, top):
+        """
+        Проверка совпадения всех сохраненных списков с точным поиском
+        """
+        snapshot = get_engine().snapshot()
+        lists = load_neighbor_lists(CustomUser.objects.values_list('id', flat=True))
+        for user_id in snapshot.user_ids[snapshot.norms > 0].tolist():
+            self.assertEqual(lists[user_id], (top, snapshot.search(user_id, limit=top)))
+
+        neighbors = {user_id: {match_id for match_id, _ in matches} for user_id, (_, matches) in lists.items()}
+        self.assertEqual(
+            set(MutualMatch.objects.values_list('user_low_id', 'user_high_id')),
+            {
+                (user_id, match_id)
+                for user_id, matches in neighbors.items()
+                for match_id in matches
+                if user_id < match_id and user_id in neighbors.get(match_id, ())
+            }
+        )
+
+    def test_updated_on_priority_change(self):
+        """
+        Тестирование исправления списков на месте при изменении приоритетов,
+        в том числе списков, из которых пользователь выбывает
+        """
+        call_command('compute_neighbors', workers=1, top=3, stdout=StringIO())
+        aspect3 = Aspect.objects.create(aspect="Aspect 3")
+        weight10 = 10
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_priority(self.users[0], aspect3, self.weight, self.attitude_positive)
+        self.assertListsMatchLive(3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            priority = UserPriority.objects.get(user=self.users[4], aspect=self.aspect2)
+            priority.signed_weight = UserPriority.to_signed_weight(self.attitude_negative, weight10)
+            priority.save()
+        self.assertListsMatchLive(3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserPriority.objects.filter(user=self.users[7], aspect=self.aspect1).delete()
+        self.assertListsMatchLive(3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[9].delete()
+        self.assertListsMatchLive(3)
+
+        self.assertEqual(self.get_compatible_users(self.user1.id).data['source'], 'precomputed')
+
+    def test_patched_in_background(self):
+        """
+        Тестирование записи приоритета в обслуживающем процессе ->
+        Запрос не ждет блокировки построения снимка, а списки
+        исправляются в фоновом потоке
+        """
+        call_command('compute_neighbors', workers=1, top=3, stdout=StringIO())
+        engine = get_engine()
+        engine.snapshot()
+        holding, release = threading.Event(), threading.Event()
+
+        def hold():
+            with engine._build_lock:
+                holding.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold)
+        self.client.force_authenticate(user=self.users[0])
+        with patch('soulmate.signals.applies_in_background', return_value=True), \
+                patch('soulmate.signals.update_priority_norms') as update_norms, \
+                patch('soulmate.signals.update_neighbor_lists') as update_lists, \
+                patch.object(engine, '_apply', lambda data_version, prepare=False: None):
+            holder.start()
+            holding.wait(5)
+            try:
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.client.post(
+                        reverse('Priorities-list'), {'aspect': 'Aspect 3', 'attitude': 'positive', 'weight': 5}
+                    )
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+                self.assertFalse(update_lists.called)
+            finally:
+                release.set()
+                holder.join()
+            get_background_executor().submit(lambda: None).result(5)
+
+        update_norms.assert_called_once_with({self.users[0].id})
+        update_lists.assert_called_once()
+
+    def test_priority_change_during_computation(self):
+        """
+        Тестирование изменения приоритетов во время вычисления списков ->
+        Блоки, вычисленные по прежнему снимку, не оставляют устаревших списков
+        """
+        call_command('compute_neighbors', workers=1, top=3, stdout=StringIO())
+        compute = neighbors_command.compute_neighbor_lists
+
+        def compute_with_changes(*args):
+            for number, results in enumerate(compute(*args)):
+                yield results
+                if number == 0:
+                    with self.captureOnCommitCallbacks(execute=True):
+                        priority = UserPriority.objects.get(user=self.users[20], aspect=self.aspect2)
+                        priority.signed_weight = -priority.signed_weight
+                        priority.save()
+                        UserPriority.objects.filter(user=self.users[21]).delete()
+
+        with patch.object(neighbors_command, 'compute_neighbor_lists', compute_with_changes):
+            call_command('compute_neighbors', workers=1, top=3, block_size=7, stdout=StringIO())
+
+        self.assertFalse(NeighborList.objects.filter(user=self.users[21]).exists())
+        self.assertListsMatchLive(3)
+
+    @override_settings(SOULMATE_MATCHING={'NEIGHBORS_INCREMENTAL': False})
+    def test_invalidated_on_priority_change(self):
+        """
+        Тестирование отказа от предвычисленных списков пользователя,
+        изменившего приоритеты, и списков, в которых он находится
+        """
+        call_command('compute_neighbors', workers=1, stdout=StringIO())
+        neighbor_id = self.get_compatible_users(self.user1.id).data['compatible_users'][0]['user_id']
+
+        aspect3 = Aspect.objects.create(aspect="Aspect 3")
+        self.create_priority(CustomUser.objects.get(id=neighbor_id), aspect3, self.weight, self.attitude_positive)
+
+        self.assertEqual(self.get_compatible_users(self.user1.id).data['source'], 'live')
+        self.assertEqual(self.get_compatible_users(neighbor_id).data['source'], 'live')
+
+    @override_settings(SOULMATE_MATCHING={'SEARCH_MODE': 'sql'})
+    def test_invalidated_without_engine(self):
+        """
+        Тестирование способа поиска без резидентного снимка ->
+        Снимок не строится ни при старте процесса, ни при изменении
+        приоритетов, а затронутые списки удаляются
+        """
+        call_command('compute_neighbors', workers=1, stdout=StringIO())
+        get_engine().reset()
+        warm_up()
+        neighbor_id = self.get_compatible_users(self.user1.id).data['compatible_users'][0]['user_id']
+
+        aspect3 = Aspect.objects.create(aspect="Aspect 3")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_priority(CustomUser.objects.get(id=neighbor_id), aspect3, self.weight, self.attitude_positive)
+
+        self.assertEqual(self.get_compatible_users(self.user1.id).data['source'], 'live')
+        self.assertEqual(self.get_compatible_users(neighbor_id).data['source'], 'live')
+        self.assertFalse(get_engine().stats()['built'])
+
+    @override_settings(SOULMATE_MATCHING={'NEIGHBORS_MAX_AGE': 60})
+    def test_stale_lists_not_used(self):
+        """
+        Тестирование выдачи на лету при устаревших списках
+        и удаления списков пользователей без приоритетов
+        """
+        call_command('compute_neighbors', workers=1, stdout=StringIO())
+        NeighborList.objects.update(computed_at=timezone.now() - timedelta(minutes=2))
+
+        self.assertEqual(self.get_compatible_users(self.user1.id).data['source'], 'live')
+
+        UserPriority.objects.filter(user=self.user2).delete()
+        call_command('compute_neighbors', workers=1, stdout=StringIO())
+
+        self.assertFalse(NeighborList.objects.filter(user=self.user2).exists())
+        self.assertFalse(CompatibleNeighbor.objects.filter(neighbor=self.user2).exists())
+
+    def test_mutual_matches(self):
+        """
+        Тестирование взаимной выдачи ->
+        Предвычисленные пары должны совпадать с поиском на лету,
+        и каждый пользователь выдачи должен находиться в списке другого
+        """
+        call_command('compute_neighbors', workers=1, top=5, stdout=StringIO())
+
+        with override_settings(SOULMATE_MATCHING={'COMPATIBLE_USERS_LIMIT': 5}):
+            for user in [self.user1, self.user2] + self.users:
+                precomputed = self.get_compatible_users(user.id, mutual='true')
+                live = self.get_compatible_users(user.id, mode='exact', mutual='true')
+
+                self.assertEqual(precomputed.data['source'], 'precomputed')
+                self.assertEqual(precomputed.data['compatible_users'], live.data['compatible_users'])
+                for match in precomputed.data['compatible_users']:
+                    self.assertIn(user.id, [
+                        reverse_match['user_id']
+                        for reverse_match in self.get_compatible_users(match['user_id']).data['compatible_users']
+                    ])
+
+        self.assertTrue(MutualMatch.objects.exists())
+
+    def test_async_view_matches_sync(self):
+        """
+        Тестирование совпадения ответов асинхронного представления
+        с CompatibleUsersView для разных способов поиска
+        """
+        def get(name, user_id, **params):
+            return self.client.get(reverse(name, kwargs={'user_id': user_id}), params)
+
+        call_command('compute_neighbors', workers=1, stdout=StringIO())
+        for user in [self.user1, self.user2] + self.users[::5]:
+            for params in ({}, {'mode': 'exact'}, {'mode': 'inverted'}, {'mode': 'sql'}, {'mutual': 'true'},
+                           {'mode': 'exact', 'mutual': 'true'}):
+                cache.clear()
+                expected = get('compatible-users', user.id, **params).json()
+                cache.clear()
+                self.assertEqual(get('async-compatible-users', user.id, **params).json(), expected)
+
+        self.assertEqual(get('async-compatible-users', 10 ** 6).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(get('async-compatible-users', self.user1.id, mode='x').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def get_full_listing(self, user_id, threshold):
+        """
+        Полная выдача точным поиском по снимку.
+        """
+        return [
+            {'user_id': match_id, 'compatibility_percentage': to_percentage(similarity)}
+            for match_id, similarity in get_engine().snapshot().search(user_id, threshold, 10 ** 6)
+        ]
+
+    def test_stream_all_matches(self):
+        """
+        Тестирование потоковой выдачи NDJSON ->
+        Выдаются все пользователи не ниже порога в порядке убывания совместимости
+        """
+        for threshold in (60, 0):
+            response = self.get_compatible_users(self.user1.id, stream='true', threshold=threshold)
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            records = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+            self.assertEqual(
+                [{key: record[key] for key in ('user_id', 'compatibility_percentage')} for record in records],
+                self.get_full_listing(self.user1.id, threshold)
+            )
+            self.assertTrue(all(record['name'] for record in records))
+
+        # Без ограничения COMPATIBLE_USERS_LIMIT
+        self.assertGreater(len(records), 20)
+
+    def test_cursor_pages(self):
+        """
+        Тестирование постраничной выдачи с курсором ->
+        Страницы синхронного и асинхронного представлений
+        вместе совпадают с полной выдачей
+        """
+        for name in ('compatible-users', 'async-compatible-users'):
+            url = reverse(name, kwargs={'user_id': self.user2.id})
+            records, params = [], {'page_size': 4, 'threshold': 50}
+            while True:
+                page = self.client.get(url, params).json()
+                self.assertLessEqual(len(page['compatible_users']), 4)
+                records.extend(page['compatible_users'])
+                if page['next_cursor'] is None:
+                    break
+                params['cursor'] = page['next_cursor']
+
+            self.assertEqual(
+                [{key: record[key] for key in ('user_id', 'compatibility_percentage')} for record in records],
+                self.get_full_listing(self.user2.id, 50)
+            )
+
+    def test_listing_invalid_params(self):
+        """
+        Тестирование некорректных параметров полной выдачи -> Ответ 400
+        """
+        for params in ({'cursor': 'x'}, {'page_size': 0}, {'page_size': 10 ** 6}, {'stream': 'true', 'threshold': 101},
+                       {'stream': 'true', 'mutual': 'true'}, {'page_size': 5, 'mode': 'lsh'}):
+            response = self.get_compatible_users(self.user1.id, **params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_budget(self):
+        """
+        Тестирование поиска с бюджетом времени, в который он укладывается ->
+        Полная выдача, совпадающая с точным поиском
+        """
+        for user in [self.user1, self.user2] + self.users[::5]:
+            cache.clear()
+            expected = self.get_compatible_users(user.id, mode='exact').data
+            for params in ({'budget_ms': 60000}, {'budget_ms': 60000, 'mode': 'exact'}):
+                cache.clear()
+                with override_settings(SOULMATE_MATCHING={'SEARCH_MODE': 'exact'}):
+                    response = self.get_compatible_users(user.id, **params)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertFalse(response.data['partial'])
+                self.assertNotIn('scanned', response.data)
+                self.assertEqual(response.data['compatible_users'], expected['compatible_users'])
+
+                cache.clear()
+                with override_settings(SOULMATE_MATCHING={'SEARCH_MODE': 'exact'}):
+                    async_response = self.client.get(
+                        reverse('async-compatible-users', kwargs={'user_id': user.id}), params
+                    )
+                self.assertEqual(async_response.json(), response.json())
+
+    def test_search_budget_invalid_params(self):
+        """
+        Тестирование некорректного бюджета времени и бюджета
+        для способов поиска кроме точного (в том числе для способа
+        по умолчанию SEARCH_MODE) -> Ответ 400
+        """
+        for params in ({'budget_ms': 0}, {'budget_ms': 'x'}, {'budget_ms': 100, 'mode': 'inverted'},
+                       {'budget_ms': 100, 'mutual': 'true'}, {'budget_ms': 100}):
+            response = self.get_compatible_users(self.user1.id, **params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
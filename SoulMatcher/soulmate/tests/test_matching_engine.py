@@ -0,0 +1,1056 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest.mock import patch
+
+import numpy as np
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+
+from .base import BaseTestCase
+from ..database import ReplicaRouter, apply_pragmas, note_replica_synced, note_writes, primary_reads, read_database, \
+    read_your_writes, replica_has_version, replica_reads, track_replica_reads
+from ..matching import get_engine, tiered_store, MatchingSnapshot, InvertedIndex, LSHIndex, IVFIndex, IVFModel, VectorStore, ShardPool, \
+    SingleFlight, budgeted_search, bump_data_version, find_compatible_users, find_mutual_users, get_data_version, result_cache, \
+    run_scoring, warm_up
+from ..matching.data import load_signed_weights
+from ..matching.sql import update_priority_norms
+from ..models import CustomUser, UserPriority, Aspect
+
+
+class MatchingEngineTestCase(BaseTestCase):
+    """
+    Тесты синхронизации резидентного движка подбора с приоритетами.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        super().setUp()
+        self.aspect = Aspect.objects.create(aspect="Aspect 1")
+        self.weight = 3
+        self.positive = "positive"
+        self.negative = "negative"
+
+        self.user1 = CustomUser.objects.create(username="user1", email="user1@example.com")
+        self.user2 = CustomUser.objects.create(username="user2", email="user2@example.com")
+
+        self.priority = self.create_priority(self.user1, self.aspect, self.positive)
+
+    def create_priority(self, user, aspect, attitude):
+        """
+        Создание приоритета для пользователя.
+        """
+        return UserPriority.objects.create(
+            user=user, aspect=aspect, signed_weight=UserPriority.to_signed_weight(attitude, self.weight)
+        )
+
+    def get_weight(self, user, aspect):
+        """
+        Получение знакового веса пользователя по аспекту из снимка.
+        """
+        snapshot = get_engine().snapshot()
+        vector = snapshot.vector(user.id)
+        if vector is None:
+            return 0
+        column = list(snapshot.aspect_ids).index(aspect.id)
+        return vector[0, column]
+
+    def test_initial_build(self):
+        """
+        Тестирование построения снимка по данным БД.
+        """
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 3)
+        self.assertFalse(get_engine().snapshot().has_priorities(self.user2.id))
+
+    def test_priority_added(self):
+        """
+        Тестирование появления нового приоритета и нового аспекта в снимке.
+        """
+        get_engine().snapshot()
+        aspect2 = Aspect.objects.create(aspect="Aspect 2")
+        self.create_priority(self.user2, aspect2, self.negative)
+
+        self.assertEqual(self.get_weight(self.user2, aspect2), -3)
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 3)
+
+    def test_priority_updated(self):
+        """
+        Тестирование изменения приоритета.
+        """
+        self.create_priority(self.user2, self.aspect, self.positive)
+        get_engine().snapshot()
+
+        self.priority.signed_weight = -3
+        self.priority.save()
+
+        self.assertEqual(self.get_weight(self.user1, self.aspect), -3)
+        self.assertEqual(self.get_weight(self.user2, self.aspect), 3)
+
+    def test_priority_removed(self):
+        """
+        Тестирование удаления приоритета.
+        """
+        get_engine().snapshot()
+        self.priority.delete()
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 0)
+
+        self.create_priority(self.user1, self.aspect, self.positive)
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 3)
+
+        self.user1.priorities.all().delete()
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 0)
+
+    def test_user_deleted(self):
+        """
+        Тестирование удаления пользователя из снимка.
+        """
+        get_engine().snapshot()
+        user_id = self.user1.id
+        self.user1.delete()
+
+        self.assertNotIn(user_id, get_engine().snapshot().row_of)
+
+    def test_pinned_snapshot(self):
+        """
+        Тестирование закрепленного снимка ->
+        Поиск в пуле потоков run_scoring видит снимок запроса
+        и не перечитывает изменения из БД
+        """
+        engine = get_engine()
+        snapshot = engine.snapshot()
+        self.priority.delete()
+
+        async def score():
+            with engine.pinned(snapshot):
+                return await run_scoring(engine.snapshot)
+
+        self.assertIs(async_to_sync(score)(), snapshot)
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 0)
+
+    def test_changes_of_other_process(self):
+        """
+        Тестирование изменения приоритетов в другом процессе ->
+        Строки опубликованных пользователей перечитываются
+        по общей версии данных без полного построения
+        """
+        engine = get_engine()
+        engine.snapshot()
+        # Изменение без сигналов этого процесса
+        UserPriority.objects.filter(id=self.priority.id).update(signed_weight=-3)
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 3)
+
+        bump_data_version([self.user1.id])
+        self.assertEqual(self.get_weight(self.user1, self.aspect), -3)
+        self.assertEqual(engine.snapshot().data_version, get_data_version())
+        self.assertEqual(engine.stats()['rebuilds'], 0)
+
+    def test_unknown_changes_rebuild(self):
+        """
+        Тестирование сдвига версии данных без списка изменений ->
+        Снимок строится заново
+        """
+        engine = get_engine()
+        engine.snapshot()
+        UserPriority.objects.filter(id=self.priority.id).update(signed_weight=-3)
+
+        bump_data_version()
+        self.assertEqual(self.get_weight(self.user1, self.aspect), -3)
+        self.assertEqual(engine.stats()['rebuilds'], 1)
+
+    def test_changes_applied_in_background(self):
+        """
+        Тестирование применения изменений в фоновом потоке ->
+        Запрос не ждет применения и ищет по прежнему снимку,
+        выдача по нему не кэшируется
+        """
+        engine = get_engine()
+        old = engine.snapshot()
+        self.priority.signed_weight = -3
+        self.priority.save()
+        # Фиксация транзакции сдвигает версию данных
+        bump_data_version([self.user1.id])
+        applied = old.with_users({self.user1.id}, *load_signed_weights([self.user1.id]), get_data_version())
+        release = threading.Event()
+
+        def slow_apply(data_version, prepare=False):
+            release.wait(5)
+            engine._take_dirty()
+            engine._snapshot = applied
+
+        url = reverse('compatible-users', kwargs={'user_id': self.user1.id})
+        with patch.object(engine, '_applies_in_background', return_value=True), \
+                patch.object(engine, '_apply', slow_apply), \
+                override_settings(SOULMATE_MATCHING={'SNAPSHOT_APPLY_WAIT': 0.01}):
+            try:
+                self.assertIs(engine.snapshot(), old)
+                self.assertEqual(self.client.get(url, {'mode': 'exact'}).status_code, status.HTTP_200_OK)
+                self.assertIsNone(result_cache.peek(self.user1.id, 'exact', get_data_version()))
+            finally:
+                release.set()
+                engine.apply_changes().join(5)
+
+            self.assertIs(engine.snapshot(), applied)
+            self.assertEqual(self.client.get(url, {'mode': 'exact'}).status_code, status.HTTP_200_OK)
+            self.assertIsNotNone(result_cache.peek(self.user1.id, 'exact', get_data_version()))
+
+    def test_rebuild(self):
+        """
+        Тестирование полного построения снимка с подменой текущего ->
+        Новый снимок со следующей версией, прежний остается пригодным
+        """
+        old = get_engine().snapshot()
+        self.assertTrue(get_engine().rebuild(background=False))
+        snapshot = get_engine().snapshot()
+
+        self.assertIsNot(snapshot, old)
+        self.assertEqual(snapshot.version, old.version + 1)
+        self.assertIsNone(snapshot.retained)
+        self.assertEqual(self.get_weight(self.user1, self.aspect), 3)
+        self.assertTrue(old.has_priorities(self.user1.id))
+
+        url = reverse('compatible-users-engine-stats')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.user1.is_staff = True
+        self.user1.save()
+        self.client.force_authenticate(self.user1)
+
+        stats = self.client.get(url).data
+        self.assertEqual((stats['version'], stats['users'], stats['rebuilds']), (snapshot.version, 1, 1))
+        self.assertFalse(stats['rebuilding'])
+
+    def test_changes_during_rebuild_applied(self):
+        """
+        Тестирование изменения приоритетов после чтения данных построением,
+        уже примененного к прежнему снимку ->
+        Изменение должно примениться и к новому снимку
+        """
+        engine = get_engine()
+        engine.snapshot()
+        build = engine._build
+
+        def build_then_change():
+            result = build()
+            self.create_priority(self.user2, self.aspect, self.negative)
+            engine.snapshot()
+            return result
+
+        engine._build = build_then_change
+        engine.rebuild(background=False)
+        del engine._build
+
+        self.assertEqual(self.get_weight(self.user2, self.aspect), -3)
+
+    def test_background_rebuild(self):
+        """
+        Тестирование построения в фоновом потоке ->
+        Поиск не ждет построения, повторный запуск не начинается,
+        пока идет первый
+        """
+        engine = get_engine()
+        old = engine.snapshot()
+        release = threading.Event()
+        built = create_random_snapshot().at_data_version(old.data_version)
+
+        def slow_build():
+            release.wait(5)
+            return built, 0.5
+
+        engine._build = slow_build
+        try:
+            self.assertTrue(engine.rebuild())
+            self.assertFalse(engine.rebuild())
+            self.assertIs(engine.snapshot(), old)
+            self.assertTrue(engine.stats()['rebuilding'])
+        finally:
+            release.set()
+            engine.wait_rebuild(5)
+            del engine._build
+
+        snapshot = engine.snapshot()
+        self.assertEqual(len(snapshot.user_ids), len(built.user_ids))
+        self.assertEqual(engine.stats()['build_seconds'], 0.5)
+
+
+def create_random_snapshot(users_count=500, seed=0):
+    """
+    Создание случайного снимка с группами похожих пользователей.
+    """
+    rng = np.random.default_rng(seed)
+    users, aspects, weights = [], [], []
+    for user_id in range(1, users_count + 1):
+        group = user_id % 5
+        for aspect_id in rng.choice(40, size=rng.integers(1, 12), replace=False):
+            sign = 1 if (aspect_id + group) % 3 else -1
+            users.append(user_id)
+            aspects.append(int(aspect_id))
+            weights.append(sign * int(rng.integers(0, 11)))
+
+    return MatchingSnapshot.from_weights(
+        np.array(users), np.array(aspects), np.array(weights)
+    )
+
+
+class InvertedIndexTestCase(SimpleTestCase):
+    """
+    Тесты поиска по инвертированному индексу с отсечением кандидатов.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        self.snapshot = create_random_snapshot()
+        self.index = InvertedIndex(self.snapshot)
+
+    def assertSameMatches(self, expected, actual):
+        """
+        Проверка совпадения выдачи с точностью до ошибок округления.
+        """
+        self.assertEqual([user_id for user_id, _ in expected], [user_id for user_id, _ in actual])
+        np.testing.assert_allclose([s for _, s in expected], [s for _, s in actual])
+
+    def test_matches_exact_search(self):
+        """
+        Тестирование совпадения результатов с точным поиском
+        при разных порогах и ограничениях выдачи.
+        """
+        for user_id in range(1, 501, 7):
+            for threshold, limit in ((75, 20), (60, 5), (90, 50)):
+                self.assertSameMatches(
+                    self.snapshot.search(user_id, threshold, limit),
+                    self.index.search(user_id, threshold, limit)
+                )
+
+    def test_exact_threshold_kept(self):
+        """
+        Тестирование ситуации, когда совместимость ровно равна порогу ->
+        Пользователь не должен отсекаться
+        """
+        snapshot = MatchingSnapshot.from_weights(
+            np.array([1, 1, 1, 1, 2, 2, 2, 2]),
+            np.array([1, 2, 3, 4, 1, 2, 3, 4]),
+            np.array([1, 1, 1, -1, 1, 1, 1, 1])
+        )
+        self.assertEqual(InvertedIndex(snapshot).search(1, 75, 20), [(2, 0.5)])
+
+    def test_low_threshold_matches_exact_search(self):
+        """
+        Тестирование порога не выше 50% ->
+        Пользователи без общих аспектов (нулевое сходство)
+        не должны теряться
+        """
+        snapshot = MatchingSnapshot.from_weights(
+            np.array([1, 1, 2, 3]),
+            np.array([1, 2, 1, 3]),
+            np.array([4, 2, -3, 5])
+        )
+        index = InvertedIndex(snapshot)
+        for threshold in (50, 30):
+            self.assertEqual(index.search(1, threshold, 20), snapshot.search(1, threshold, 20))
+        self.assertEqual(index.search(1, 50, 20), [(3, 0.0)])
+
+
+class LSHIndexTestCase(SimpleTestCase):
+    """
+    Тесты приближенного поиска по сигнатурам LSH.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        self.snapshot = create_random_snapshot()
+
+    def test_results_are_exact_subset(self):
+        """
+        Тестирование того, что приближенный поиск возвращает
+        точные сходства и находит большую часть точной выдачи.
+        """
+        index = LSHIndex(self.snapshot, probe_radius=2)
+        found = expected = 0
+        for user_id in range(1, 501, 7):
+            exact = dict(self.snapshot.search(user_id))
+            approximate = index.search(user_id)
+            for match_id, similarity in approximate:
+                self.assertIn(match_id, exact)
+                self.assertAlmostEqual(similarity, exact[match_id])
+            found += len(approximate)
+            expected += len(exact)
+
+        self.assertGreater(found / expected, 0.8)
+
+    def test_incremental_signatures(self):
+        """
+        Тестирование пересчета сигнатур только для изменившихся пользователей ->
+        Результат должен совпадать с построением индекса с нуля
+        """
+        previous = LSHIndex(self.snapshot)
+        snapshot = self.snapshot.with_users(
+            {3, 1000}, np.array([3, 1000, 1000]), np.array([1, 1, 99]), np.array([5, 5, -2])
+        )
+
+        incremental = LSHIndex(snapshot, previous=previous)
+        rebuilt = LSHIndex(snapshot)
+
+        np.testing.assert_array_equal(incremental.signatures, rebuilt.signatures)
+        np.testing.assert_array_equal(incremental.band_keys, rebuilt.band_keys)
+
+    def test_previous_index_from_same_lineage(self):
+        """
+        Тестирование переноса сигнатур через for_snapshot ->
+        Переносятся только сигнатуры снимка, из которого получен
+        исправленный, а не индекса другого снимка с той же версией
+        """
+        LSHIndex.for_snapshot(self.snapshot)
+        changes = ({3}, np.array([3]), np.array([1]), np.array([5]))
+
+        # Снимок, построенный заново (например, после сброса движка),
+        # нумеруется с начала
+        other = create_random_snapshot(seed=1)
+        self.assertEqual(other.version, self.snapshot.version)
+        index = LSHIndex.for_snapshot(other.with_users(*changes))
+        np.testing.assert_array_equal(index.signatures, LSHIndex(index.snapshot).signatures)
+
+        snapshot = self.snapshot.with_users(*changes)
+        self.assertIsNotNone(snapshot.previous(LSHIndex._build_next))
+        index = LSHIndex.for_snapshot(snapshot)
+        np.testing.assert_array_equal(index.signatures, LSHIndex(snapshot).signatures)
+        # Индекс предыдущего снимка после переноса не удерживается
+        self.assertIsNone(snapshot.previous(LSHIndex._build_next))
+
+
+class IVFIndexTestCase(SimpleTestCase):
+    """
+    Тесты поиска по кластерам k-means.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        self.snapshot = create_random_snapshot()
+        self.model = IVFModel.train(self.snapshot, n_clusters=5)
+
+    def test_all_clusters_match_exact_search(self):
+        """
+        Тестирование просмотра всех кластеров ->
+        Результат должен совпадать с точным поиском
+        """
+        index = IVFIndex(self.snapshot, self.model)
+        for user_id in range(1, 501, 7):
+            self.assertEqual(
+                [match_id for match_id, _ in self.snapshot.search(user_id)],
+                [match_id for match_id, _ in index.search(user_id, nprobe=5)]
+            )
+
+    def test_new_user_assigned(self):
+        """
+        Тестирование отнесения нового пользователя к ближайшему кластеру
+        """
+        previous = IVFIndex(self.snapshot, self.model)
+        snapshot = self.snapshot.with_users({1000}, np.array([1000]), np.array([1]), np.array([7]))
+        index = IVFIndex(snapshot, self.model, previous=previous)
+
+        self.assertEqual(len(index.labels), len(snapshot.user_ids))
+        self.assertEqual(index.search(1000, nprobe=5), snapshot.search(1000))
+
+    def test_saved_model_loaded(self):
+        """
+        Тестирование сохранения модели и ее подхвата поиском
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ivf.npz')
+            with override_settings(SOULMATE_MATCHING={'IVF_INDEX_PATH': path}):
+                self.assertIsNone(IVFIndex.for_snapshot(self.snapshot))
+
+                self.model.save(path)
+                index = IVFIndex.for_snapshot(self.snapshot)
+
+                self.assertIsNotNone(index)
+                np.testing.assert_array_equal(index.model.centroids, self.model.centroids)
+                np.testing.assert_array_equal(index.labels, IVFIndex(self.snapshot, self.model).labels)
+
+    def test_previous_index_from_same_lineage(self):
+        """
+        Тестирование переноса кластеров через for_snapshot ->
+        Переносятся только кластеры снимка, из которого получен
+        исправленный, а не индекса другого снимка с той же версией
+        """
+        changes = ({3}, np.array([3]), np.array([1]), np.array([5]))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ivf.npz')
+            self.model.save(path)
+            with override_settings(SOULMATE_MATCHING={'IVF_INDEX_PATH': path}):
+                IVFIndex.for_snapshot(self.snapshot)
+
+                other = create_random_snapshot(seed=1).with_users(*changes)
+                index = IVFIndex.for_snapshot(other)
+                np.testing.assert_array_equal(index.labels, IVFIndex(other, index.model).labels)
+
+                snapshot = self.snapshot.with_users(*changes)
+                index = IVFIndex.for_snapshot(snapshot)
+                self.assertIs(IVFIndex.for_snapshot(snapshot), index)
+                np.testing.assert_array_equal(index.labels, IVFIndex(snapshot, index.model).labels)
+                self.assertIsNone(snapshot.previous(IVFIndex._build_next))
+
+
+class VectorStoreTestCase(SimpleTestCase):
+    """
+    Тесты файла векторов, отображенного в память.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        self.snapshot = create_random_snapshot()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'vectors.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def search(self, store, snapshot, user_id):
+        """
+        Поиск по файлу с вектором пользователя из снимка.
+        """
+        vector = snapshot.vector(user_id)
+        return store.search(user_id, snapshot.aspect_ids[vector.indices], vector.data)
+
+    def test_matches_exact_search(self):
+        """
+        Тестирование совпадения поиска по файлу с точным поиском
+        """
+        VectorStore.write(self.snapshot, self.path)
+        store = VectorStore.open(self.path)
+
+        self.assertEqual(store.column_data.dtype, np.int8)
+        for user_id in range(1, 501, 7):
+            self.assertEqual(self.search(store, self.snapshot, user_id), self.snapshot.search(user_id))
+
+    def test_replaced_file_picked_up(self):
+        """
+        Тестирование подхвата файла, замененного переименованием
+        """
+        with override_settings(SOULMATE_MATCHING={'VECTOR_STORE_PATH': self.path}):
+            self.assertIsNone(VectorStore.current())
+
+            VectorStore.write(self.snapshot, self.path)
+            store = VectorStore.current()
+            self.assertIs(VectorStore.current(), store)
+
+            snapshot = self.snapshot.with_users({1000}, np.array([1000]), np.array([1]), np.array([-7]))
+            VectorStore.write(snapshot, self.path)
+            replaced = VectorStore.current()
+
+            self.assertIsNot(replaced, store)
+            self.assertIsNone(store.row(1000))
+            self.assertEqual(self.search(replaced, snapshot, 1000), snapshot.search(1000))
+
+
+class DatabaseProfileTestCase(SimpleTestCase):
+    """
+    Тесты производственного профиля SQLite и маршрутизации чтений подбора.
+    """
+
+    def test_pragmas_applied(self):
+        """
+        Тестирование применения прагм и чтения WAL-файла соединением только для чтения
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.sqlite3')
+            conn = sqlite3.connect(path)
+            apply_pragmas(conn.cursor(), settings.SQLITE_PRODUCTION_PRAGMAS)
+            conn.execute('CREATE TABLE t (id INTEGER)')
+            conn.commit()
+
+            reader = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            apply_pragmas(reader.cursor(), settings.SQLITE_PRODUCTION_PRAGMAS)
+            self.assertEqual(reader.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(reader.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.execute('INSERT INTO t VALUES (1)')
+            reader.close()
+            conn.close()
+
+    def test_replica_reads_routed(self):
+        """
+        Тестирование направления чтений в реплику READ_DATABASE
+        """
+        router = ReplicaRouter()
+
+        with override_settings(SOULMATE_MATCHING={'READ_DATABASE': 'default'}):
+            self.assertIsNone(router.db_for_read(CustomUser))
+            with replica_reads():
+                self.assertEqual(router.db_for_read(CustomUser), 'default')
+                self.assertEqual(router.db_for_write(CustomUser), 'default')
+                with primary_reads():
+                    self.assertIsNone(router.db_for_read(CustomUser))
+            self.assertIsNone(router.db_for_read(CustomUser))
+
+        # Псевдонима нет в DATABASES - чтения идут в соединение по умолчанию
+        with override_settings(SOULMATE_MATCHING={'READ_DATABASE': 'missing'}), replica_reads():
+            self.assertIsNone(read_database())
+            self.assertFalse(router.allow_migrate('missing', 'soulmate'))
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        SOULMATE_MATCHING={'READ_DATABASE': 'default', 'READ_YOUR_WRITES_SECONDS': 30}
+    )
+    def test_read_your_writes(self):
+        """
+        Тестирование чтений из основной БД после изменения приоритетов пользователя
+        """
+        note_writes([1])
+
+        with replica_reads(2):
+            self.assertEqual(read_database(), 'default')
+            # Пользователь запроса определен уже внутри блока
+            read_your_writes(1)
+            self.assertIsNone(read_database())
+            # Вложенный блок без пользователей не возвращает чтения в реплику
+            with replica_reads():
+                self.assertIsNone(read_database())
+        with replica_reads(2, 1):
+            self.assertIsNone(read_database())
+
+        with override_settings(SOULMATE_MATCHING={'READ_DATABASE': 'default', 'READ_YOUR_WRITES_SECONDS': 0}):
+            with replica_reads(1):
+                self.assertEqual(read_database(), 'default')
+
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        SOULMATE_MATCHING={'READ_DATABASE': 'default'}
+    )
+    def test_replica_version(self):
+        """
+        Тестирование отметки чтений из реплики и версии данных копии ->
+        Копия отстает до синхронизации, соединение к файлу основной БД - нет
+        """
+        router = ReplicaRouter()
+        with track_replica_reads() as reads:
+            router.db_for_read(CustomUser)
+            self.assertFalse(reads.used)
+            with replica_reads():
+                router.db_for_read(CustomUser)
+        self.assertTrue(reads.used)
+
+        with patch.dict(connections['default'].settings_dict, NAME='/tmp/replica.sqlite3'):
+            self.assertFalse(replica_has_version(5))
+            note_replica_synced(5)
+            self.assertTrue(replica_has_version(5))
+            self.assertFalse(replica_has_version(6))
+        with patch.dict(connections['default'].settings_dict, NAME='file:/tmp/db.sqlite3?mode=ro'):
+            self.assertTrue(replica_has_version(6))
+
+@override_settings(SOULMATE_MATCHING={'SHARDS': 3})
+class ShardPoolTestCase(BaseTestCase):
+    """
+    Тесты поиска в процессах шардов.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.aspects = [Aspect.objects.create(aspect=f"Aspect {i}") for i in range(8)]
+        self.users = []
+        for i in range(60):
+            user = CustomUser.objects.create(username=f"user{i}", email=f"user{i}@example.com")
+            for aspect in rng.choice(self.aspects, size=rng.integers(1, 6), replace=False):
+                UserPriority.objects.create(user=user, aspect=aspect, signed_weight=int(rng.choice([-1, 1]) * rng.integers(1, 11)))
+            self.users.append(user)
+        self.pool = ShardPool.get()
+
+    def tearDown(self):
+        ShardPool.shutdown()
+
+    def assert_matches_exact_search(self, pool, threshold=None, limit=None):
+        """
+        Проверка совпадения выдачи шардов с точным поиском
+        для всех пользователей.
+        """
+        snapshot = get_engine().snapshot()
+        for user in self.users:
+            self.assertEqual(
+                pool.search(user.id, threshold, limit),
+                snapshot.search(user.id, threshold, limit) if snapshot.has_priorities(user.id) else None
+            )
+
+    def test_matches_exact_search(self):
+        """
+        Тестирование совпадения результатов с точным поиском
+        при разных порогах и ограничениях выдачи без снимка
+        в родительском процессе
+        """
+        combinations = ((75, 20), (60, 5), (40, 50))
+        expected = {
+            (user.id, threshold, limit): find_compatible_users(user.id, 'exact', threshold, limit)
+            for user in self.users for threshold, limit in combinations
+        }
+        get_engine().reset()
+        for (user_id, threshold, limit), matches in expected.items():
+            self.assertEqual(self.pool.search(user_id, threshold, limit), matches)
+        self.assertFalse(get_engine().stats()['built'])
+
+    def test_changed_users_sent_to_shards(self):
+        """
+        Тестирование изменений приоритетов в этом и в другом процессе ->
+        Шардам пересылаются строки изменившихся пользователей,
+        результат должен совпадать с точным поиском
+        """
+        self.pool.search(self.users[0].id)
+        user = CustomUser.objects.create(username="new", email="new@example.com")
+        UserPriority.objects.create(user=user, aspect=self.aspects[0], signed_weight=5)
+        self.users[1].priorities.all().delete()
+        self.users.append(user)
+        self.assert_matches_exact_search(self.pool, 0, 1000)
+
+        # Изменение другого процесса публикуется с версией данных
+        priority = self.users[2].priorities.first()
+        UserPriority.objects.filter(id=priority.id).update(signed_weight=-priority.signed_weight)
+        bump_data_version([self.users[2].id])
+        self.assert_matches_exact_search(self.pool, 0, 1000)
+        self.assertEqual(self.pool.data_version, get_data_version())
+
+    def test_concurrent_searches(self):
+        """
+        Тестирование одновременных запросов ->
+        Ответы шардов доходят до своих запросов
+        """
+        self.pool.search(self.users[0].id)
+        snapshot = get_engine().snapshot()
+        queries = {}
+        for user in self.users:
+            vector = snapshot.vector(user.id)
+            if vector is not None:
+                queries[user.id] = (snapshot.aspect_ids[vector.indices], vector.data)
+
+        results = {}
+
+        def search(user_ids):
+            for user_id in user_ids:
+                aspects, weights = queries[user_id]
+                results[user_id] = sorted(
+                    match for matches in self.pool._scatter(
+                        [('search', (user_id, aspects, weights, 0, 1000))] * self.pool.shards
+                    ) for match in matches
+                )
+
+        user_ids = list(queries)
+        threads = [threading.Thread(target=search, args=(user_ids[i::4],)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        for user_id in user_ids:
+            self.assertEqual(results[user_id], sorted(snapshot.search(user_id, 0, 1000)))
+
+    def test_restarted_after_shard_died(self):
+        """
+        Тестирование перезапуска пула после гибели процесса шарда
+        """
+        self.pool.search(self.users[0].id)
+        self.pool.processes[0].kill()
+        self.pool.processes[0].join()
+
+        pool = ShardPool.get()
+        self.assertIsNot(pool, self.pool)
+        self.assert_matches_exact_search(pool)
+
+
+class BudgetedSearchTestCase(SimpleTestCase):
+    """
+    Тесты точного поиска, ограниченного по времени.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        self.snapshot = create_random_snapshot()
+
+    def test_unlimited_budget_matches_exact_search(self):
+        """
+        Тестирование поиска, уложившегося в бюджет ->
+        Результат должен совпадать с точным поиском
+        """
+        for user_id in range(1, 501, 7):
+            matches, scanned = budgeted_search(self.snapshot, user_id, float('inf'), 60, 20, chunk_size=64)
+            self.assertEqual(matches, self.snapshot.search(user_id, 60, 20))
+            self.assertEqual(scanned, 1)
+
+    def test_expired_budget_returns_best_scanned(self):
+        """
+        Тестирование истекшего бюджета ->
+        Должны вернуться лучшие пользователи из первой части строк
+        """
+        for user_id in (1, 250, 500):
+            matches, scanned = budgeted_search(self.snapshot, user_id, float('-inf'), 60, 20, chunk_size=100)
+            expected = [
+                match for match in self.snapshot.search(user_id, 60, 1000)
+                if self.snapshot.row_of[match[0]] < 100
+            ][:20]
+            self.assertEqual(matches, expected)
+            self.assertEqual(scanned, 0.2)
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    """
+    Тесты объединения одновременных одинаковых вычислений.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        self.entered, self.release = threading.Event(), threading.Event()
+        self.calls = 0
+
+    def compute(self):
+        """
+        Вычисление, ожидающее разрешения на завершение.
+        """
+        self.calls += 1
+        self.entered.set()
+        self.release.wait(5)
+        return [(self.calls, 1.0)]
+
+    def run_concurrently(self, flight, func, count=5):
+        """
+        Запуск первого вызова, а после входа в вычисление -
+        остальных вызовов с тем же ключом в потоках.
+        """
+        results, threads = [], []
+
+        def call():
+            try:
+                results.append(flight.do('key', func))
+            except ValueError as error:
+                results.append(error)
+
+        for i in range(count):
+            threads.append(threading.Thread(target=call))
+            threads[-1].start()
+            if i == 0:
+                self.entered.wait(5)
+        # Ожидающие вызовы успевают присоединиться к вычислению
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_concurrent_calls_share_result(self):
+        """
+        Тестирование одновременных вызовов с одним ключом ->
+        Вычисление выполняется один раз, все получают его результат
+        """
+        flight = SingleFlight()
+        results = self.run_concurrently(flight, self.compute)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [[(1, 1.0)]] * 5)
+        # После окончания вычисления ключ освобождается
+        self.assertEqual(flight.do('key', lambda: 'again'), 'again')
+
+    def test_error_shared(self):
+        """
+        Тестирование исключения в вычислении ->
+        Исключение получают все ожидающие вызовы
+        """
+        def fail():
+            self.compute()
+            raise ValueError('failed')
+
+        results = self.run_concurrently(SingleFlight(), fail)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+
+class TieredStoreTestCase(BaseTestCase):
+    """
+    Тесты поиска по горячему уровню и файлу векторов.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        super().setUp()
+        rng = np.random.default_rng(0)
+        aspects = [Aspect.objects.create(aspect=f"Aspect {i}") for i in range(6)]
+        weights = list(range(1, 11))
+        attitudes = ["positive", "negative"]
+
+        self.users = []
+        for i in range(30):
+            user = CustomUser.objects.create(username=f"user{i}", email=f"user{i}@example.com")
+            for aspect in rng.choice(aspects, size=3, replace=False):
+                UserPriority.objects.create(
+                    user=user, aspect=aspect,
+                    signed_weight=UserPriority.to_signed_weight(attitudes[rng.integers(2)], weights[rng.integers(10)])
+                )
+            self.users.append(user)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'vectors.bin')
+        VectorStore.write(get_engine().snapshot(), self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def tiered_settings(self, **values):
+        """
+        Настройки поиска по файлу векторов теста.
+        """
+        return override_settings(SOULMATE_MATCHING={'VECTOR_STORE_PATH': self.path, **values})
+
+    def test_matches_exact_search(self):
+        """
+        Тестирование совпадения результатов с точным поиском
+        при продвижении и вытеснении пользователей
+        """
+        snapshot = get_engine().snapshot()
+        for budget, hits in ((10 ** 9, len(self.users)), (200, 0)):
+            tiered_store.reset()
+            with self.tiered_settings(TIERED_HOT_BYTES=budget, TIERED_ADMISSION_SCORE=1):
+                for _ in range(2):
+                    for user in self.users:
+                        self.assertEqual(
+                            tiered_store.search(VectorStore.current(), user.id, 60, 10),
+                            snapshot.search(user.id, 60, 10)
+                        )
+                self.assertLessEqual(tiered_store.stats()['hot_bytes'], budget)
+                self.assertEqual(tiered_store.stats()['hits'], hits)
+
+    def test_changed_hot_user_reloaded(self):
+        """
+        Тестирование изменения приоритетов горячего пользователя ->
+        Поиск должен учитывать новые веса без перестроения файла
+        """
+        user, other = self.users[:2]
+        with self.tiered_settings(TIERED_ADMISSION_SCORE=1):
+            tiered_store.search(VectorStore.current(), user.id)
+            other_vector = tiered_store.vector(other.id)
+            self.assertIn(user.id, tiered_store.hot.row_of)
+
+            user.priorities.all().delete()
+            for aspect_id, weight in zip(*other_vector):
+                UserPriority.objects.create(user=user, aspect_id=aspect_id, signed_weight=weight)
+
+            matches = tiered_store.search(VectorStore.current(), other.id, 99, 1)
+            self.assertEqual(matches, [(user.id, 1.0)])
+
+    def test_frequent_users_kept(self):
+        """
+        Тестирование вытеснения ->
+        Разовые обращения не вытесняют часто обращающегося пользователя,
+        а с ростом активности нового пользователя вытесняется прежний
+        """
+        frequent, newcomer = self.users[:2]
+        with self.tiered_settings(TIERED_ADMISSION_SCORE=1):
+            tiered_store.vector(frequent.id)
+            budget = tiered_store.stats()['hot_bytes']
+            with self.tiered_settings(TIERED_ADMISSION_SCORE=1, TIERED_HOT_BYTES=budget):
+                for _ in range(2):
+                    tiered_store.vector(frequent.id)
+                tiered_store.vector(newcomer.id)
+                self.assertEqual(list(tiered_store.hot.user_ids), [frequent.id])
+
+                for _ in range(3):
+                    tiered_store.vector(newcomer.id)
+                self.assertEqual(list(tiered_store.hot.user_ids), [newcomer.id])
+
+    def test_admission_after_repeated_access(self):
+        """
+        Тестирование продвижения в горячий уровень со второго обращения
+        """
+        user = self.users[0]
+        with self.tiered_settings():
+            tiered_store.vector(user.id)
+            self.assertNotIn(user.id, tiered_store.hot.row_of)
+            tiered_store.vector(user.id)
+            self.assertIn(user.id, tiered_store.hot.row_of)
+            tiered_store.vector(user.id)
+            self.assertEqual((tiered_store.stats()['hits'], tiered_store.stats()['misses']), (1, 2))
+
+    def test_missing_file_searched_without_engine(self):
+        """
+        Тестирование поиска mmap до сборки файла векторов ->
+        Выдача запросом к БД без построения резидентного снимка
+        """
+        expected = {user.id: get_engine().snapshot().search(user.id) for user in self.users}
+        # Нормы векторов для поиска запросом к БД пересчитываются после фиксации
+        update_priority_norms([user.id for user in self.users])
+        get_engine().reset()
+        missing = os.path.join(self.directory.name, 'missing.bin')
+        with override_settings(SOULMATE_MATCHING={'VECTOR_STORE_PATH': missing, 'SEARCH_MODE': 'mmap'}):
+            warm_up()
+            for user in self.users:
+                self.assertEqual(find_compatible_users(user.id), expected[user.id])
+        self.assertFalse(get_engine().stats()['built'])
+
+    def test_store_rebuild_keeps_data_version(self):
+        """
+        Тестирование пересборки файла векторов ->
+        Версия данных не сдвигается: устаревают только
+        закэшированные выдачи способов поиска по файлу
+        """
+        url = reverse('compatible-users', kwargs={'user_id': self.users[0].id})
+        with self.tiered_settings(NEIGHBORS_MAX_AGE=0):
+            for mode in ('exact', 'mmap', 'tiered'):
+                self.assertEqual(self.client.get(url, {'mode': mode}).status_code, status.HTTP_200_OK)
+            version = get_data_version()
+            for mode in ('exact', 'mmap', 'tiered'):
+                self.assertIsNotNone(result_cache.peek(self.users[0].id, mode, version))
+
+            call_command('build_vector_store', stdout=StringIO())
+            self.assertEqual(get_data_version(), version)
+            self.assertIsNotNone(result_cache.peek(self.users[0].id, 'exact', version))
+            self.assertIsNone(result_cache.peek(self.users[0].id, 'mmap', version))
+            self.assertIsNone(result_cache.peek(self.users[0].id, 'tiered', version))
+
+    def test_tiered_mode_without_engine(self):
+        """
+        Тестирование пакетной и взаимной выдачи в режиме tiered ->
+        Выдача совпадает с точным поиском без построения резидентного
+        снимка, полная выдача отклоняется
+        """
+        expected = {user.id: find_compatible_users(user.id, 'exact') for user in self.users}
+        mutual = {user.id: find_mutual_users(user.id, 'exact') for user in self.users}
+        get_engine().reset()
+        self.client.force_authenticate(self.users[0])
+        with self.tiered_settings(SEARCH_MODE='tiered', NEIGHBORS_MAX_AGE=0):
+            warm_up()
+            user_ids = [user.id for user in self.users[:5]]
+            response = self.client.post(reverse('compatible-users-batch'), {'user_ids': user_ids}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            for user_id in user_ids:
+                matches = response.data['compatible_users'][user_id]
+                self.assertEqual([match['user_id'] for match in matches], [match[0] for match in expected[user_id]])
+            for user in self.users:
+                self.assertEqual(find_mutual_users(user.id), mutual[user.id])
+
+            url = reverse('compatible-users', kwargs={'user_id': self.users[0].id})
+            for params in ({'stream': 'true'}, {'page_size': 5}, {'budget_ms': 100}):
+                self.assertEqual(self.client.get(url, params).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(get_engine().stats()['built'])
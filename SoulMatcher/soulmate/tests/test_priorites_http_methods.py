@@ -1,20 +1,32 @@
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
 from django.urls import reverse
 
 from rest_framework import status
 
 from .base import BaseTestCase
-from ..models import Priority, Aspect, Attitude, Weight
+from ..compaction import merge_duplicate_aspects
+from ..database import wrote_recently
+from ..matching import get_engine
+from ..models import UserPriority, Aspect
+from ..signals import priorities_changed
 
 
 class PrioritiesTest(BaseTestCase):
     """
     Тесты приоритетов.
     """
+    list_url_name = 'Priorities-list'
+    detail_url_name = 'Priorities-detail'
 
     def setUp(self):
         """
         Подготовка данных для тестов.
         """
+        super().setUp()
         self.user = self.create_user()
         response = self.client.post(
             reverse('token_obtain_pair'),
@@ -35,13 +47,13 @@ class PrioritiesTest(BaseTestCase):
         """
         Получение URL для приоритета с указанным идентификатором.
         """
-        return reverse('Priorities-detail', kwargs={'pk': priority_id})
+        return reverse(self.detail_url_name, kwargs={'pk': priority_id})
 
     def create_priority(self, aspect, attitude, weight):
         """
         Создание приоритета (POST).
         """
-        url = reverse('Priorities-list')
+        url = reverse(self.list_url_name)
         data = {
             'aspect': aspect,
             'attitude': attitude,
@@ -55,17 +67,12 @@ class PrioritiesTest(BaseTestCase):
         Создание объекта приоритета.
         """
         aspect_instance, _ = Aspect.objects.get_or_create(aspect=aspect)
-        attitude_instance, _ = Attitude.objects.get_or_create(attitude=attitude)
-        weight_instance, _ = Weight.objects.get_or_create(weight=weight)
 
-        priority = Priority.objects.create(
+        return UserPriority.objects.create(
+            user=self.user,
             aspect=aspect_instance,
-            attitude=attitude_instance,
-            weight=weight_instance
+            signed_weight=UserPriority.to_signed_weight(attitude, weight)
         )
-        priority.users.add(self.user)
-
-        return priority
 
     def update_priority(self, priority_id, aspect, attitude, weight):
         """
@@ -109,7 +116,7 @@ class PrioritiesTest(BaseTestCase):
         GET
         Тестирование получения списка приоритетов.
         """
-        url = reverse('Priorities-list')
+        url = reverse(self.list_url_name)
         self.set_authorization()
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -132,6 +139,22 @@ class PrioritiesTest(BaseTestCase):
         response = self.patch_priority(priority.id, {'weight': 7})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_patch_priority_read_your_writes(self):
+        """
+        PATCH
+        Тестирование отметки об изменении приоритетов, после которой
+        чтения пользователя идут в основную БД, а не в реплику.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            priority = self.create_priority_object()
+        cache.clear()
+        self.assertFalse(wrote_recently([self.user.id]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.patch_priority(priority.id, {'weight': 7})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(wrote_recently([self.user.id]))
+
     def test_delete_priority(self):
         """
         DELETE
@@ -162,6 +185,31 @@ class PrioritiesTest(BaseTestCase):
         response = self.create_priority('smoking', 'negative', 12)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_priority_same_aspect(self):
+        """
+        Тестирование повторного создания приоритета на тот же аспект ->
+        Прежний приоритет заменяется
+        """
+        self.create_priority('smoking', 'positive', 8)
+        response = self.create_priority('smoking', 'negative', 3)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        priorities = self.client.get(reverse(self.list_url_name)).json()
+        self.assertEqual(
+            [(p['display_aspect'], p['display_attitude'], p['display_weight']) for p in priorities],
+            [('smoking', 'negative', '3')]
+        )
+
+    def test_update_priority_existing_aspect(self):
+        """
+        Тестирование смены аспекта приоритета на аспект
+        другого приоритета пользователя -> Ответ 400
+        """
+        self.create_priority_object('sport')
+        priority = self.create_priority_object()
+        response = self.patch_priority(priority.id, {'aspect': 'sport'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_priority_invalid_data(self):
         """
         Тестирование обновления приоритета с недопустимыми данными.
@@ -170,3 +218,163 @@ class PrioritiesTest(BaseTestCase):
         response = self.update_priority(priority.id, 'smoking', 'invalid', 12)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+
+class AsyncPrioritiesTest(PrioritiesTest):
+    """
+    Тесты асинхронных представлений приоритетов:
+    те же сценарии, что и для PriorityViewSet.
+    """
+    list_url_name = 'async-priorities-list'
+    detail_url_name = 'async-priorities-detail'
+
+    def test_same_data_as_sync(self):
+        """
+        Тестирование совпадения ответов с PriorityViewSet
+        """
+        self.create_priority('smoking', 'positive', 8)
+        priority = self.create_priority_object('sport', 'negative', 3)
+        self.set_authorization()
+
+        self.assertEqual(
+            self.client.get(reverse(self.list_url_name)).json(),
+            self.client.get(reverse(PrioritiesTest.list_url_name)).json()
+        )
+        self.assertEqual(
+            self.client.get(self.get_priority_url(priority.id)).json(),
+            self.client.get(reverse(PrioritiesTest.detail_url_name, kwargs={'pk': priority.id})).json()
+        )
+
+    def test_unauthenticated(self):
+        """
+        Тестирование запроса без токена ->
+        Ответ 401, приоритеты чужих пользователей недоступны
+        """
+        response = self.client.get(reverse(self.list_url_name))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        priority = self.create_priority_object()
+        priority.user = self.create_user(username='other', email='other@example.com')
+        priority.save()
+        self.set_authorization()
+
+        response = self.client.get(self.get_priority_url(priority.id))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class PriorityAdminTest(BaseTestCase):
+    """
+    Тесты админки приоритетов.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        super().setUp()
+        self.user = self.create_user()
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.aspect = Aspect.objects.create(aspect='smoking')
+
+    def test_filters(self):
+        """
+        Тестирование фильтров по отношению и весу
+        """
+        sport = Aspect.objects.create(aspect='sport')
+        UserPriority.objects.create(user=self.user, aspect=self.aspect, signed_weight=-3)
+        UserPriority.objects.create(user=self.user, aspect=sport, signed_weight=3)
+        url = reverse('admin:soulmate_userpriority_changelist')
+
+        for params, expected in (({'attitude': 'negative'}, ['smoking']), ({'weight': '3'}, ['smoking', 'sport'])):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                sorted(str(priority.aspect) for priority in response.context['cl'].result_list), expected
+            )
+
+    def test_zero_weight_rejected(self):
+        """
+        Тестирование ограничения знакового веса ->
+        Нулевой вес не соответствует паре отношение/вес и не сохраняется
+        """
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserPriority.objects.create(user=self.user, aspect=self.aspect, signed_weight=0)
+        UserPriority.objects.create(user=self.user, aspect=self.aspect, signed_weight=1)
+
+    def test_add_by_attitude_and_weight(self):
+        """
+        Тестирование создания приоритета в админке ->
+        Отношение и вес сохраняются знаковым весом
+        """
+        response = self.client.post(reverse('admin:soulmate_userpriority_add'), {
+            'user': self.user.id, 'aspect': self.aspect.id, 'attitude': 'negative', 'weight': 7
+        })
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(UserPriority.objects.get(user=self.user).signed_weight, -7)
+
+
+class AspectCompactionTest(BaseTestCase):
+    """
+    Тесты удаления и слияния аспектов.
+    """
+
+    def setUp(self):
+        """
+        Подготовка данных для тестов.
+        """
+        super().setUp()
+        self.user = self.create_user()
+        self.other = self.create_user(username='other', email='other@example.com')
+        self.smoking, self.sport, self.orphan = [
+            Aspect.objects.create(aspect=name) for name in ('smoking', 'sport', 'orphan')
+        ]
+
+    def test_dry_run(self):
+        """
+        Тестирование отчета без изменений ->
+        Аспекты без приоритетов подсчитываются, но не удаляются
+        """
+        out = StringIO()
+        call_command('compact_aspects', dry_run=True, stdout=out)
+
+        self.assertIn('Would reclaim 3 orphaned aspects', out.getvalue())
+        self.assertEqual(Aspect.objects.count(), 3)
+
+    def test_orphans_deleted(self):
+        """
+        Тестирование удаления аспектов без приоритетов частями
+        """
+        UserPriority.objects.create(user=self.user, aspect=self.smoking, signed_weight=5)
+        out = StringIO()
+        call_command('compact_aspects', batch_size=1, stdout=out)
+
+        self.assertIn('Reclaimed 2 orphaned aspects', out.getvalue())
+        self.assertEqual(list(Aspect.objects.values_list('aspect', flat=True)), ['smoking'])
+
+    def test_merge(self):
+        """
+        Тестирование слияния аспектов ->
+        Приоритеты переводятся на сохраняемый аспект, при повторе у одного
+        пользователя остается последний добавленный, снимок обновляется
+        """
+        UserPriority.objects.create(user=self.user, aspect=self.sport, signed_weight=-4)
+        UserPriority.objects.create(user=self.user, aspect=self.smoking, signed_weight=5)
+        UserPriority.objects.create(user=self.other, aspect=self.sport, signed_weight=2)
+        get_engine().snapshot()
+
+        report = merge_duplicate_aspects(Aspect, UserPriority, {self.smoking.id: [self.sport.id]}, dry_run=True)
+        self.assertEqual(report, {'aspects': 1, 'repointed': 1, 'removed': 1, 'users': 2})
+        self.assertEqual(UserPriority.objects.count(), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            merge_duplicate_aspects(
+                Aspect, UserPriority, {self.smoking.id: [self.sport.id]}, on_merged=priorities_changed
+            )
+
+        self.assertEqual(
+            sorted(UserPriority.objects.values_list('user_id', 'aspect_id', 'signed_weight')),
+            sorted([(self.user.id, self.smoking.id, 5), (self.other.id, self.smoking.id, 2)])
+        )
+        self.assertFalse(Aspect.objects.filter(id=self.sport.id).exists())
+        self.assertEqual(get_engine().snapshot().search(self.user.id), [(self.other.id, 1.0)])
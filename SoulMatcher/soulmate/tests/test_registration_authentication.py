@@ -15,6 +15,7 @@ class UserSerializerTest(BaseTestCase):
         """
         Подготовка данных для тестов.
         """
+        super().setUp()
         self.user = self.create_user()
 
     def test_user_serializer(self):
@@ -68,6 +69,7 @@ class EmailConfirmationTest(BaseTestCase):
         """
         Подготовка данных для тестов.
         """
+        super().setUp()
         self.user_confirmed = self.create_user(
             username='confirmed_user',
             email='confirmed@example.com',
@@ -133,6 +135,7 @@ class AuthenticationTest(BaseTestCase):
         """
         Подготовка данных для тестов.
         """
+        super().setUp()
         self.user = self.create_user(email_confirmed=False)
 
     def authenticate(self, username, password):
@@ -4,7 +4,7 @@ from rest_framework.routers import DefaultRouter
 
 from django.urls import path, include
 
-from . import views
+from . import async_views, views
 
 
 router = DefaultRouter()
@@ -17,5 +17,11 @@ urlpatterns = [
     path('token/', views.CustomTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('temp_protected_view/', views.temp_protected_view, name='temp_protected_view'),
+    path('compatible-users/cache-stats/', views.CompatibleUsersCacheStatsView.as_view(), name='compatible-users-cache-stats'),
+    path('compatible-users/engine-stats/', views.MatchingEngineStatsView.as_view(), name='compatible-users-engine-stats'),
+    path('compatible-users/batch/', views.CompatibleUsersBatchView.as_view(), name='compatible-users-batch'),
     path('compatible-users/<int:user_id>/', views.CompatibleUsersView.as_view(), name='compatible-users'),
+    path('async/priorities/', async_views.AsyncPriorityListView.as_view(), name='async-priorities-list'),
+    path('async/priorities/<int:pk>/', async_views.AsyncPriorityDetailView.as_view(), name='async-priorities-detail'),
+    path('async/compatible-users/<int:user_id>/', async_views.AsyncCompatibleUsersView.as_view(), name='async-compatible-users'),
 ]
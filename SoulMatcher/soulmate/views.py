@@ -1,25 +1,59 @@
+import json
+import time
 import uuid
-from collections import defaultdict
+from datetime import timedelta
 
 from django.contrib.auth import get_user_model
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 
 from rest_framework import status, viewsets, views
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 
 from rest_framework_simplejwt.views import \
     TokenObtainPairView as SimpleTokenObtainPairView
 
-from sklearn.metrics.pairwise import cosine_similarity
-
-from .models import Priority, CustomUser, Aspect
+from .database import \
+    read_your_writes, \
+    replica_has_version, \
+    replica_reads, \
+    track_replica_reads
+from .models import UserPriority, CustomUser
 from .serializers import \
     UserSerializer, \
     CustomTokenObtainPairSerializer, \
-    PrioritySerializer
+    PrioritySerializer, \
+    CompatibleUsersBatchSerializer, \
+    CompatibleUsersListingSerializer, \
+    CompatibleUsersSearchSerializer
 from .email_sender import send_verification_email
+from .matching import \
+    SEARCH_MODES, \
+    ResultCache, \
+    VectorStore, \
+    budgeted_search, \
+    deadline_after, \
+    display_names, \
+    encode_cursor, \
+    find_compatible_users, \
+    find_compatible_users_batch, \
+    find_mutual_users, \
+    get_engine, \
+    get_data_version, \
+    get_mutual_matches, \
+    get_neighbor_list, \
+    get_setting, \
+    iter_matches, \
+    matches_page, \
+    result_cache, \
+    single_flight, \
+    tiered_store, \
+    to_percentage, \
+    uses_engine, \
+    uses_vector_store
 
 
 class CustomTokenObtainPairView(SimpleTokenObtainPairView):
@@ -132,55 +166,265 @@ class PriorityViewSet(viewsets.ModelViewSet):
         Возвращает queryset приоритетов для аутентифицированного пользователя.
         """
         user = self.request.user
-        return Priority.objects.filter(users__in=[user])
+        return UserPriority.objects.filter(user=user).select_related('aspect')
 
     def perform_create(self, serializer):
         """
-        Сохраняет приоритет
-        и связывает его с аутентифицированным пользователем.
+        Сохраняет приоритет аутентифицированного пользователя.
         """
-        priority = serializer.save()
-        priority.users.add(self.request.user)
+        serializer.save(user=self.request.user)
 
 
-class CompatibleUsersView(views.APIView):
+def query_flag(request, name):
     """
-    Представление для получения списка совместимых пользователей
-    на основе приоритетов.
+    Возвращает значение логического параметра запроса.
+    """
+    return request.query_params.get(name, '').lower() in ('true', '1')
+
+
+class ReplicaReadsMixin:
+    """
+    Направляет чтения представления в реплику (ReplicaRouter).
+
+    Если пользователь из URL (user_id) или аутентифицированный
+    пользователь запроса недавно изменял приоритеты
+    (READ_YOUR_WRITES_SECONDS), чтения идут в основную БД,
+    и пользователь видит собственные изменения.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads(kwargs.get('user_id')):
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Пользователь запроса известен только после аутентификации
+        if request.user.is_authenticated:
+            read_your_writes(request.user.id)
+
+
+class CompatibleUsersMixin:
+    """
+    Общая логика представлений совместимых пользователей:
+    формирование записей выдачи с именами пользователей.
     """
 
-    def get_user_vector(self, user_id):
+    def serialize_matches(self, matches, names=None):
         """
-        Получает вектор приоритетов для заданного пользователя.
+        Формирует записи выдачи из пар (ID пользователя, сходство),
+        нормализуя косинусное сходство до процента от 0 до 100.
 
-        :param user_id: ID пользователя
-        :return:        Кортеж, содержащий вектор приоритетов,
-                        индексы аспектов и ID аспектов пользователя
-        """
-        user = get_object_or_404(CustomUser, id=user_id)
-        priorities = Priority.objects.filter(users=user)
-
-        # Получение всех аспектов из таблицы и формирование их порядка,
-        # для корректной расстановки векторов
-        # и последующего рассчета косинусного сходства
-        aspect_indices = {
-            aspect.id: i
-            for i, aspect in enumerate(Aspect.objects.all())
+        Имена загружаются уже после отбора лучших пользователей,
+        одним запросом для отсутствующих в кэше имен.
+
+        :param matches: Список пар (ID пользователя, сходство)
+        :param names:   Словарь ID пользователя -> имя, если имена
+                        уже загружены
+        :return:        Список словарей с ID, именем
+                        и процентом совместимости
+        """
+        if names is None:
+            names = display_names.get_many(
+                [compatible_user_id for compatible_user_id, _ in matches]
+            )
+        return [
+            {
+                'user_id': compatible_user_id,
+                'name': names.get(compatible_user_id),
+                'compatibility_percentage': to_percentage(similarity)
+            }
+            for compatible_user_id, similarity in matches
+        ]
+
+    def serialize_result(self, result, names=None):
+        """
+        Формирует ответ с выдачей, источником и временем вычисления.
+        Выдача поиска, прерванного по бюджету времени, помечается
+        полем partial, а доля просмотренных пользователей
+        передается в поле scanned.
+        """
+        data = {
+            "compatible_users": self.serialize_matches(result["matches"], names),
+            "source": result["source"],
+            "computed_at": result["computed_at"],
+            "partial": result.get("partial", False),
+        }
+        if data["partial"]:
+            data["scanned"] = result["scanned"]
+        return data
+
+    @staticmethod
+    def get_deadline(request, mode, mutual, started):
+        """
+        Определяет момент окончания бюджета времени поиска на лету
+        из параметра budget_ms или настройки SEARCH_BUDGET_MS.
+
+        Бюджет поддерживается только точным поиском (mode равен exact
+        или не задан при SEARCH_MODE равной exact) без взаимной
+        выдачи; бюджет из настройки для остальных способов
+        не применяется.
+
+        :param request: Объект запроса
+        :param mode:    Способ поиска или None (настройка SEARCH_MODE)
+        :param mutual:  Запрошена взаимная выдача
+        :param started: Момент начала обработки запроса
+                        по time.monotonic
+        :return:        Кортеж (момент окончания бюджета или None, None)
+                        или (None, словарь ошибок)
+        """
+        serializer = CompatibleUsersSearchSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return None, serializer.errors
+
+        exact = not mutual and (mode or get_setting('SEARCH_MODE')) == 'exact'
+        budget_ms = serializer.validated_data.get('budget_ms')
+        if budget_ms is not None and not exact:
+            return None, {
+                "error": "Time budget is supported only by exact search."
+            }
+        if budget_ms is None:
+            budget_ms = get_setting('SEARCH_BUDGET_MS')
+        if budget_ms is None or not exact:
+            return None, None
+        return deadline_after(budget_ms, started), None
+
+    @staticmethod
+    def flight_key(user_id, mode, mutual, deadline, version):
+        """
+        Возвращает ключ объединения одновременных одинаковых
+        вычислений выдачи (single_flight): запросы с бюджетом времени
+        объединяются только между собой.
+        """
+        return user_id, mode, mutual, deadline is not None, version
+
+    @staticmethod
+    def uses_cache_lock(deadline):
+        """
+        Проверяет, согласуется ли вычисление выдачи между процессами
+        блокировкой в кэше (SINGLE_FLIGHT_CACHE_LOCK). Поиск
+        с бюджетом времени не ждет других процессов.
+        """
+        return (
+            deadline is None
+            and get_setting('SINGLE_FLIGHT_CACHE_LOCK')
+            and get_setting('RESULT_CACHE_TIMEOUT')
+        )
+
+    @staticmethod
+    def is_cacheable(result, version, replica_reads):
+        """
+        Проверяет, можно ли сохранить выдачу в кэше под версией
+        данных version, и убирает из нее служебные поля data_version
+        и store_generation. Не кэшируются неполная выдача поиска
+        с бюджетом времени, выдача по снимку движка, еще не получившему
+        изменения до этой версии (они применяются в фоне), выдача,
+        прочитанная из реплики, которая могла их еще не получить,
+        и выдача по хранилищу векторов, замененному во время поиска
+        (она сохранилась бы под поколением нового файла).
+
+        :param result:        Выдача find_matches
+        :param version:       Версия данных о приоритетах
+        :param replica_reads: Отметка чтений из реплики
+                              (track_replica_reads)
+        """
+        data_version = result.pop("data_version", None)
+        store_replaced = "store_generation" in result and (
+            result.pop("store_generation") != VectorStore.generation()
+        )
+        return (
+            not result.get("partial")
+            and not store_replaced
+            and (data_version is None or data_version >= version)
+            and (not replica_reads.used or replica_has_version(version))
+        )
+
+    @staticmethod
+    def budgeted_result(search_result):
+        """
+        Формирует результат поиска, ограниченного по времени.
+
+        :param search_result: Кортеж (список пар (ID пользователя,
+                              сходство), доля просмотренных
+                              пользователей)
+        """
+        matches, scanned = search_result
+        return {
+            "matches": matches,
+            "source": "live",
+            "computed_at": None,
+            "partial": scanned < 1,
+            "scanned": scanned,
         }
 
-        # Получение всех аспектов клиента и создание шаблона его вектора
-        user_aspect_ids = [priority.aspect.id for priority in priorities]
-        user_vector = [0] * len(aspect_indices)
+    @staticmethod
+    def is_listing(request):
+        """
+        Проверяет, запрошена ли полная выдача (потоком или страницами).
+        """
+        return (
+            query_flag(request, 'stream')
+            or 'cursor' in request.query_params
+            or 'page_size' in request.query_params
+        )
+
+    @staticmethod
+    def validate_listing(request, mode, mutual):
+        """
+        Проверяет параметры полной выдачи.
+
+        Полная выдача вычисляется точным поиском по снимку движка,
+        поэтому без параметра mode она доступна, только если способ
+        поиска по умолчанию ищет по снимку (uses_engine).
+
+        :param request: Объект запроса
+        :param mode:    Способ поиска или None
+        :param mutual:  Запрошена взаимная выдача
+        :return:        Кортеж (проверенные параметры, None)
+                        или (None, словарь ошибок)
+        """
+        if mutual or mode not in (None, 'exact') or not uses_engine(mode):
+            return None, {
+                "error": "Streaming and pagination support only exact search."
+            }
+        serializer = CompatibleUsersListingSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return None, serializer.errors
+        return serializer.validated_data, None
+
+    def serialize_page(self, page, names=None):
+        """
+        Формирует страницу выдачи с курсором следующей страницы.
+
+        :param page: Кортеж (список пар (ID пользователя, сходство),
+                     курсор следующей страницы или None)
+        """
+        matches, after = page
+        return {
+            "compatible_users": self.serialize_matches(matches, names),
+            "next_cursor": encode_cursor(after) if after else None,
+        }
 
-        # Разбор приоритетов клиента и формирвание его вектора интересов
-        for priority in priorities:
-            index = aspect_indices[priority.aspect.id]
+    def stream_matches(self, snapshot, user_id, threshold):
+        """
+        Выдает всех пользователей с совместимостью не ниже порога
+        строками NDJSON. Сходства вычисляются один раз, а записи
+        формируются и имена загружаются частями по STREAM_CHUNK_SIZE,
+        поэтому выдача целиком в памяти не собирается.
+        """
+        for chunk in iter_matches(snapshot, user_id, threshold):
+            names = display_names.get_many(
+                [compatible_user_id for compatible_user_id, _ in chunk],
+                store=False
+            )
+            for record in self.serialize_matches(chunk, names):
+                yield json.dumps(record, ensure_ascii=False) + '\n'
 
-            weight = priority.weight.weight
-            attitude = priority.attitude.attitude
-            user_vector[index] = weight if attitude == 'positive' else -weight
 
-        return user_vector, aspect_indices, user_aspect_ids
+class CompatibleUsersView(ReplicaReadsMixin, CompatibleUsersMixin, views.APIView):
+    """
+    Представление для получения списка совместимых пользователей
+    на основе приоритетов.
+    """
 
     def get(self, request, user_id):
         """
@@ -189,114 +433,328 @@ class CompatibleUsersView(views.APIView):
 
         Производит анализ приоритетов пользователей
         с целью определения степени совместимости.
-        Для заданного пользователя ищет других пользователей,
-        у которых есть общие приоритеты, и вычисляет степень совместимости
-        на основе косинусного сходства между их векторами приоритетов.
+        Выдача кэшируется до следующего изменения приоритетов
+        (RESULT_CACHE_TIMEOUT), а одновременные одинаковые запросы
+        ждут вычисления первого из них (compute_matches).
+        Если способ поиска не задан и для пользователя есть
+        предвычисленный список (команда compute_neighbors) не старше
+        NEIGHBORS_MAX_AGE секунд, выдача берется из него.
+        Иначе векторы приоритетов всех пользователей берутся из
+        резидентной разреженной матрицы движка подбора, и степень
+        совместимости (косинусное сходство) вычисляется способом
+        из параметра запроса mode или настройки SEARCH_MODE:
+        произведением вектора клиента на всю матрицу,
+        по инвертированному индексу аспектов с отсечением кандидатов,
+        которые не могут попасть в выдачу, приближенно - по сигнатурам
+        LSH или по ближайшим кластерам, либо сгруппированным запросом
+        к БД без резидентной матрицы.
+        С параметром mutual=true выдаются только взаимно совместимые
+        пользователи: те, в чьих списках находится и сам пользователь.
+        Они берутся из предвычисленных пар или находятся на лету
+        пакетным поиском обратных выдач.
+        С параметрами stream=true, cursor или page_size выдаются все
+        пользователи с совместимостью не ниже threshold (list_all_matches).
+        С параметром budget_ms (или настройкой SEARCH_BUDGET_MS) точный
+        поиск на лету ограничивается по времени: по истечении бюджета
+        возвращаются лучшие из просмотренных пользователей с partial=true
+        и долей просмотренных пользователей scanned.
 
         :param request: Объект запроса
         :param user_id: ID пользователя,
                         для которого необходимо найти совместимых пользователей
         :return:        Список совместимых пользователей в
-                        порядке убывания степени совместимости
+                        порядке убывания степени совместимости,
+                        источник выдачи (precomputed или live)
+                        и время вычисления предвычисленного списка
         """
-        # user_vector - вектор интересов клиента
-        # aspect_indices - словарь с установленным порядком аспектов,
-        #                  для установки порядка в векторах
-        # user_aspect_ids - список с аспектами клиента
-        user_vector, aspect_indices, user_aspect_ids = self.get_user_vector(user_id)
-
-        if not any(user_vector):
+        started = time.monotonic()
+        mode = request.query_params.get('mode') or None
+        if mode is not None and mode not in SEARCH_MODES:
             return Response(
-                {"error": "User does not have any priorities."},
+                {"error": f"Unknown search mode: {mode}."},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        mutual = query_flag(request, 'mutual')
+        if self.is_listing(request):
+            return self.list_all_matches(request, user_id, mode, mutual)
+
+        deadline, errors = self.get_deadline(request, mode, mutual, started)
+        if errors is not None:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        version = get_data_version()
+        result = result_cache.get(user_id, mode, version, mutual)
+        if result is None:
+            get_object_or_404(CustomUser, id=user_id)
+            # Одновременные одинаковые запросы ждут вычисления первого
+            result = single_flight.do(
+                self.flight_key(user_id, mode, mutual, deadline, version),
+                lambda: self.compute_matches(
+                    user_id, mode, mutual, deadline, version
+                )
+            )
 
-        # Получение всех пользователей с приоритететами клиента
-        relevant_user_ids = Priority.objects.filter(
-            aspect__id__in=user_aspect_ids
-        ).values_list(
-            'users__id', flat=True
-        ).distinct()
-
-        # Удаление id клиента из списка пользователей
-        relevant_user_ids = list(relevant_user_ids)
-        if user_id in relevant_user_ids:
-            relevant_user_ids.remove(user_id)
-
-        # Получение всех приоритетов пользователей,
-        # имеющих общие приоритеты с клиентом
-        all_priorities = Priority.objects.filter(
-            users__id__in=relevant_user_ids
-        ).values(
-            'users__id',
-            'aspect__id',
-            'weight__weight',
-            'attitude__attitude'
-        )
+            if result is None:
+                return Response(
+                    {"error": "User does not have any priorities."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        # Отбор не более COMPATIBLE_USERS_LIMIT пользователей
+        # с совместимостью не ниже COMPATIBILITY_THRESHOLD процентов
+        return Response(self.serialize_result(result), status=status.HTTP_200_OK)
+
+    def list_all_matches(self, request, user_id, mode, mutual):
+        """
+        Возвращает всех пользователей с совместимостью не ниже порога
+        из параметра threshold: с stream=true - потоком NDJSON
+        в порядке убывания совместимости, иначе - страницами
+        по page_size записей с курсором next_cursor (пара сходство
+        и ID последней записи), который передается параметром cursor
+        для получения следующей страницы. Сходства вычисляются
+        точным поиском по снимку движка.
+
+        :param request: Объект запроса
+        :param user_id: ID пользователя
+        :param mode:    Способ поиска (допускается только exact)
+        :param mutual:  Запрошена взаимная выдача (не поддерживается)
+        :return:        Потоковый ответ или страница выдачи
+        """
+        params, errors = self.validate_listing(request, mode, mutual)
+        if errors is not None:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-        # Создание словаря, в котором для каждого несуществующего ключа
-        # будет создаваться массив из нулей длиной в количество аспектов в БД
-        vectors = defaultdict(lambda: [0] * len(aspect_indices))
-
-        # В цикле по одному перебираются приоритеты, привязанные к пользователю
-        # Благордаря defaultdict они подставляются на те позиции, на которых
-        # они должны находится в соответствии с aspect_indices. В конце цикла
-        # словарь vectors полностью заполняется правильно упорядоченными
-        # векторами каждого пользователя
-        for priority in all_priorities:
-            user_id = priority['users__id']
-            aspect_id = priority['aspect__id']
-            weight = priority['weight__weight']
-            attitude = priority['attitude__attitude']
-
-            index = aspect_indices[aspect_id]
-            vectors[user_id][index] = weight if attitude == 'positive' else -weight
-
-        # Если ни одного вектора интересов построить не удалось
-        # (не было пользователей, не было пользователей с
-        # заполненными интересами), то выполнение алгоритма останавливается
-        if not vectors:
+        get_object_or_404(CustomUser, id=user_id)
+        snapshot = get_engine().snapshot()
+        if not snapshot.has_priorities(user_id):
             return Response(
-                {"compatible_users": []},
-                status=status.HTTP_200_OK
+                {"error": "User does not have any priorities."},
+                status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Рассчет косинусного сходства,
-        # формирование массива для вывода результата запроса клиента,
-        # нормализация косинусного сходства (до значения до 0 до 100),
-        # фильтрация от 75 и ниже и сортировка
-        similarities = cosine_similarity(
-            [user_vector], list(vectors.values())
-        )[0]
+        threshold = params.get('threshold')
+        if query_flag(request, 'stream'):
+            return StreamingHttpResponse(
+                self.stream_matches(snapshot, user_id, threshold),
+                content_type='application/x-ndjson'
+            )
 
-        compatible_users = [
-            {
-                'user_id': user_id,
-                'name': self.get_user_name(user_id),
-                'compatibility_percentage': (similarity + 1) / 2 * 100
-            }
-            for user_id, similarity in zip(vectors.keys(), similarities)
-            if (similarity + 1) / 2 * 100 >= 75
-        ]
-        compatible_users = sorted(
-            compatible_users,
-            key=lambda x: x['compatibility_percentage'],
-            reverse=True
+        page = matches_page(
+            snapshot,
+            user_id,
+            threshold,
+            params.get('cursor'),
+            params.get('page_size')
         )
+        return Response(self.serialize_page(page), status=status.HTTP_200_OK)
 
-        return Response(
-            {"compatible_users": compatible_users[:20]},
-            status=status.HTTP_200_OK
-        )
+    def compute_matches(self, user_id, mode, mutual, deadline, version):
+        """
+        Находит совместимых пользователей и сохраняет выдачу в кэше
+        (неполная выдача поиска с бюджетом времени не кэшируется).
+
+        С настройкой SINGLE_FLIGHT_CACHE_LOCK процесс сначала
+        захватывает блокировку в кэше, а процессы, не захватившие
+        ее, ждут, пока выдача появится в кэше, и вычисляют ее сами,
+        только если блокировка снята без сохранения выдачи.
+
+        :param user_id:  ID пользователя
+        :param mode:     Способ поиска или None
+        :param mutual:   Искать только взаимно совместимых пользователей
+        :param deadline: Момент окончания бюджета времени или None
+        :param version:  Версия данных о приоритетах
+        :return:         Результат find_matches
+        """
+        locked = False
+        if self.uses_cache_lock(deadline):
+            locked = result_cache.acquire(user_id, mode, version, mutual)
+            if not locked:
+                result = result_cache.wait(user_id, mode, version, mutual)
+                if result is not None:
+                    return result
+
+        try:
+            with track_replica_reads() as reads:
+                result = self.find_matches(user_id, mode, mutual, deadline)
+            if result is not None and self.is_cacheable(result, version, reads):
+                result_cache.set(user_id, mode, result, version, mutual)
+            return result
+        finally:
+            if locked:
+                result_cache.release(user_id, mode, version, mutual)
+
+    def find_matches(self, user_id, mode, mutual=False, deadline=None):
+        """
+        Находит совместимых пользователей в предвычисленном списке
+        или на лету.
+
+        :param user_id:  ID пользователя
+        :param mode:     Способ поиска или None
+        :param mutual:   Искать только взаимно совместимых пользователей
+        :param deadline: Момент окончания бюджета времени поиска
+                         на лету или None (см. get_deadline)
+        :return:         Словарь со списком пар (ID пользователя, сходство),
+                         источником выдачи, временем вычисления списка
+                         версией данных снимка движка (data_version)
+                         и поколением хранилища векторов (store_generation)
+                         или None, если у пользователя нет приоритетов
+        """
+        if mode is None:
+            precomputed = self.get_precomputed_matches(user_id, mutual)
+            if precomputed is not None:
+                computed_at, matches = precomputed
+                return {
+                    "matches": matches,
+                    "source": "precomputed",
+                    "computed_at": computed_at,
+                }
+
+        engine = get_engine()
+        snapshot = engine.snapshot() if uses_engine(mode) else None
+        # Поколение хранилища векторов читается до поиска,
+        # как версия данных
+        store_generation = VectorStore.generation() if uses_vector_store(mode) else None
+        if deadline is not None:
+            if not snapshot.has_priorities(user_id):
+                return None
+            result = self.budgeted_result(
+                budgeted_search(snapshot, user_id, deadline)
+            )
+        else:
+            search = find_mutual_users if mutual else find_compatible_users
+            with engine.pinned(snapshot):
+                matches = search(user_id, mode)
+            if matches is None:
+                return None
+            result = {"matches": matches, "source": "live", "computed_at": None}
+        if snapshot is not None:
+            result["data_version"] = snapshot.data_version
+        if uses_vector_store(mode):
+            result["store_generation"] = store_generation
+        return result
 
     @staticmethod
-    def get_user_name(user_id):
+    def get_precomputed_matches(user_id, mutual=False):
         """
-        Возвращает имя пользователя по его ID.
-        Если first_name и last_name отсутствуют, возвращает username.
+        Возвращает предвычисленный список совместимых
+        (или взаимно совместимых) пользователей,
+        если он достаточно свежий.
 
         :param user_id: ID пользователя
-        :return: Имя пользователя
+        :param mutual:  Вернуть только взаимно совместимых пользователей
+        :return:        Кортеж (время вычисления, список пар
+                        (ID пользователя, сходство)) или None
+        """
+        max_age = get_setting('NEIGHBORS_MAX_AGE')
+        if not max_age:
+            return None
+        lookup = get_mutual_matches if mutual else get_neighbor_list
+        return lookup(
+            user_id,
+            timezone.now() - timedelta(seconds=max_age),
+            get_setting('COMPATIBLE_USERS_LIMIT')
+        )
+
+
+class CompatibleUsersCacheStatsView(views.APIView):
+    """
+    Представление для получения статистики кэша выдачи
+    совместимых пользователей.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        """
+        Обрабатывает GET-запросы.
+
+        :param request: Объект запроса
+        :return:        Количество попаданий и промахов, доля попаданий
+                        и текущая версия данных о приоритетах
+        """
+        return Response(ResultCache.stats(), status=status.HTTP_200_OK)
+
+
+class MatchingEngineStatsView(views.APIView):
+    """
+    Представление для получения сведений о снимке движка подбора
+    текущего процесса.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
         """
-        user = CustomUser.objects.get(id=user_id)
-        return f"{user.first_name} {user.last_name}".strip() or user.username
+        Обрабатывает GET-запросы.
+
+        :param request: Объект запроса
+        :return:        Версия и размеры снимка, его возраст,
+                        длительность последнего полного построения,
+                        признак идущего фонового построения
+                        и размер горячего уровня поиска tiered
+        """
+        stats = get_engine().stats()
+        stats['tiered'] = tiered_store.stats()
+        return Response(stats, status=status.HTTP_200_OK)
+
+
+class CompatibleUsersBatchView(ReplicaReadsMixin, CompatibleUsersMixin, views.APIView):
+    """
+    Представление для пакетного получения списков совместимых
+    пользователей сразу для многих пользователей.
+    """
+
+    def post(self, request):
+        """
+        Обрабатывает POST-запросы со списком ID пользователей.
+
+        Векторы всех запрошенных пользователей собираются в одну
+        матрицу, и сходства вычисляются блоками одним произведением
+        разреженных матриц вместо отдельного поиска для каждого.
+        Способы поиска без резидентного снимка (DATABASE_MODES)
+        ищут каждого пользователя отдельно.
+        Порог совместимости, ограничение выдачи и формат записей
+        совпадают с CompatibleUsersView.
+
+        :param request: Объект запроса с полем user_ids
+        :return:        Словарь ID пользователя -> список совместимых
+                        пользователей и словарь ошибок для пользователей,
+                        которых нет или у которых нет приоритетов
+        """
+        serializer = CompatibleUsersBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        user_ids = serializer.validated_data['user_ids']
+        existing_ids = set(
+            CustomUser.objects.filter(
+                id__in=user_ids
+            ).values_list('id', flat=True)
+        )
+
+        results = find_compatible_users_batch(
+            [user_id for user_id in user_ids if user_id in existing_ids]
+        )
+
+        names = display_names.get_many(list({
+            compatible_user_id
+            for matches in results.values() if matches
+            for compatible_user_id, _ in matches
+        }))
+
+        compatible_users, errors = {}, {}
+        for user_id in user_ids:
+            if user_id not in existing_ids:
+                errors[user_id] = "User not found."
+            elif results[user_id] is None:
+                errors[user_id] = "User does not have any priorities."
+            else:
+                compatible_users[user_id] = self.serialize_matches(
+                    results[user_id], names
+                )
+
+        return Response(
+            {"compatible_users": compatible_users, "errors": errors},
+            status=status.HTTP_200_OK
+        )